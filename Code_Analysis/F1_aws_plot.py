@@ -1,206 +1,188 @@
 import numpy as np
 import pandas as pd
 
-import fastf1 as ff1
-from fastf1 import plotting
+from lazy_session import needs_streams
+from render import finish_figure, pyplot
+from telemetry_alignment import align_laps, channel_index
+from driver_comparisons import distinct_colors, fastest_lap, get_session
+from instrumentation import instrumented, stage
+
+
+# The actions a driver can be doing, codes index into this tuple
+ACTIONS = ('Brake', 'Full Throttle', 'Cornering')
+
+# Meters shown after the exit of a corner in corner_comparison
+CORNER_MARGIN = 100
+
+telemetry_colors = {
+    'Full Throttle': 'green',
+    'Cornering': 'grey',
+    'Brake': 'red',
+}
+
+
+def action_codes(brake, throttle):
+    '''Labels every telemetry sample with an index into ACTIONS:
+    Throttle == 100 → 'Full Throttle'
+    Brake > 0 → 'Brake'
+    everything else → 'Cornering'''
+    brake = np.asarray(brake)
+    throttle = np.asarray(throttle)
+    return np.where(throttle >= 100, 1, np.where(brake > 0, 0, 2)).astype(np.int8)
+
+
+def action_spans(distance, codes, lap_ids=None):
+    '''Run-length encodes the actions of one or many laps laid end to end.
+    A run ends where the action or the lap changes. Returns start distance,
+    end distance, action code and lap id of every run; each run starts where
+    the previous one of the same lap ended, so the bars join up'''
+    distance = np.asarray(distance, dtype=float)
+    codes = np.asarray(codes)
+    lap_ids = np.zeros(len(codes), dtype=int) if lap_ids is None else np.asarray(lap_ids)
+
+    change = np.empty(len(codes), dtype=bool)
+    change[0] = True
+    change[1:] = (codes[1:] != codes[:-1]) | (lap_ids[1:] != lap_ids[:-1])
+    first = np.flatnonzero(change)
+    last = np.append(first[1:], len(codes)) - 1
+
+    end = distance[last]
+    start = distance[first]
+    # join every run onto the end of the previous run of the same lap
+    same_lap = np.zeros(len(first), dtype=bool)
+    same_lap[1:] = lap_ids[first[1:]] == lap_ids[first[:-1]]
+    start[same_lap] = end[:-1][same_lap[1:]]
+
+    return start, end, codes[first], lap_ids[first]
+
+
+def aligned_action_spans(grid, telemetry, labels):
+    '''Action spans of every lap in an aligned telemetry array (laps x grid x
+    channels) in one pass, as a table with one row per span'''
+    n_laps, n_samples = telemetry.shape[:2]
+    codes = action_codes(telemetry[..., channel_index('Brake')].ravel(),
+                         telemetry[..., channel_index('Throttle')].ravel())
+    lap_ids = np.repeat(np.arange(n_laps), n_samples)
+    with stage('action_spans', rows=codes.size):
+        start, end, action, lap = action_spans(np.tile(grid, n_laps), codes, lap_ids)
+
+    return pd.DataFrame({
+        'Lap': np.asarray(labels)[lap],
+        'Start': start,
+        'End': end,
+        'CurrentAction': pd.Categorical.from_codes(action, ACTIONS),
+    })
+
+
+def corner_average_speeds(grid, telemetry, d_min, d_max):
+    '''Average speed of every lap between d_min and d_max'''
+    window = (grid >= d_min) & (grid <= d_max)
+    return telemetry[:, window, channel_index('Speed')].mean(axis=1)
+
+
+@instrumented()
+@needs_streams('laps', 'car_data')
+def race_action_spans(session, drivers=None, step=5.0):
+    '''Action spans of every timed lap of the given drivers (all by default),
+    for analysing a whole race rather than only the fastest laps'''
+    laps = session.laps
+    laps = laps.loc[laps['LapTime'].notna()]
+    if drivers is not None:
+        laps = laps.loc[laps['Driver'].isin(drivers)]
+
+    lap_list = [lap for _, lap in laps.iterlaps()]
+    grid, telemetry = align_laps(lap_list, step=step)
+    spans = aligned_action_spans(grid, telemetry, np.arange(len(lap_list)))
+
+    # Attach driver and lap number to every span
+    spans['Driver'] = laps['Driver'].to_numpy()[spans['Lap']]
+    spans['LapNumber'] = laps['LapNumber'].to_numpy()[spans['Lap']]
+    return spans.drop(columns='Lap')
+
+
+def fastest_lap_actions(session, driver_1, driver_2):
+    '''Aligned telemetry of the fastest laps of two drivers, their colors and
+    what each driver is doing along the lap as (start, end, action) spans'''
+    # Extracting the fastest laps for specified drivers
+    fastest_driver_1 = fastest_lap(session, driver_1)
+    fastest_driver_2 = fastest_lap(session, driver_2)
+
+    # load telemetry, aligned on the same distances
+    distance, telemetry = align_laps([fastest_driver_1, fastest_driver_2])
 
-from matplotlib import pyplot as plt
-from matplotlib.pyplot import figure
-
-
-def get_session(year, grand_prix, session):
-    ''' This calls on the fastf1 api and creates a session based on year,
-     grand prix, and session(Quali, race, sprint) wanted '''
-    # Setup plotting
-    plotting.setup_mpl()
-
-    # Enable the cache
-    ff1.Cache.enable_cache('/Users/cameronstevens/Documents/Coding/F1_2022_race_analytics/cache') 
-
-    # Get rid of some pandas warnings that are not relevant for us at the moment
-    pd.options.mode.chained_assignment = None 
-
-    # we only want support for timedelta plotting in this example
-    ff1.plotting.setup_mpl(mpl_timedelta_support=True, color_scheme=None, misc_mpl_mods=False)
+    # Identifying the team for coloring later on
+    colors = distinct_colors([fastest_driver_1['Team'], fastest_driver_2['Team']])
 
-    #This loads the session for the Grand prix session of interest
+    # What each driver is doing along the lap, as (start, end, action) spans
+    all_actions = aligned_action_spans(distance, telemetry, [driver_1, driver_2])
+    return distance, telemetry, colors, all_actions
 
-    session = ff1.get_session(year, grand_prix, session)
-    
-    session.load() 
 
-    return(session)
+def speed_difference_text(driver_1, driver_2, avg_speed_driver_1, avg_speed_driver_2):
+    if avg_speed_driver_1 > avg_speed_driver_2:    
+        return f"{driver_1} {round(avg_speed_driver_1 - avg_speed_driver_2,2)}km/h faster"
+    return f"{driver_2} {round(avg_speed_driver_2 - avg_speed_driver_1,2)}km/h faster"
 
 
-def get_driver_aws_data(driver_1, driver_2, d_min, d_max, session):
+@instrumented()
+@needs_streams('laps', 'car_data')
+def get_driver_aws_data(driver_1, driver_2, d_min, d_max, session, output=None, dpi=None):
     ''' Specify the drivers of interest, and we choose the corners,
     or the distance we want to compare specifically. We pick the fastest lap from the
-    loaded telementry data'''
-
-    # Extracting the laps for specified drivers
-    laps_driver_1 = session.laps.pick_driver(driver_1)
-    laps_driver_2 = session.laps.pick_driver(driver_2)
-    #pick fastest lap and load telemetry
-    telemetry_driver_1 = laps_driver_1.pick_fastest().get_car_data().add_distance()
-    telemetry_driver_2 = laps_driver_2.pick_fastest().get_car_data().add_distance()
-
-    # Identifying the team for coloring later on
-    team_driver_1 = laps_driver_1.reset_index().loc[0, 'Team']
-    team_driver_2 = laps_driver_2.reset_index().loc[0, 'Team']
-
-    #label all the rows of telemtry data according to the following rules:
-    #Brake > 0 → ‘Brake’
-    #Throttle == 100 → ‘Full Throttle’
-    #Brake == 0 & Throttle < 100 → ‘Cornering’
-    # Assigning labels to what the drivers are currently doing 
-    telemetry_driver_1.loc[telemetry_driver_1['Brake'] > 0, 'CurrentAction'] = 'Brake'
-    telemetry_driver_1.loc[telemetry_driver_1['Throttle'] == 100, 'CurrentAction'] = 'Full Throttle'
-    telemetry_driver_1.loc[(telemetry_driver_1['Brake'] == 0) & (telemetry_driver_1['Throttle'] < 100), 'CurrentAction'] = 'Cornering'
-
-    telemetry_driver_2.loc[telemetry_driver_2['Brake'] > 0, 'CurrentAction'] = 'Brake'
-    telemetry_driver_2.loc[telemetry_driver_2['Throttle'] == 100, 'CurrentAction'] = 'Full Throttle'
-    telemetry_driver_2.loc[(telemetry_driver_2['Brake'] == 0) & (telemetry_driver_2['Throttle'] < 100), 'CurrentAction'] = 'Cornering'
-
-
-    # Numbering each unique action to identify changes, so that we can group later on
-    telemetry_driver_1['ActionID'] = (telemetry_driver_1['CurrentAction'] != telemetry_driver_1['CurrentAction'].shift(1)).cumsum()
-    telemetry_driver_2['ActionID'] = (telemetry_driver_2['CurrentAction'] != telemetry_driver_2['CurrentAction'].shift(1)).cumsum()
-
-    # Identifying all unique actions
-    actions_driver_1 = telemetry_driver_1[['ActionID', 'CurrentAction', 'Distance']].groupby(['ActionID', 'CurrentAction']).max('Distance').reset_index()
-    actions_driver_2 = telemetry_driver_2[['ActionID', 'CurrentAction', 'Distance']].groupby(['ActionID', 'CurrentAction']).max('Distance').reset_index()
-
-    actions_driver_1['Driver'] = driver_1
-    actions_driver_2['Driver'] = driver_2
-
-
-    #we want to know the distance elapsed time per section
-    #actions_driver_1 and actions_driver_2 display which distance the action took place
-    # Calculating the distance between each action, so that we know how long the bar should be
-    actions_driver_1['DistanceDelta'] = actions_driver_1['Distance'] - actions_driver_1['Distance'].shift(1)
-    actions_driver_1.loc[0, 'DistanceDelta'] = actions_driver_1.loc[0, 'Distance']
-
-    actions_driver_2['DistanceDelta'] = actions_driver_2['Distance'] - actions_driver_2['Distance'].shift(1)
-    actions_driver_2.loc[0, 'DistanceDelta'] = actions_driver_2.loc[0, 'Distance']
+    loaded telementry data. See render.finish_figure for output'''
 
-
-    # Merging together
-    all_actions = actions_driver_1.append(actions_driver_2)
+    distance, telemetry, colors, all_actions = fastest_lap_actions(session, driver_1, driver_2)
 
     #WE ask ourselves what driver actually performed better through the corners
     #and the answer is by looking at drivers highest average speed through the corner.
+    avg_speed_driver_1, avg_speed_driver_2 = corner_average_speeds(distance, telemetry, d_min, d_max)
+    speed_text = speed_difference_text(driver_1, driver_2, avg_speed_driver_1, avg_speed_driver_2)
 
-    # Calculating average speed
-    avg_speed_driver_1 = np.mean(telemetry_driver_1['Speed'].loc[
-        (telemetry_driver_1['Distance'] >= d_min) & 
-            (telemetry_driver_1['Distance'] >= d_max) 
-    ])
-
-
-    avg_speed_driver_2 = np.mean(telemetry_driver_2['Speed'].loc[
-        (telemetry_driver_2['Distance'] >= d_min) & 
-            (telemetry_driver_2['Distance'] >= d_max) 
-    ])
-
-    if avg_speed_driver_1 > avg_speed_driver_2:    
-        speed_text = f"{driver_1} {round(avg_speed_driver_1 - avg_speed_driver_2,2)}km/h faster"
-    else:
-        speed_text = f"{driver_1} {round(avg_speed_driver_2 - avg_speed_driver_1,2)}km/h faster"
-
-    ##############################
-    #
-    # Setting everything up
-    #
-    ##############################
-    plt.rcParams["figure.figsize"] = [13, 4]
-    plt.rcParams["figure.autolayout"] = True
-
-    telemetry_colors = {
-        'Full Throttle': 'green',
-        'Cornering': 'grey',
-        'Brake': 'red',
-    }
-
-    fig, ax = plt.subplots(2)
-
-
-    ##############################
-    #
-    # Lineplot for speed 
-    #
-    ##############################
-    ax[0].plot(telemetry_driver_1['Distance'], telemetry_driver_1['Speed'], label=driver_1, color=ff1.plotting.team_color(team_driver_1))
-    ax[0].plot(telemetry_driver_2['Distance'], telemetry_driver_2['Speed'], label=driver_2, color=ff1.plotting.team_color(team_driver_2))
-
-    # Speed difference
-    ax[0].text(d_min + 15,200, speed_text, fontsize = 15)
+    return plot_aws_driver_data(distance, telemetry, [driver_1, driver_2], colors, all_actions,
+                                d_min, d_max, speed_text, output=output, dpi=dpi)
 
-    ax[0].set(ylabel='Speed')
-    ax[0].legend(loc="lower right")
 
+@instrumented()
+@needs_streams('laps', 'car_data')
+def corner_comparison(driver_1, driver_2, corner, session, output=None, dpi=None):
+    '''get_driver_aws_data through a corner by number (4 or "T4") of the
+    detected corner table instead of guessed distances. With corner None or
+    "auto" it shows the corner where the two fastest laps differ most'''
+    from corners import circuit_corners, corner as corner_row
 
-    ##############################
-    #
-    # Horizontal barplot for telemetry
-    #
-    ##############################
-    for driver in [driver_1, driver_2]:
-        driver_actions = all_actions.loc[all_actions['Driver'] == driver]
-        
-        previous_action_end = 0
-        for _, action in driver_actions.iterrows():
-            ax[1].barh(
-                [driver], 
-                action['DistanceDelta'], 
-                left=previous_action_end, 
-                color=telemetry_colors[action['CurrentAction']]
-            )
-            
-            previous_action_end = previous_action_end + action['DistanceDelta']
-            
-            
-    ##############################
-    #
-    # Styling of the plot
-    #
-    ##############################   
-    # Set x-label
-    plt.xlabel('Distance')
+    corners = circuit_corners(session)
+    distance, telemetry, colors, all_actions = fastest_lap_actions(session, driver_1, driver_2)
 
-    # Invert y-axis 
-    plt.gca().invert_yaxis()
+    if corner is None or str(corner).lower() == 'auto':
+        differences = [abs(np.subtract(*corner_average_speeds(distance, telemetry, entry, exit_)))
+                       for entry, exit_ in zip(corners['Entry'], corners['Exit'])]
+        row = corners.iloc[int(np.argmax(differences))]
+    else:
+        row = corner_row(corners, corner)
 
-    # Remove frame from plot
-    ax[1].spines['top'].set_visible(False)
-    ax[1].spines['right'].set_visible(False)
-    ax[1].spines['left'].set_visible(False)
+    d_min, d_max = row['Entry'], row['Exit']
+    avg_speed_driver_1, avg_speed_driver_2 = corner_average_speeds(distance, telemetry, d_min, d_max)
+    speed_text = f"T{int(row['Corner'])}: " + speed_difference_text(driver_1, driver_2, avg_speed_driver_1,
+                                                                     avg_speed_driver_2)
 
-    # Add legend
-    labels = list(telemetry_colors.keys())
-    handles = [plt.Rectangle((0,0),1,1, color=telemetry_colors[label]) for label in labels]
-    ax[1].legend(handles, labels)
+    # A little of the straight after the exit, where the drive out of the corner shows
+    return plot_aws_driver_data(distance, telemetry, [driver_1, driver_2], colors, all_actions,
+                                d_min, d_max + CORNER_MARGIN, speed_text, output=output, dpi=dpi)
 
-    # Zoom in on the specific part we want to see
-    ax[0].set_xlim(d_min, d_max)
-    ax[1].set_xlim(d_min, d_max)
 
-def plot_aws_driver_data():
+def plot_aws_driver_data(distance, telemetry, drivers, colors, all_actions, d_min, d_max,
+                         speed_text='', output=None, dpi=None):
+    '''Speed traces on top and the action timeline of every driver below'''
 
     ##############################
     #
     # Setting everything up
     #
     ##############################
-    plt.rcParams["figure.figsize"] = [13, 4]
-    plt.rcParams["figure.autolayout"] = True
-
-    telemetry_colors = {
-        'Full Throttle': 'green',
-        'Cornering': 'grey',
-        'Brake': 'red',
-    }
-
-    fig, ax = plt.subplots(2)
+    # Figure settings are passed per figure, not through the global rcParams,
+    # so they don't leak into every plot made afterwards
+    plt = pyplot()
+    fig, ax = plt.subplots(2, figsize=[13, 4], tight_layout=True)
 
 
     ##############################
@@ -208,8 +190,8 @@ def plot_aws_driver_data():
     # Lineplot for speed 
     #
     ##############################
-    ax[0].plot(telemetry_driver_1['Distance'], telemetry_driver_1['Speed'], label=driver_1, color=ff1.plotting.team_color(team_driver_1))
-    ax[0].plot(telemetry_driver_2['Distance'], telemetry_driver_2['Speed'], label=driver_2, color=ff1.plotting.team_color(team_driver_2))
+    for i, driver in enumerate(drivers):
+        ax[0].plot(distance, telemetry[i, :, channel_index('Speed')], label=driver, color=colors[i])
 
     # Speed difference
     ax[0].text(d_min + 15,200, speed_text, fontsize = 15)
@@ -223,19 +205,16 @@ def plot_aws_driver_data():
     # Horizontal barplot for telemetry
     #
     ##############################
-    for driver in [driver_1, driver_2]:
-        driver_actions = all_actions.loc[all_actions['Driver'] == driver]
-        
-        previous_action_end = 0
-        for _, action in driver_actions.iterrows():
-            ax[1].barh(
-                [driver], 
-                action['DistanceDelta'], 
-                left=previous_action_end, 
-                color=telemetry_colors[action['CurrentAction']]
-            )
-            
-            previous_action_end = previous_action_end + action['DistanceDelta']
+    # One broken_barh per driver instead of one bar artist per action
+    for i, driver in enumerate(drivers):
+        driver_actions = all_actions.loc[all_actions['Lap'] == driver]
+        ax[1].broken_barh(
+            list(zip(driver_actions['Start'], driver_actions['End'] - driver_actions['Start'])),
+            (i - 0.4, 0.8),
+            facecolors=driver_actions['CurrentAction'].map(telemetry_colors).astype(str).tolist()
+        )
+    ax[1].set_yticks(range(len(drivers)))
+    ax[1].set_yticklabels(drivers)
             
             
     ##############################
@@ -244,10 +223,10 @@ def plot_aws_driver_data():
     #
     ##############################   
     # Set x-label
-    plt.xlabel('Distance')
+    ax[1].set_xlabel('Distance')
 
     # Invert y-axis 
-    plt.gca().invert_yaxis()
+    ax[1].invert_yaxis()
 
     # Remove frame from plot
     ax[1].spines['top'].set_visible(False)
@@ -263,4 +242,4 @@ def plot_aws_driver_data():
     ax[0].set_xlim(d_min, d_max)
     ax[1].set_xlim(d_min, d_max)
 
-
+    return finish_figure(fig, output, dpi)
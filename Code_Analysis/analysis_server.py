@@ -0,0 +1,538 @@
+# analysis_server.py
+# A long-running local HTTP service that serves the analyses from warm sessions.
+#
+# Every dashboard request used to start Python, import everything, load the
+# session and render. Here the sessions stay loaded in a few worker processes
+# and rendered images and tables are kept by a hash of their parameters, so
+# asking for the same comparison again is a dictionary lookup.
+#
+# pyplot is not thread-safe, so every worker renders one figure at a time on a
+# single thread. Requests for the same session always go to the same worker
+# (that is where the session is warm), identical requests in flight are only
+# rendered once and the HTTP threads themselves never touch matplotlib.
+#
+# Example:
+#   python analysis_server.py --port 8050 --workers 2 --preload 2022:Monaco:Q
+#   curl "localhost:8050/plot/double_driver_lap_comparison?year=2022&gp=Monaco&session=Q&args=VER,LEC"
+#   curl "localhost:8050/plot/driver_gear_changes?year=2022&gp=Monaco&session=Q&args=LEC&format=svg"
+#   curl "localhost:8050/data/fastest_laps?year=2022&gp=Monaco&session=Q"
+#   curl "localhost:8050/stats"
+#
+# Endpoints:
+#   /plot/<analysis>  any analysis of season_batch.ANALYSES as png, svg or pdf
+#   /data/<table>     one of TABLES as JSON records
+#   /analyses         what can be asked for
+#   /stats            artifact cache and latency statistics
+#   /health
+
+import os
+import sys
+import json
+import time
+import hashlib
+import argparse
+import functools
+import threading
+import traceback
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from concurrent.futures.process import BrokenProcessPool
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+from season_batch import ANALYSES, DRIVER_LIST_ANALYSES, parse_analysis
+from instrumentation import stage
+
+
+# Name -> (module, function) of the tables served as JSON. Each takes the
+# session, and drivers= when the request has args
+TABLES = {
+    'fastest_laps': ('analysis_server', 'fastest_laps'),
+    'lap_deltas': ('driver_comparisons', 'pairwise_lap_deltas'),
+    'race_pace': ('race_pace', 'race_pace_table'),
+    'weather': ('static_plot', 'laps_with_weather'),
+    'action_spans': ('F1_aws_plot', 'race_action_spans'),
+    'gaps': ('track_index', 'field_gaps'),
+    'corners': ('corners', 'corner_stats'),
+    'theoretical_best': ('minisectors', 'theoretical_best'),
+}
+
+CONTENT_TYPES = {
+    'png': 'image/png',
+    'svg': 'image/svg+xml',
+    'pdf': 'application/pdf',
+    'json': 'application/json',
+}
+
+# Rendered artifacts kept in memory, 512 MiB unless F1_ARTIFACT_CACHE_BYTES says otherwise
+DEFAULT_ARTIFACT_BYTES = int(os.environ.get('F1_ARTIFACT_CACHE_BYTES', 512 * 1024 ** 2))
+
+# Seconds a request waits for its worker, loading a session from the api can take a while
+REQUEST_TIMEOUT = 600
+
+# Latencies kept for the percentiles in /stats
+LATENCY_SAMPLES = 2000
+
+# Where sessions come from: a module with get_session(year, grand_prix, session)
+SESSION_SOURCE = 'driver_comparisons'
+
+# Bump when an artifact changes without its parameters or the analysis code
+# changing (e.g. new plot styling in a dependency), artifacts in --cache-dir
+# rendered by an older version are then never served again
+ARTIFACT_VERSION = 1
+
+
+def fastest_laps(session, drivers=None):
+    '''fastest_lap_table of a session, optionally for some drivers only'''
+    from driver_comparisons import fastest_lap_table
+
+    table = fastest_lap_table(session.laps)
+    if drivers:
+        table = table.loc[table['Driver'].isin(drivers)]
+    return table
+
+
+def frame_json(frame):
+    '''A dataframe as JSON records, timedeltas as seconds and timestamps as ISO'''
+    import pandas as pd
+
+    frame = pd.DataFrame(frame)
+    if not isinstance(frame.index, pd.RangeIndex):
+        frame = frame.reset_index()
+    for column in frame.columns[frame.dtypes.map(pd.api.types.is_timedelta64_dtype)]:
+        frame[column] = frame[column].dt.total_seconds()
+    return frame.to_json(orient='records', date_format='iso')
+
+
+@functools.lru_cache(maxsize=None)
+def artifact_version():
+    '''What the artifacts of this server depend on besides their parameters:
+    ARTIFACT_VERSION, the session store layout and fastf1 version and the
+    source of the analysis modules'''
+    from session_store import store_version
+
+    code = hashlib.sha256()
+    directory = os.path.dirname(os.path.abspath(__file__))
+    for name in sorted(os.listdir(directory)):
+        if name.endswith('.py'):
+            with open(os.path.join(directory, name), 'rb') as f:
+                code.update(f.read())
+    return f'{ARTIFACT_VERSION}-{store_version()}-{code.hexdigest()[:16]}'
+
+
+def artifact_key(params):
+    '''Hash of everything that decides what an artifact looks like, the
+    version included so the persistent cache never outlives the code'''
+    text = json.dumps(params, sort_keys=True, default=str)
+    return hashlib.sha256(f'{artifact_version()}:{text}'.encode()).hexdigest()
+
+
+def request_params(kind, name, query, source=SESSION_SOURCE):
+    '''Checks and normalises the parameters of a /plot or /data request.
+    Raises KeyError for unknown analyses and ValueError for bad parameters'''
+    known = ANALYSES if kind == 'plot' else TABLES
+    if name not in known:
+        raise KeyError(f"Unknown {kind} '{name}', expected one of {sorted(known)}")
+
+    missing = [field for field in ('year', 'gp', 'session') if not query.get(field)]
+    if missing:
+        raise ValueError(f'Missing parameters {missing}')
+    try:
+        year = int(query['year'])
+        dpi = int(query['dpi']) if query.get('dpi') else None
+    except ValueError:
+        raise ValueError('year and dpi must be numbers')
+
+    image_format = query.get('format', 'png' if kind == 'plot' else 'json').lower()
+    allowed = ('png', 'svg', 'pdf') if kind == 'plot' else ('json',)
+    if image_format not in allowed:
+        raise ValueError(f"format must be one of {allowed}")
+
+    # Same argument parsing as season_batch, e.g. args=VER,LEC,1200,2100
+    args = list(parse_analysis(f"{name}:{query.get('args', '')}")[1:])
+    grand_prix = query['gp']
+    return {
+        'kind': kind, 'name': name, 'year': year,
+        'gp': int(grand_prix) if grand_prix.isdigit() else grand_prix.lower(),
+        'session': query['session'].lower(),
+        'args': args, 'format': image_format, 'dpi': dpi, 'source': source,
+    }
+
+
+def _init_worker():
+    # Workers never open windows
+    import matplotlib
+    matplotlib.use('Agg')
+
+
+def warm_session(source, year, grand_prix, session_name, streams=None):
+    '''Loads a session (and its streams) into the worker's session cache'''
+    import importlib
+
+    session = importlib.import_module(source).get_session(year, grand_prix, session_name)
+    if hasattr(session, 'load_streams'):
+        from session_store import STREAMS
+        session.load_streams(*(streams or STREAMS))
+    return repr(session)
+
+
+def render_artifact(params):
+    '''Runs one analysis on a warm session inside a worker. Returns the bytes
+    of the image or JSON'''
+    import importlib
+    from render import pyplot
+
+    session = importlib.import_module(params['source']).get_session(
+        params['year'], params['gp'], params['session'])
+    args = list(params['args'])
+
+    if params['kind'] == 'data':
+        module_name, function_name = TABLES[params['name']]
+        function = getattr(importlib.import_module(module_name), function_name)
+        table = function(session, drivers=args) if args else function(session)
+        return frame_json(table).encode()
+
+    module_name, function_name = ANALYSES[params['name']]
+    function = getattr(importlib.import_module(module_name), function_name)
+    if params['name'] in DRIVER_LIST_ANALYSES:
+        args = [args]
+    kwargs = {'dpi': params['dpi']} if params['dpi'] else {}
+    try:
+        return function(*args, session, output=params['format'], **kwargs)
+    except Exception:
+        # finish_figure closes its figure, this catches anything left over after an error
+        pyplot().close('all')
+        raise
+
+
+class ArtifactCache:
+    '''LRU cache of rendered artifacts by parameter hash with a memory budget
+    in bytes, optionally backed by a directory that outlives the server'''
+
+    def __init__(self, max_bytes=DEFAULT_ARTIFACT_BYTES, cache_dir=None):
+        self.max_bytes = max_bytes
+        self.cache_dir = cache_dir
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        # key -> bytes, oldest first
+        self._artifacts = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._artifacts)
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key[:2], key)
+
+    def get(self, key):
+        '''The artifact, or None'''
+        with self._lock:
+            data = self._artifacts.get(key)
+            if data is not None:
+                self._artifacts.move_to_end(key)
+                self.hits += 1
+                return data
+
+        if self.cache_dir and os.path.exists(self._path(key)):
+            with open(self._path(key), 'rb') as f:
+                data = f.read()
+            self._remember(key, data)
+            with self._lock:
+                self.hits += 1
+            return data
+
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def put(self, key, data):
+        self._remember(key, data)
+        if self.cache_dir:
+            path = self._path(key)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            # Write next to it and swap, a crash never leaves half a file behind
+            tmp_path = f'{path}.tmp{os.getpid()}.{threading.get_ident()}'
+            with open(tmp_path, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+
+    def _remember(self, key, data):
+        with self._lock:
+            if key in self._artifacts:
+                self._bytes -= len(self._artifacts.pop(key))
+            self._artifacts[key] = data
+            self._bytes += len(data)
+            # The newest artifact is always kept
+            while len(self._artifacts) > 1 and self._bytes > self.max_bytes:
+                _, evicted = self._artifacts.popitem(last=False)
+                self._bytes -= len(evicted)
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._artifacts.clear()
+            self._bytes = 0
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+                'evictions': self.evictions,
+                'artifacts': len(self._artifacts),
+                'bytes': self._bytes,
+                'max_bytes': self.max_bytes,
+            }
+
+
+class WorkerPool:
+    '''Single-threaded render workers. With processes=False there is one
+    render thread in this process instead, matplotlib is then only ever used
+    from that thread. Work for a session always goes to the same worker'''
+
+    def __init__(self, workers=2, processes=True):
+        self.processes = processes
+        self.workers = max(1, workers) if processes else 1
+        self._executors = [self._new_executor() for _ in range(self.workers)]
+        self._lock = threading.Lock()
+
+    def _new_executor(self):
+        if self.processes:
+            return ProcessPoolExecutor(max_workers=1, initializer=_init_worker)
+        return ThreadPoolExecutor(max_workers=1, thread_name_prefix='render')
+
+    def worker_index(self, session_key):
+        digest = hashlib.md5(repr(session_key).encode()).hexdigest()
+        return int(digest, 16) % self.workers
+
+    def submit(self, session_key, function, *args):
+        index = self.worker_index(session_key)
+        with self._lock:
+            executor = self._executors[index]
+        try:
+            return executor.submit(function, *args)
+        except BrokenProcessPool:
+            # The worker died (e.g. out of memory), start a new one. Its sessions are lost
+            with self._lock:
+                if self._executors[index] is executor:
+                    self._executors[index] = self._new_executor()
+                executor = self._executors[index]
+            return executor.submit(function, *args)
+
+    def shutdown(self):
+        for executor in self._executors:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+
+class AnalysisService:
+    '''Artifacts by parameters: from the cache, from a render already in
+    flight, or rendered by the worker that has the session warm'''
+
+    def __init__(self, workers=2, processes=True, source=SESSION_SOURCE,
+                 max_bytes=DEFAULT_ARTIFACT_BYTES, cache_dir=None, timeout=REQUEST_TIMEOUT):
+        self.source = source
+        self.timeout = timeout
+        self.cache = ArtifactCache(max_bytes, cache_dir)
+        # Imports fastf1 once up front rather than in the first request
+        self.version = artifact_version()
+        self.pool = WorkerPool(workers, processes)
+        self.started = time.time()
+        self.shared = 0
+
+        # key -> future of a render in flight
+        self._pending = dict()
+        self._lock = threading.Lock()
+        self._latencies = {'hit': deque(maxlen=LATENCY_SAMPLES), 'miss': deque(maxlen=LATENCY_SAMPLES)}
+
+    @staticmethod
+    def session_key(params):
+        return (params['year'], params['gp'], params['session'])
+
+    def preload(self, year, grand_prix, session_name, streams=None):
+        '''Loads a session in its worker ahead of the first request'''
+        grand_prix = int(grand_prix) if str(grand_prix).isdigit() else str(grand_prix).lower()
+        session_name = str(session_name).lower()
+        return self.pool.submit((int(year), grand_prix, session_name), warm_session,
+                                self.source, int(year), grand_prix, session_name, streams)
+
+    def artifact(self, params):
+        '''Returns (key, bytes, cache hit)'''
+        started = time.perf_counter()
+        key = artifact_key(params)
+        data = self.cache.get(key)
+        if data is not None:
+            self._latencies['hit'].append(time.perf_counter() - started)
+            return key, data, True
+
+        # Identical requests arriving together share one render
+        with self._lock:
+            future = self._pending.get(key)
+            if future is None:
+                future = self.pool.submit(self.session_key(params), render_artifact, params)
+                self._pending[key] = future
+                future.add_done_callback(lambda done, key=key: self._finished(key, done))
+            else:
+                self.shared += 1
+
+        try:
+            data = future.result(timeout=self.timeout)
+        except FutureTimeoutError:
+            raise TimeoutError(f'No result after {self.timeout}s')
+        self._latencies['miss'].append(time.perf_counter() - started)
+        return key, data, False
+
+    def _finished(self, key, future):
+        if not future.cancelled() and future.exception() is None:
+            self.cache.put(key, future.result())
+        with self._lock:
+            self._pending.pop(key, None)
+
+    def stats(self):
+        latency = dict()
+        for outcome, samples in self._latencies.items():
+            ordered = sorted(samples)
+            latency[outcome] = {
+                'count': len(ordered),
+                'p50_ms': 1000 * ordered[len(ordered) // 2] if ordered else None,
+                'p95_ms': 1000 * ordered[int(len(ordered) * 0.95)] if ordered else None,
+            }
+        return {
+            'uptime_seconds': time.time() - self.started,
+            'workers': self.pool.workers,
+            'processes': self.pool.processes,
+            'source': self.source,
+            'artifact_version': self.version,
+            'in_flight': len(self._pending),
+            'shared_renders': self.shared,
+            'cache': self.cache.stats(),
+            'latency': latency,
+        }
+
+    def close(self):
+        self.pool.shutdown()
+
+
+class AnalysisHandler(BaseHTTPRequestHandler):
+    '''GET endpoints of the AnalysisService in self.server.service'''
+
+    server_version = 'F1Analysis/1.0'
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        query = {field: values[-1] for field, values in parse_qs(url.query).items()}
+        parts = [part for part in url.path.split('/') if part]
+        service = self.server.service
+
+        try:
+            if not parts or parts == ['analyses']:
+                self.send_json({'plots': sorted(ANALYSES), 'tables': sorted(TABLES),
+                                'driver_list_plots': list(DRIVER_LIST_ANALYSES)})
+            elif parts == ['health']:
+                self.send_json({'ok': True})
+            elif parts == ['stats']:
+                self.send_json(service.stats())
+            elif len(parts) == 2 and parts[0] in ('plot', 'data'):
+                params = request_params(parts[0], parts[1], query, service.source)
+                with stage('request', analysis=parts[1], format=params['format']) as event:
+                    key, data, hit = service.artifact(params)
+                    event['hit'] = hit
+                self.send_artifact(key, data, params['format'], hit)
+            else:
+                self.send_json({'error': f'Not found: {url.path}'}, status=404)
+        except KeyError as error:
+            self.send_json({'error': error.args[0] if error.args else str(error)}, status=404)
+        except ValueError as error:
+            self.send_json({'error': str(error)}, status=400)
+        except TimeoutError as error:
+            self.send_json({'error': str(error)}, status=504)
+        except Exception as error:
+            self.send_json({'error': f'{type(error).__name__}: {error}',
+                            'traceback': traceback.format_exc()}, status=500)
+
+    def send_artifact(self, key, data, image_format, hit):
+        etag = f'"{key[:32]}"'
+        if self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', CONTENT_TYPES[image_format])
+        self.send_header('Content-Length', str(len(data)))
+        self.send_header('ETag', etag)
+        # Sessions of a live weekend can still change, let clients ask again
+        self.send_header('Cache-Control', 'no-cache')
+        self.send_header('X-Cache', 'hit' if hit else 'miss')
+        self.end_headers()
+        self.wfile.write(data)
+
+    def send_json(self, value, status=200):
+        data = json.dumps(value, default=str).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', CONTENT_TYPES['json'])
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        if not self.server.quiet:
+            super().log_message(format, *args)
+
+
+def make_server(service, host='127.0.0.1', port=8050, quiet=False):
+    '''An HTTP server for the service, call serve_forever() on it'''
+    server = ThreadingHTTPServer((host, port), AnalysisHandler)
+    server.daemon_threads = True
+    server.service = service
+    server.quiet = quiet
+    return server
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Serve the analyses over local HTTP from warm sessions')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8050)
+    parser.add_argument('--workers', type=int, default=2,
+                        help='render processes, 0 renders on one thread in the server process')
+    parser.add_argument('--cache-dir', help='also keep rendered artifacts in this directory')
+    parser.add_argument('--max-mb', type=float, default=DEFAULT_ARTIFACT_BYTES / 2 ** 20,
+                        help='memory for rendered artifacts')
+    parser.add_argument('--preload', nargs='*', default=[],
+                        help='sessions to load at start as year:grand prix:session, e.g. 2022:Monaco:Q')
+    parser.add_argument('--synthetic', action='store_true',
+                        help='serve made-up sessions (synthetic_session) instead of loading them')
+    parser.add_argument('--quiet', action='store_true', help="don't log every request")
+    args = parser.parse_args(argv)
+
+    # A server never shows figures, and the render thread must not start a GUI
+    import matplotlib
+    matplotlib.use('Agg')
+
+    service = AnalysisService(workers=args.workers, processes=args.workers > 0,
+                              source='synthetic_session' if args.synthetic else SESSION_SOURCE,
+                              max_bytes=int(args.max_mb * 2 ** 20), cache_dir=args.cache_dir)
+    for spec in args.preload:
+        year, grand_prix, session_name = spec.split(':')
+        service.preload(year, grand_prix, session_name)
+
+    server = make_server(service, args.host, args.port, quiet=args.quiet)
+    print(f'Serving {len(ANALYSES)} analyses and {len(TABLES)} tables on '
+          f'http://{args.host}:{server.server_port} with {service.pool.workers} worker(s)', flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.close()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,222 @@
+# benchmarks.py
+# Offline benchmark suite on synthetic sessions.
+#
+# Every benchmark runs one analysis on a freshly generated SyntheticSession
+# (so nothing is cached from the run before) and renders it to png. The time
+# spent in finish_figure is reported as rendering, the rest as data
+# preparation. Results go to a JSON file that a later run can be compared
+# against to catch regressions.
+#
+# Example:
+#   python benchmarks.py --drivers 20 --laps 50 --hz 4 --repeat 3 --output bench.json
+#   python benchmarks.py --compare bench.json
+#   python benchmarks.py --imports
+
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import subprocess
+import statistics
+
+import matplotlib
+matplotlib.use('Agg')
+
+import numpy as np
+import pandas as pd
+
+from render import render_timer
+from synthetic_session import SyntheticSession
+
+
+# Name -> (module, function, arguments before the session). 'D1' and 'D2' are
+# replaced by the first two drivers of the session
+BENCHMARKS = {
+    'fastest_laptimes': ('driver_comparisons', 'fastest_laptimes', ()),
+    'double_driver_lap_comparison': ('driver_comparisons', 'double_driver_lap_comparison', ('D1', 'D2')),
+    'driver_speed_change': ('driver_comparisons', 'driver_speed_change', ('D1',)),
+    'driver_gear_changes': ('driver_comparisons', 'driver_gear_changes', ('D1',)),
+    'get_driver_aws_data': ('F1_aws_plot', 'get_driver_aws_data', ('D1', 'D2', 500, 1500)),
+    'static_track_temp': ('static_plot', 'static_track_temp', ()),
+    'static_track_conditions': ('static_plot', 'static_track_conditions', ()),
+    'laptime_vs_track_temp': ('static_plot', 'laptime_vs_track_temp', ()),
+    'race_pace': ('race_pace', 'race_pace', (['D1', 'D2'],)),
+}
+
+# A benchmark counts as regressed when it is this much slower than the baseline
+REGRESSION_FACTOR = 1.25
+
+# Seconds an analysis module may take to import in a fresh interpreter, and the
+# heavy modules none of them may import until a plot or download needs them
+IMPORT_BUDGET = 1.0
+IMPORT_MODULES = ('driver_comparisons', 'F1_aws_plot', 'static_plot', 'race_pace',
+                  'constructor_standings', 'season_batch', 'analysis_server', 'live_session',
+                  'race_replay', 'track_index', 'corners', 'minisectors', 'race_simulator')
+LAZY_MODULES = ('matplotlib.pyplot', 'seaborn', 'requests', 'fastf1.plotting', 'timple')
+
+
+def _resolve(argument, drivers):
+    if isinstance(argument, list):
+        return [_resolve(item, drivers) for item in argument]
+    return {'D1': drivers[0], 'D2': drivers[1]}.get(argument, argument) \
+        if isinstance(argument, str) else argument
+
+
+def run_benchmark(name, session, image_format='png'):
+    '''Runs one benchmark on a session. Returns seconds in total, for
+    rendering and for the rest (data preparation) plus the image size'''
+    import importlib
+
+    module_name, function_name, arguments = BENCHMARKS[name]
+    function = getattr(importlib.import_module(module_name), function_name)
+    drivers = list(session.laps['Driver'].unique())
+    arguments = [_resolve(argument, drivers) for argument in arguments]
+
+    with render_timer() as timer:
+        started = time.perf_counter()
+        image = function(*arguments, session, output=image_format)
+        seconds = time.perf_counter() - started
+
+    return {'seconds': seconds, 'render_seconds': timer['seconds'],
+            'prepare_seconds': seconds - timer['seconds'], 'bytes': len(image)}
+
+
+_IMPORT_PROBE = '''
+import sys, json, time
+started = time.perf_counter()
+import {module}
+seconds = time.perf_counter() - started
+print(json.dumps({{'seconds': seconds, 'loaded': [name for name in {lazy!r} if name in sys.modules]}}))
+'''
+
+
+def import_times(modules=IMPORT_MODULES, budget=IMPORT_BUDGET, lazy=LAZY_MODULES):
+    '''Imports every module in a fresh interpreter. Returns a table with the
+    import time, which of the lazy modules got loaded with it and whether
+    either is over budget'''
+    directory = os.path.dirname(os.path.abspath(__file__))
+    rows = list()
+    for module in modules:
+        probe = _IMPORT_PROBE.format(module=module, lazy=tuple(lazy))
+        result = subprocess.run([sys.executable, '-c', probe], capture_output=True, text=True,
+                                cwd=directory, check=True)
+        measured = json.loads(result.stdout.strip().splitlines()[-1])
+        rows.append({'module': module, 'seconds': measured['seconds'],
+                     'loaded': ', '.join(measured['loaded']),
+                     'violation': measured['seconds'] > budget or bool(measured['loaded'])})
+    return pd.DataFrame(rows)
+
+
+def environment():
+    '''Versions and machine the results were measured with'''
+    import matplotlib
+    import fastf1
+
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except OSError:
+        commit = ''
+
+    return {
+        'commit': commit or None,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'processor': platform.processor() or platform.machine(),
+        'numpy': np.__version__,
+        'pandas': pd.__version__,
+        'matplotlib': matplotlib.__version__,
+        'fastf1': fastf1.__version__,
+    }
+
+
+def run_suite(names=None, drivers=20, laps=50, hz=4, repeat=3, image_format='png', seed=0):
+    '''Runs the benchmarks repeat times each, every run on a new synthetic
+    session of the given size. Returns the machine readable results'''
+    names = list(names or BENCHMARKS)
+    unknown = [name for name in names if name not in BENCHMARKS]
+    if unknown:
+        raise ValueError(f"Unknown benchmarks {unknown}, expected some of {sorted(BENCHMARKS)}")
+
+    runs = list()
+    for name in names:
+        for run in range(repeat):
+            session = SyntheticSession(drivers=drivers, laps=laps, hz=hz, seed=seed)
+            runs.append({'benchmark': name, 'run': run, **run_benchmark(name, session, image_format)})
+
+    summary = dict()
+    for name in names:
+        timings = [run for run in runs if run['benchmark'] == name]
+        summary[name] = {
+            key: statistics.median(run[key] for run in timings)
+            for key in ('seconds', 'prepare_seconds', 'render_seconds', 'bytes')
+        }
+        summary[name]['min_seconds'] = min(run['seconds'] for run in timings)
+
+    return {
+        'created': pd.Timestamp.now(tz='UTC').isoformat(),
+        'environment': environment(),
+        'config': {'drivers': drivers, 'laps': laps, 'hz': hz, 'repeat': repeat,
+                   'format': image_format, 'seed': seed},
+        'summary': summary,
+        'runs': runs,
+    }
+
+
+def compare(results, baseline, factor=REGRESSION_FACTOR):
+    '''Median time of every benchmark against a baseline result. Returns a
+    table with the ratio and whether it regressed'''
+    rows = list()
+    for name, current in results['summary'].items():
+        before = baseline['summary'].get(name)
+        if before is None:
+            continue
+        ratio = current['seconds'] / before['seconds']
+        rows.append({'benchmark': name, 'baseline': before['seconds'], 'current': current['seconds'],
+                     'ratio': ratio, 'regressed': ratio > factor})
+    return pd.DataFrame(rows)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Time the analyses on synthetic sessions')
+    parser.add_argument('benchmarks', nargs='*', help=f'default: all of {", ".join(BENCHMARKS)}')
+    parser.add_argument('--drivers', type=int, default=20)
+    parser.add_argument('--laps', type=int, default=50)
+    parser.add_argument('--hz', type=float, default=4)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--format', default='png', choices=['png', 'svg', 'pdf'])
+    parser.add_argument('--output', help='write the results as JSON to this file')
+    parser.add_argument('--compare', help='JSON results of an earlier run to compare against')
+    parser.add_argument('--factor', type=float, default=REGRESSION_FACTOR,
+                        help='slowdown that counts as a regression')
+    parser.add_argument('--imports', action='store_true',
+                        help=f'only check that every analysis module imports within {IMPORT_BUDGET}s '
+                             'without loading matplotlib, seaborn, requests or fastf1.plotting')
+    args = parser.parse_args(argv)
+
+    if args.imports:
+        table = import_times()
+        print(table.to_string(index=False, float_format=lambda value: f'{value:.3f}'))
+        return 1 if table['violation'].any() else 0
+
+    results = run_suite(args.benchmarks, drivers=args.drivers, laps=args.laps, hz=args.hz,
+                        repeat=args.repeat, image_format=args.format)
+
+    table = pd.DataFrame.from_dict(results['summary'], orient='index')
+    print(table.to_string(float_format=lambda value: f'{value:.3f}'))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=1)
+
+    if args.compare:
+        with open(args.compare) as f:
+            comparison = compare(results, json.load(f), args.factor)
+        print(comparison.to_string(index=False, float_format=lambda value: f'{value:.3f}'))
+        return 1 if comparison['regressed'].any() else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,244 @@
+# compact_frames.py
+# Smaller dtypes for the laps, telemetry and weather frames of a session.
+#
+# fastf1 hands car and position data back as float64, int64 and Python string
+# objects, millions of rows per race. After loading, the channels are narrowed
+# to what they actually hold: float32 for positions, speed and rpm, int8/uint8
+# for gear, throttle, brake and DRS, and categoricals for the repeated strings
+# (driver, team, compound, source, status). Columns are only narrowed when the
+# values fit, so nothing is clipped. Timedeltas already are int64 nanoseconds
+# (timedelta64[ns]), object columns holding timedeltas are converted to that.
+#
+# LazySession compacts every stream it loads (set F1_COMPACT=0 to keep the
+# original dtypes), so the session store and the session cache hold the
+# compact frames. memory_report and verify_compaction show what it saves and
+# that the analyses still agree.
+#
+# Example:
+#   python compact_frames.py 2022 Monaco R
+
+import os
+import sys
+import copy
+
+import numpy as np
+import pandas as pd
+
+from session_store import STREAMS, _set_session_data
+
+
+# Compact every stream LazySession loads, F1_COMPACT=0 turns it off
+COMPACT = os.environ.get('F1_COMPACT', '1') not in ('', '0')
+
+# Channels where float32 (7 significant digits) is far below the sensor
+# resolution: positions in 1/10 m, speed in km/h, rpm
+FLOAT32_COLUMNS = ('X', 'Y', 'Z', 'Speed', 'RPM')
+
+# Small integer channels and the narrowest type they fit in
+INTEGER_COLUMNS = {
+    'nGear': np.int8,
+    'Throttle': np.uint8,
+    'Brake': np.uint8,
+    'DRS': np.uint8,
+}
+
+# Strings repeated on every row
+CATEGORY_COLUMNS = ('Driver', 'DriverNumber', 'Team', 'Compound', 'TrackStatus',
+                    'CurrentAction', 'Source', 'Status')
+
+# Values fastf1 writes into these columns later that have to be categories
+# from the start. Car and position data are merged column by column, which
+# needs the same categories on both sides
+EXTRA_CATEGORIES = {'Source': ('car', 'pos', 'interpolation')}
+
+
+def _fits(values, dtype):
+    '''All values are whole numbers (no missing ones) within the range of dtype'''
+    if values.dtype == bool or not pd.api.types.is_numeric_dtype(values.dtype):
+        return False
+    array = values.to_numpy()
+    if len(array) == 0:
+        return True
+    if array.dtype.kind == 'f' and (np.isnan(array).any() or np.any(array != np.round(array))):
+        return False
+    info = np.iinfo(dtype)
+    return bool(array.min() >= info.min and array.max() <= info.max)
+
+
+def compact_dtypes(frame):
+    '''The dtype every column of frame can be narrowed to without losing
+    anything, as {column: dtype}. Columns that are fine as they are are left out'''
+    dtypes = dict()
+    for column in frame.columns:
+        values = frame[column]
+        if column in FLOAT32_COLUMNS and values.dtype == np.float64:
+            dtypes[column] = np.float32
+        elif column in INTEGER_COLUMNS and values.dtype != INTEGER_COLUMNS[column]:
+            if _fits(values, INTEGER_COLUMNS[column]):
+                dtypes[column] = INTEGER_COLUMNS[column]
+        elif column in CATEGORY_COLUMNS and values.dtype == object:
+            categories = set(values.dropna().unique()) | set(EXTRA_CATEGORIES.get(column, ()))
+            dtypes[column] = pd.CategoricalDtype(sorted(categories, key=str))
+        elif values.dtype == object and len(values) \
+                and pd.api.types.infer_dtype(values, skipna=True) == 'timedelta':
+            dtypes[column] = 'timedelta64[ns]'
+    return dtypes
+
+
+def compact_frame(frame):
+    '''frame with compact dtypes. Keeps the class (Laps, Telemetry) and its
+    session and driver; returns frame itself when there is nothing to do'''
+    dtypes = compact_dtypes(frame)
+    if not dtypes:
+        return frame
+    return frame.astype(dtypes)
+
+
+def frame_nbytes(frame):
+    return int(pd.DataFrame(frame).memory_usage(deep=True).sum())
+
+
+def _stream_frames(session, stream):
+    '''(name, frame) of every frame that makes up a loaded stream'''
+    if stream == 'laps':
+        return [('laps', session.laps), ('results', session.results)]
+    if stream in ('car_data', 'pos_data'):
+        return [(str(drv), telemetry) for drv, telemetry in getattr(session, stream).items()]
+    if stream == 'weather':
+        return [('weather', session.weather_data)]
+    raise ValueError(f"Unknown stream '{stream}', expected one of {STREAMS}")
+
+
+def compact_stream(session, stream):
+    '''Replaces the frames of a loaded stream of a (plain, not lazy) session
+    by their compact versions. Returns (bytes before, bytes after, rows)'''
+    frames = _stream_frames(session, stream)
+    compacted = [(name, compact_frame(frame)) for name, frame in frames]
+
+    if stream == 'laps':
+        _set_session_data(session, 'laps', compacted[0][1])
+        _set_session_data(session, 'results', compacted[1][1])
+    elif stream == 'weather':
+        _set_session_data(session, 'weather_data', compacted[0][1])
+    else:
+        _set_session_data(session, stream, dict(compacted))
+
+    before = sum(frame_nbytes(frame) for _, frame in frames)
+    after = sum(frame_nbytes(frame) for _, frame in compacted)
+    rows = sum(len(frame) for _, frame in frames)
+    return before, after, rows
+
+
+def compact_session(session, streams=STREAMS):
+    '''Compacts the given streams of a session in place. Returns the memory
+    report: rows, bytes before and after and the ratio per stream'''
+    session = getattr(session, 'session', session)
+    rows = list()
+    for stream in streams:
+        before, after, n_rows = compact_stream(session, stream)
+        rows.append({'stream': stream, 'rows': n_rows, 'bytes_before': before, 'bytes_after': after})
+
+    report = pd.DataFrame(rows)
+    total = report[['rows', 'bytes_before', 'bytes_after']].sum()
+    report = pd.concat([report, pd.DataFrame([{'stream': 'total', **total}])], ignore_index=True)
+    report['ratio'] = report['bytes_after'] / report['bytes_before']
+    return report
+
+
+def memory_report(session, streams=STREAMS):
+    '''Memory held by the given streams now, and what compacting would leave
+    of it, without changing the session'''
+    return compact_session(_compacted_copy(session, ()), streams)
+
+
+def _compacted_copy(session, streams=STREAMS):
+    '''A shallow copy of a (plain) session whose frames can be swapped
+    without touching the original. The given streams are compacted'''
+    session = getattr(session, 'session', session)
+    clone = copy.copy(session)
+    for stream in STREAMS:
+        frames = _stream_frames(session, stream)
+        if stream in streams:
+            frames = [(name, compact_frame(frame)) for name, frame in frames]
+        # The frames refer back to their session, point the copies at the clone
+        frames = [(name, _rebind(frame, clone)) for name, frame in frames]
+        if stream == 'laps':
+            _set_session_data(clone, 'laps', frames[0][1])
+            _set_session_data(clone, 'results', frames[1][1])
+        elif stream == 'weather':
+            _set_session_data(clone, 'weather_data', frames[0][1])
+        else:
+            _set_session_data(clone, stream, dict(frames))
+    return clone
+
+
+def _rebind(frame, session):
+    if hasattr(frame, 'session'):
+        frame = frame.copy(deep=False)
+        frame.session = session
+    return frame
+
+
+def _max_difference(expected, actual):
+    expected = pd.DataFrame(expected).reset_index(drop=True)
+    actual = pd.DataFrame(actual).reset_index(drop=True)
+    if expected.shape != actual.shape or list(expected.columns) != list(actual.columns):
+        return np.inf
+
+    difference = 0.0
+    for column in expected.columns:
+        left, right = expected[column], actual[column]
+        if pd.api.types.is_timedelta64_dtype(left):
+            left, right = left.dt.total_seconds(), pd.to_timedelta(right).dt.total_seconds()
+        if pd.api.types.is_numeric_dtype(left) and pd.api.types.is_numeric_dtype(right) \
+                and left.dtype != bool:
+            left, right = left.to_numpy(dtype=float), right.to_numpy(dtype=float)
+            both = ~(np.isnan(left) & np.isnan(right))
+            if np.isnan(left[both]).any() or np.isnan(right[both]).any():
+                return np.inf
+            if both.any():
+                difference = max(difference, float(np.max(np.abs(left[both] - right[both]))))
+        elif not left.astype(object).equals(right.astype(object)):
+            return np.inf
+    return difference
+
+
+def verify_compaction(session, drivers=None, tolerance=1e-3):
+    '''Runs the table analyses on the session as it is and on a compacted
+    copy and compares them. Returns the largest difference per analysis and
+    whether it is within tolerance (seconds, metres, km/h)'''
+    from driver_comparisons import fastest_lap_table, pairwise_lap_deltas
+    from race_pace import race_pace_table
+    from F1_aws_plot import race_action_spans
+    from static_plot import attach_weather
+
+    original = _compacted_copy(session, ())
+    compacted = _compacted_copy(session)
+    if drivers is None:
+        drivers = list(fastest_lap_table(original.laps)['Driver'][:3])
+
+    checks = {
+        'fastest_lap_table': lambda s: fastest_lap_table(s.laps).drop(columns='TeamColor'),
+        'pairwise_lap_deltas': lambda s: pairwise_lap_deltas(s, drivers),
+        'race_pace_table': lambda s: race_pace_table(s, drivers),
+        'race_action_spans': lambda s: race_action_spans(s, drivers[:1]),
+        'attach_weather': lambda s: attach_weather(s.laps, s.weather_data)[['LapTime', 'TrackTemp', 'AirTemp']],
+    }
+    rows = list()
+    for name, check in checks.items():
+        difference = _max_difference(check(original), check(compacted))
+        rows.append({'analysis': name, 'max_difference': difference, 'ok': difference <= tolerance})
+    return pd.DataFrame(rows)
+
+
+if __name__ == '__main__':
+    from driver_comparisons import get_session
+
+    # python compact_frames.py 2022 Monaco R
+    year, grand_prix, session_name = sys.argv[1:4]
+    session = get_session(int(year), grand_prix, session_name)
+    # Load the original dtypes to compare against
+    session.compact = False
+    session.load_streams(*STREAMS)
+    print(memory_report(session).to_string(index=False))
+    print(verify_compaction(session).to_string(index=False))
@@ -1,76 +1,266 @@
+import os
+import json
+import warnings
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
 import pandas as pd
 import numpy as np
-import random
-import requests
 
-# Don't forget to 'pip install fastf1'
-import fastf1 as ff1
-from fastf1 import plotting
+from render import finish_figure, pyplot
+from session_store import CACHE_DIR
+from instrumentation import instrumented, stage
+
+
+# Base url of the Ergast api. Point ERGAST_URL at a local server (e.g.
+# "python -m http.server" in a directory of recorded <endpoint>.json files)
+# to run without the real api
+ERGAST_URL = os.environ.get('ERGAST_URL', 'https://ergast.com/api/f1')
+
+# Seconds to wait for a response, and how often to retry failed requests
+TIMEOUT = 10
+RETRIES = 3
+
+# Standings after a finished round never change, so every response is kept on
+# disk as <season>/<round>/driverStandings.json (the same layout ERGAST_URL
+# can serve). Set F1_OFFLINE=1 to only ever read from there
+ERGAST_CACHE_DIR = os.environ.get('F1_ERGAST_CACHE', os.path.join(CACHE_DIR, 'ergast'))
+OFFLINE = os.environ.get('F1_OFFLINE', '') not in ('', '0')
+
 
-# Don't forget to 'pip install seaborn'
-import seaborn as sns
-import matplotlib.pyplot as plt
+def http_session(retries=RETRIES, backoff=0.5, pool_size=16):
+    '''A keep-alive requests session that retries failed GETs with exponential
+    backoff and keeps up to pool_size connections open for concurrent use'''
+    # Don't forget to 'pip install requests', only needed when we go online
+    import requests
+    from requests.adapters import HTTPAdapter
+    from urllib3.util.retry import Retry
 
+    retry = Retry(total=retries, backoff_factor=backoff,
+                  status_forcelist=(429, 500, 502, 503, 504), allowed_methods=frozenset(['GET']))
+    adapter = HTTPAdapter(max_retries=retry, pool_connections=pool_size, pool_maxsize=pool_size)
 
-def ergast_retrieve(api_endpoint: str):
+    http = requests.Session()
+    http.mount('http://', adapter)
+    http.mount('https://', adapter)
+    return http
+
+
+def ergast_retrieve(api_endpoint: str, http=None, base_url=None, timeout=TIMEOUT):
     '''we created a method called ergast_retrieve(). Ergast has many different endpoints
      (e.g. for championship standings, race results, qualifying results, et cetera)'''
 
-    url = f'https://ergast.com/api/f1/{api_endpoint}.json'
-    response = requests.get(url).json()
+    import requests
+
+    url = f'{base_url or ERGAST_URL}/{api_endpoint}.json'
+    response = (http or requests).get(url, timeout=timeout)
+    response.raise_for_status()
     
-    return response['MRData']
+    return response.json()['MRData']
 
 
-def get_constructor_rankings():
-    # Specify the number of rounds we want in our plot (in other words, specify the current round)
-    rounds = int(input("Specify Round"))
+def fetch_driver_standings(rounds, season='current', http=None, base_url=None, max_workers=8, errors=None):
+    '''Retrieves the driver standings after each of the given rounds
+    concurrently over one pooled session. Returns {round: MRData}. With an
+    errors dict, rounds that fail end up in there as {round: exception} and the
+    others are still returned, otherwise the first failure is raised'''
+    rounds = list(rounds)
+    own_session = http is None
+    http = http or http_session(pool_size=max_workers)
 
-    # Initiate an empty dataframe to store our data
-    all_championship_standings = pd.DataFrame()
+    responses = dict()
+    try:
+        with stage('ergast.fetch', season=season, rows=len(rounds)), \
+                ThreadPoolExecutor(max_workers=max_workers) as pool:
+            futures = {pool.submit(ergast_retrieve, f'{season}/{round_number}/driverStandings',
+                                   http=http, base_url=base_url): round_number
+                       for round_number in rounds}
+            for future in as_completed(futures):
+                try:
+                    responses[futures[future]] = future.result()
+                except (OSError, ValueError) as error:
+                    if errors is None:
+                        raise
+                    errors[futures[future]] = error
+        return responses
+    finally:
+        if own_session:
+            http.close()
 
+
+def standings_table(responses):
+    '''Builds the table of championship positions (rounds x drivers) in one go
+    from {round: MRData}, plus the driver -> team mapping used for colors'''
+    records = list()
     # We also want to store which driver drives for which team, which will help us later
     driver_team_mapping = {}
 
-    # Initate a loop through all the rounds
-    for i in range(1, rounds + 1):
-        # Make request to driverStandings endpoint for the current round
-        race = ergast_retrieve(f'current/{i}/driverStandings')
-        
+    for round_number in sorted(responses):
         # Get the standings from the result
-        standings = race['StandingsTable']['StandingsLists'][0]['DriverStandings']
-        
-        # Initiate a dictionary to store the current rounds' standings in
-        current_round = {'round': i}
-        
-        # Loop through all the drivers to collect their information
-        for i in range(len(standings)):
-            driver = standings[i]['Driver']['code']
-            position = standings[i]['position']
-            
-            # Store the drivers' position
-            current_round[driver] = int(position)
-            
+        standings = responses[round_number]['StandingsTable']['StandingsLists'][0]['DriverStandings']
+
+        # Store the drivers' position for the current round
+        current_round = {'round': round_number}
+        for standing in standings:
+            driver = standing['Driver']['code']
+            current_round[driver] = int(standing['position'])
+
             # Create mapping for driver-team to be used for the coloring of the lines
-            driver_team_mapping[driver] = standings[i]['Constructors'][0]['name']
+            driver_team_mapping[driver] = standing['Constructors'][0]['name']
+        records.append(current_round)
+
+    return pd.DataFrame.from_records(records), driver_team_mapping
+
+
+def _cache_path(season, round_number, cache_dir=None):
+    return os.path.join(cache_dir or ERGAST_CACHE_DIR, str(season), str(round_number), 'driverStandings.json')
+
+
+def _has_standings(response):
+    return bool(response['StandingsTable']['StandingsLists'])
+
+
+def read_cached_standings(season, round_number, cache_dir=None):
+    '''The cached MRData of the standings after a round, or None'''
+    path = _cache_path(season, round_number, cache_dir)
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
 
+def write_cached_standings(season, round_number, response, cache_dir=None):
+    '''Stores the standings after a round. Rounds without standings (not raced
+    yet) are not cached, so they are asked for again next time'''
+    if not _has_standings(response):
+        return
+    path = _cache_path(season, round_number, cache_dir)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    # Write next to it and swap, a crash never leaves half a file behind
+    tmp_path = f'{path}.tmp{os.getpid()}'
+    with open(tmp_path, 'w') as f:
+        json.dump(response, f)
+    os.replace(tmp_path, path)
+
+
+def cached_rounds(season, cache_dir=None):
+    '''Round numbers of a season that are in the cache'''
+    season_dir = os.path.join(cache_dir or ERGAST_CACHE_DIR, str(season))
+    if not os.path.isdir(season_dir):
+        return []
+    return sorted(int(name) for name in os.listdir(season_dir)
+                  if name.isdigit() and os.path.exists(_cache_path(season, name, cache_dir)))
+
+
+def cached_seasons(cache_dir=None):
+    cache_dir = cache_dir or ERGAST_CACHE_DIR
+    if not os.path.isdir(cache_dir):
+        return []
+    return sorted(int(name) for name in os.listdir(cache_dir) if name.isdigit())
+
+
+def latest_standings(season='current', http=None, base_url=None):
+    '''Season, round and MRData of the latest standings in one request'''
+    response = ergast_retrieve(f'{season}/driverStandings', http=http, base_url=base_url)
+    table = response['StandingsTable']
+    return int(table['season']), int(table['round']), response
+
+
+@instrumented()
+def driver_standings(season='current', rounds=None, offline=None, cache_dir=None, http=None, base_url=None):
+    '''Championship positions per round (rounds x drivers) and the driver -> team
+    mapping, without asking anything.
+
+    rounds defaults to every round up to the latest one. Cached rounds are
+    never downloaded again, so a run after a new race costs one request for the
+    latest standings (which is that round). With offline (default: F1_OFFLINE)
+    or when the api can't be reached, everything comes from the cache.'''
+    offline = OFFLINE if offline is None else offline
+    responses = dict()
+
+    if season == 'current' or rounds is None:
+        latest = None
+        if not offline:
+            try:
+                latest = latest_standings(season, http=http, base_url=base_url)
+            except OSError as error:
+                warnings.warn(f'Ergast api not reachable, using cached standings only ({error})')
+                offline = True
+
+        if latest is not None:
+            season, latest_round, response = latest
+            write_cached_standings(season, latest_round, response, cache_dir)
+            responses[latest_round] = response
+        else:
+            if season == 'current':
+                seasons = cached_seasons(cache_dir)
+                if not seasons:
+                    raise FileNotFoundError(f'No cached standings in {cache_dir or ERGAST_CACHE_DIR}')
+                season = seasons[-1]
+            latest_round = max(cached_rounds(season, cache_dir), default=0)
+
+        if rounds is None:
+            rounds = range(1, latest_round + 1)
+
+    rounds = list(rounds)
+    for round_number in rounds:
+        if round_number not in responses:
+            cached = read_cached_standings(season, round_number, cache_dir)
+            if cached is not None:
+                responses[round_number] = cached
+
+    missing = [round_number for round_number in rounds if round_number not in responses]
+    if missing and offline:
+        raise FileNotFoundError(f'Standings of {season} rounds {missing} are not cached')
+    if missing:
+        # Rounds that did download are cached even when others failed, the
+        # next run only asks for the failed ones again
+        errors = dict()
+        fetched = fetch_driver_standings(missing, season=season, http=http, base_url=base_url, errors=errors)
+        for round_number, response in fetched.items():
+            write_cached_standings(season, round_number, response, cache_dir)
+        responses.update(fetched)
+        if errors:
+            failed = sorted(errors)
+            raise ConnectionError(f'Standings of {season} rounds {failed} could not be downloaded '
+                                  f'({errors[failed[0]]})') from errors[failed[0]]
+
+    responses = {round_number: responses[round_number] for round_number in rounds
+                 if _has_standings(responses[round_number])}
+    table, driver_team_mapping = standings_table(responses)
+    return season, table, driver_team_mapping
+
+
+@instrumented()
+def get_constructor_rankings(rounds=None, season='current', offline=None, output=None, dpi=None):
+    '''Plots the championship position of every driver per round, up to the
+    latest round unless rounds (a number or list of rounds) is given. See
+    driver_standings for caching and offline use and render.finish_figure
+    for output'''
+    # Don't forget to 'pip install seaborn' and 'pip install fastf1'
+    import seaborn as sns
+    from fastf1 import plotting as ff1_plotting
+
+    plt = pyplot()
+    if isinstance(rounds, int):
+        rounds = range(1, rounds + 1)
+
+    season, all_championship_standings, driver_team_mapping = driver_standings(
+        season, rounds, offline=offline)
+    rounds = int(all_championship_standings['round'].max())
 
-        # Append the current round to our fial dataframe
-        all_championship_standings = all_championship_standings.append(current_round, ignore_index=True)
-        
     # Set the round as the index of the dataframe
     all_championship_standings = all_championship_standings.set_index('round')
     # Melt data so it can be used as input for plot
     all_championship_standings_melted = pd.melt(all_championship_standings.reset_index(), ['round'])
 
-    # Increase the size of the plot 
-    sns.set(rc={'figure.figsize':(11.7,8.27)})
-
-    # Initiate the plot
-    fig, ax = plt.subplots()
+    # Initiate a bigger plot in seaborn's style, only for this figure instead of
+    # sns.set changing every plot made afterwards
+    with sns.axes_style('darkgrid'):
+        fig, ax = plt.subplots(figsize=(11.7, 8.27))
 
     # Set the title of the plot
-    ax.set_title("2022 Championship Standings until round {rounds}")
+    ax.set_title(f"{season} Championship Standings until round {rounds}")
 
     # Draw a line for every driver in the data by looping through all the standings
     # The reason we do it this way is so that we can specify the team color per driver
@@ -79,14 +269,15 @@ def get_constructor_rankings():
             x='round', 
             y='value', 
             data=all_championship_standings_melted.loc[all_championship_standings_melted['variable']==driver], 
-            color = ff1.plotting.team_color(driver_team_mapping[driver])
+            color = ff1_plotting.team_color(driver_team_mapping[driver]),
+            ax=ax
         )
 
     # Invert Y-axis to have championship leader (#1) on top
     ax.invert_yaxis()
 
     # Set the values that appear on the x- and y-axes
-    ax.set_xticks(range(1, rounds))
+    ax.set_xticks(range(1, rounds + 1))
     ax.set_yticks(range(1, 22))
 
     # Set the labels of the axes
@@ -114,5 +305,5 @@ def get_constructor_rankings():
             textcoords="offset points"
         )
 
-    # Save the plot
-    plt.show()
\ No newline at end of file
+    # Show or save the plot
+    return finish_figure(fig, output, dpi)
@@ -0,0 +1,298 @@
+# corners.py
+# Corners and braking zones found in the telemetry instead of typed in.
+#
+# The fastest clean laps of a session are resampled onto one distance grid and
+# their median speed, brake and throttle traces give a reference lap. Corners
+# are the speed minima of that lap (scipy.signal.find_peaks with a minimum
+# speed drop), with the speed maximum before each one as entry, the first
+# braking before the apex, the throttle pickup after it and the return to full
+# throttle as exit. The corner table is kept per circuit (in memory and on
+# disk as <cache>/corners/<year>/<circuit>.csv), so it is only detected once.
+#
+# corner_stats then measures every corner on every lap of every driver. Like
+# the mini-sectors, the distance of each driver is integrated once over the
+# whole session and all their laps are resampled from it in one go instead of
+# pulling the car data lap by lap. corner_comparison plots the drivers through
+# a corner by number instead of guessed distances.
+#
+# Example:
+#   python corners.py 2022 Monaco R
+#   python corners.py 2022 Monaco R --stats VER LEC
+
+import os
+import sys
+import argparse
+
+import numpy as np
+import pandas as pd
+
+from lazy_session import needs_streams
+from session_store import CACHE_DIR, slug
+from instrumentation import instrumented, stage
+from minisectors import EDGE_TOLERANCE, driver_distance, lap_windows
+from telemetry_alignment import CHANNELS, channel_index, resample
+
+
+# Corner tables of circuits seen before, set F1_CORNER_CACHE to keep them elsewhere
+CORNER_CACHE_DIR = os.environ.get('F1_CORNER_CACHE', os.path.join(CACHE_DIR, 'corners'))
+
+# Meters between points of the distance grid corners are found and measured on
+CORNER_STEP = 5.0
+
+# How many of the fastest clean laps make up the reference lap
+REFERENCE_LAPS = 10
+
+# A speed minimum is a corner when the car loses at least this much (km/h)
+# on the way in, and apexes are at least this many meters apart
+MIN_SPEED_DROP = 15.0
+MIN_CORNER_GAP = 50.0
+
+# Share of the reference laps that have to be on the brake for a braking zone,
+# throttle (%) the driver has to add after the apex for the pickup, and the
+# throttle (%) that counts as flat out again at the exit
+BRAKE_SHARE = 0.5
+THROTTLE_PICKUP = 10.0
+FULL_THROTTLE = 99.0
+
+CORNER_COLUMNS = ['Corner', 'Entry', 'BrakeStart', 'Apex', 'ThrottleOn', 'Exit', 'ApexSpeed']
+
+# (year, circuit) -> corner table
+_CORNERS = dict()
+
+
+def reference_laps(laps, n_laps=REFERENCE_LAPS):
+    '''The n_laps fastest timed laps, only accurate ones where fastf1 says which'''
+    laps = laps.loc[laps['LapTime'].notna()]
+    if 'IsAccurate' in laps.columns and laps['IsAccurate'].any():
+        laps = laps.loc[laps['IsAccurate'] == True]
+    return laps.sort_values('LapTime').head(n_laps)
+
+
+def reference_traces(telemetry):
+    '''Median speed, share of laps braking and median throttle along the grid
+    of an aligned telemetry array (laps x grid x channels)'''
+    return (np.median(telemetry[..., channel_index('Speed')], axis=0),
+            np.mean(telemetry[..., channel_index('Brake')] > 0, axis=0),
+            np.median(telemetry[..., channel_index('Throttle')], axis=0))
+
+
+def detect_corners(grid, speed, brake, throttle, min_drop=MIN_SPEED_DROP, min_gap=MIN_CORNER_GAP):
+    '''Corner table from reference traces along the distance grid: one row per
+    speed minimum with its entry, braking start (NaN for lifts and flat
+    corners), apex, throttle pickup and exit distance and the apex speed'''
+    from scipy.signal import find_peaks
+
+    step = grid[1] - grid[0]
+    spacing = max(int(min_gap / step), 1)
+    apexes, _ = find_peaks(-speed, prominence=min_drop, distance=spacing)
+    maxima, _ = find_peaks(speed, distance=spacing)
+    if len(apexes) == 0:
+        return pd.DataFrame(columns=CORNER_COLUMNS)
+
+    # Entry is the last speed maximum before the apex, the exit is at the latest
+    # the next one (a chicane never gets back to full throttle in between)
+    before = np.searchsorted(maxima, apexes) - 1
+    entries = np.where(before >= 0, maxima[np.maximum(before, 0)], 0)
+    entries = np.maximum(entries, np.concatenate([[0], apexes[:-1]]))
+    next_entries = np.append(entries[1:], len(grid) - 1)
+
+    braking = brake >= BRAKE_SHARE
+    full = throttle >= FULL_THROTTLE
+    rows = list()
+    for i, (entry, apex, limit) in enumerate(zip(entries, apexes, next_entries)):
+        brake_zone = np.flatnonzero(braking[entry:apex + 1])
+        brake_start = grid[entry + brake_zone[0]] if len(brake_zone) else np.nan
+
+        # Throttle pickup: the driver adds throttle again after the lowest point around the apex
+        window = slice(entry, max(limit, apex + 1))
+        lowest = entry + int(np.argmin(throttle[window]))
+        pickup = np.flatnonzero(throttle[lowest:limit + 1] >= throttle[lowest] + THROTTLE_PICKUP)
+        throttle_on = lowest + pickup[0] if len(pickup) else apex
+
+        flat_out = np.flatnonzero(full[max(throttle_on, apex):limit + 1])
+        exit_index = max(throttle_on, apex) + flat_out[0] if len(flat_out) else limit
+        rows.append({'Corner': i + 1, 'Entry': grid[entry], 'BrakeStart': brake_start, 'Apex': grid[apex],
+                     'ThrottleOn': grid[throttle_on], 'Exit': grid[exit_index], 'ApexSpeed': speed[apex]})
+    return pd.DataFrame(rows, columns=CORNER_COLUMNS)
+
+
+def _cache_path(key, cache_dir=None):
+    year, circuit = key
+    return os.path.join(cache_dir or CORNER_CACHE_DIR, str(year), f'{slug(circuit)}.csv')
+
+
+@instrumented()
+@needs_streams('laps', 'car_data')
+def circuit_corners(session, refresh=False, cache_dir=None, step=CORNER_STEP):
+    '''The corner table of the session's circuit (see detect_corners), detected
+    from this session the first time the circuit is asked for and cached
+    afterwards. refresh detects it again'''
+    from track_index import circuit_key
+
+    key = circuit_key(session)
+    path = _cache_path(key, cache_dir)
+    if not refresh and key in _CORNERS:
+        return _CORNERS[key]
+    if not refresh and os.path.exists(path):
+        _CORNERS[key] = pd.read_csv(path)
+        return _CORNERS[key]
+
+    laps = pd.DataFrame(reference_laps(session.laps))
+    with stage('corners.detect', circuit=key[1], laps=len(laps)):
+        # Up to the shortest of the reference laps, so every point has all of them
+        grid = np.arange(0, np.nanmin(lap_lengths(session, laps)), step)
+        telemetry = np.full((len(laps), len(grid), len(CHANNELS)), np.nan)
+        for number, rows in laps.groupby('DriverNumber', observed=True).indices.items():
+            telemetry[rows] = driver_lap_telemetry(session.car_data[str(number)],
+                                                   *lap_windows(laps.iloc[rows]), grid)
+        corners = detect_corners(grid, *reference_traces(telemetry))
+
+    # Write next to it and swap, a crash never leaves half a file behind
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f'{path}.tmp{os.getpid()}'
+    corners.to_csv(tmp_path, index=False)
+    os.replace(tmp_path, path)
+    _CORNERS[key] = corners
+    return corners
+
+
+def corner(corners, number):
+    '''Row of the corner table by number, "T4" works as well as 4'''
+    number = int(str(number).upper().lstrip('T'))
+    rows = corners.loc[corners['Corner'] == number]
+    if rows.empty:
+        raise KeyError(f'No corner {number}, the circuit has corners 1 to {len(corners)}')
+    return rows.iloc[0]
+
+
+def aligned_corner_stats(grid, telemetry, corners):
+    '''Every corner of every lap of an aligned telemetry array (laps x grid x
+    channels), as arrays of laps x corners: entry, apex (minimum) and exit speed,
+    where the minimum is, where braking starts and the seconds from entry to exit'''
+    speed = telemetry[..., channel_index('Speed')]
+    braking = telemetry[..., channel_index('Brake')] > 0
+    seconds = telemetry[..., channel_index('Time')]
+
+    def index(distance):
+        return np.clip(np.searchsorted(grid, distance.to_numpy(dtype=float)), 0, len(grid) - 1)
+
+    entries, apexes, exits = index(corners['Entry']), index(corners['Apex']), index(corners['Exit'])
+    shape = (len(telemetry), len(corners))
+    stats = {name: np.full(shape, np.nan) for name in
+             ('EntrySpeed', 'MinSpeed', 'MinSpeedAt', 'ExitSpeed', 'BrakePoint', 'CornerTime')}
+
+    stats['EntrySpeed'][:] = speed[:, entries]
+    stats['ExitSpeed'][:] = speed[:, exits]
+    stats['CornerTime'][:] = seconds[:, exits] - seconds[:, entries]
+    for j, (entry, apex, exit_index) in enumerate(zip(entries, apexes, exits)):
+        window = speed[:, entry:exit_index + 1]
+        lowest = np.argmin(window, axis=1)
+        stats['MinSpeed'][:, j] = window[np.arange(len(window)), lowest]
+        stats['MinSpeedAt'][:, j] = grid[entry + lowest]
+
+        zone = braking[:, entry:apex + 1]
+        brakes = zone.any(axis=1)
+        stats['BrakePoint'][brakes, j] = grid[entry + np.argmax(zone[brakes], axis=1)]
+
+    # Laps that end before the exit of a corner (NaN from there on) have no stats for it
+    missing = np.isnan(speed[:, exits])
+    for values in stats.values():
+        values[missing] = np.nan
+    return stats
+
+
+def lap_lengths(session, laps):
+    '''Meters driven on every lap, from each driver's distance over the whole
+    session. NaN for drivers without car data'''
+    lengths = np.full(len(laps), np.nan)
+    for number, rows in laps.groupby('DriverNumber', observed=True).indices.items():
+        telemetry = session.car_data.get(str(number))
+        if telemetry is None or len(telemetry) < 2:
+            continue
+        seconds, distance = driver_distance(telemetry)
+        start, end = lap_windows(laps.iloc[rows])
+        lengths[rows] = np.interp(end, seconds, distance) - np.interp(start, seconds, distance)
+    return lengths
+
+
+def driver_lap_telemetry(telemetry, start, end, grid):
+    '''All laps of one driver (start and end in session seconds) resampled
+    onto the distance grid from each lap's start, as an array of laps x grid x
+    CHANNELS with Time in session seconds. Grid points past the end of a lap
+    and laps the car data doesn't cover are NaN'''
+    telemetry = pd.DataFrame(telemetry)
+    seconds, distance = driver_distance(telemetry)
+    order = np.argsort(telemetry['SessionTime'].dt.total_seconds().to_numpy(), kind='stable')
+    values = np.column_stack([seconds if channel == 'Time' else telemetry[channel].to_numpy(dtype=float)[order]
+                              for channel in CHANNELS])
+
+    start_distance = np.interp(start, seconds, distance)
+    length = np.interp(end, seconds, distance) - start_distance
+    points = start_distance[:, None] + grid[None, :]
+    cube = resample(distance, values, points.ravel()).reshape(len(start), len(grid), len(CHANNELS))
+
+    covered = (start >= seconds[0] - EDGE_TOLERANCE) & (end <= seconds[-1] + EDGE_TOLERANCE)
+    cube[grid[None, :] > length[:, None]] = np.nan
+    cube[~covered] = np.nan
+    return cube
+
+
+@instrumented()
+@needs_streams('laps', 'car_data')
+def corner_stats(session, drivers=None, step=CORNER_STEP):
+    '''Entry, minimum and exit speed, braking point and time through every
+    corner on every timed lap of the given drivers (all by default), one row
+    per lap and corner'''
+    corners = circuit_corners(session, step=step)
+    laps = session.laps
+    reference = reference_laps(laps)
+    laps = pd.DataFrame(laps.loc[laps['LapTime'].notna() & laps['Time'].notna()])
+    if drivers is not None:
+        laps = laps.loc[laps['Driver'].isin(drivers)]
+    laps = laps.sort_values(['DriverNumber', 'LapNumber']).reset_index(drop=True)
+
+    # One grid for all laps, as long as the laps the corners were found on
+    length = np.nanmedian(lap_lengths(session, reference)) if len(reference) else np.nan
+    grid = np.arange(0, length, step) if np.isfinite(length) else np.empty(0)
+
+    stats = {name: np.full((len(laps), len(corners)), np.nan) for name in
+             ('EntrySpeed', 'MinSpeed', 'MinSpeedAt', 'ExitSpeed', 'BrakePoint', 'CornerTime')}
+    with stage('corners.stats', laps=len(laps), rows=len(laps) * len(corners)):
+        for number, rows in laps.groupby('DriverNumber', observed=True).indices.items():
+            telemetry = session.car_data.get(str(number))
+            if len(grid) < 2 or telemetry is None or len(telemetry) < 2:
+                continue
+            cube = driver_lap_telemetry(telemetry, *lap_windows(laps.iloc[rows]), grid)
+            for name, values in aligned_corner_stats(grid, cube, corners).items():
+                stats[name][rows] = values
+
+    table = pd.DataFrame({
+        'Driver': np.repeat(laps['Driver'].to_numpy(), len(corners)),
+        'LapNumber': np.repeat(laps['LapNumber'].to_numpy(), len(corners)),
+        'Corner': np.tile(corners['Corner'].to_numpy(), len(laps)),
+        **{name: values.ravel() for name, values in stats.items()},
+    })
+    return table
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Detect the corners of a circuit')
+    parser.add_argument('year', type=int)
+    parser.add_argument('grand_prix')
+    parser.add_argument('session')
+    parser.add_argument('--refresh', action='store_true', help='detect again instead of using the cache')
+    parser.add_argument('--stats', nargs='*', help='also measure every lap of these drivers (none: everyone)')
+    args = parser.parse_args(argv)
+
+    from driver_comparisons import get_session
+    session = get_session(args.year, args.grand_prix, args.session)
+
+    print(circuit_corners(session, refresh=args.refresh).to_string(index=False))
+    if args.stats is not None:
+        stats = corner_stats(session, drivers=args.stats or None)
+        print(stats.groupby(['Corner', 'Driver'])[['MinSpeed', 'CornerTime']].median().unstack().round(2))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,71 +1,139 @@
-from matplotlib import pyplot as plt
-import matplotlib as mpl
-from matplotlib import cm
-from matplotlib.pyplot import figure
-from matplotlib.collections import LineCollection
+import warnings
 
 import numpy as np
 import pandas as pd
 
-import fastf1 as ff1
-from fastf1 import utils
-from fastf1.core import Laps
-from fastf1 import plotting
+from session_store import enable_cache
+from lazy_session import needs_streams
+from session_cache import SESSION_CACHE
+from render import finish_figure, pyplot
+from instrumentation import instrumented, stage
+from telemetry_alignment import (align_laps, aligned_frame, channel_index, delta_time, delta_time_matrix,
+                                 pairwise_delta_table)
 
-from timple.timedelta import strftimedelta
+# matplotlib, fastf1.plotting and timple are imported by the functions that
+# plot, so importing this module (e.g. for lap tables only) stays cheap
+
+# Bar color of drivers without a (known) team
+NO_TEAM_COLOR = 'grey'
 
 
 def get_session(year, grand_prix, session):
     ''' This calls on the fastf1 api and creates a session based on year,
-     grand prix, and session(Quali, race, sprint) wanted '''
-    # Setup plotting
-    plotting.setup_mpl()
-
-    # Enable the cache
-    ff1.Cache.enable_cache('/Users/cameronstevens/Documents/Coding/F1_2022_race_analytics/cache') 
-
-    # Get rid of some pandas warnings that are not relevant for us at the moment
-    pd.options.mode.chained_assignment = None 
-
-    # we only want support for timedelta plotting in this example
-    ff1.plotting.setup_mpl(mpl_timedelta_support=True, color_scheme=None, misc_mpl_mods=False)
+     grand prix, and session(Quali, race, sprint) wanted. Plotting is set up
+     once by the first plot (render.setup_plotting), not here '''
+    # Enable the cache (location can be set with F1_CACHE_DIR)
+    enable_cache()
 
-    #This loads the session for the Grand prix session of interest
-
-    session = ff1.get_session(year, grand_prix, session)
-    
-    session.load() 
+    #This gets the session for the Grand prix session of interest from the shared
+    # session cache. Laps, car data, position data and weather are only loaded
+    # when a function first needs them
+    session = SESSION_CACHE.get(year, grand_prix, session)
 
     return(session)
     # This is new with Fastf1 v.2.2
-    
-def fastest_laptimes(session):
-    """This will give you fastest lap times for a given session. 
-    Note: the code will break if a driver doesnt have a fastest lap"""
-    drivers = pd.unique(session.laps['Driver'])
-    print(drivers)
-
-    list_fastest_laps = list()
-    for drv in drivers:
-        drvs_fastest_lap = session.laps.pick_driver(drv).pick_fastest()
-        list_fastest_laps.append(drvs_fastest_lap)
-    fastest_laps = Laps(list_fastest_laps).sort_values(by='LapTime').reset_index(drop=True)
 
-    # plot is nicer to look at and more easily understandable if we just plot the time differences.
-    #  Therefore we subtract the fastest lap time from all other lap times.
-    pole_lap = fastest_laps.pick_fastest()
-    fastest_laps['LapTimeDelta'] = fastest_laps['LapTime'] - pole_lap['LapTime']
 
-    team_colors = list()
-    for index, lap in fastest_laps.iterlaps():
-        color = ff1.plotting.team_color(lap['Team'])
-        team_colors.append(color)
+# Columns concat_session_laps adds to tell sessions apart
+SESSION_COLUMNS = ['Year', 'EventName', 'Session']
+
+
+def concat_session_laps(sessions):
+    """Puts the laps of several sessions into one table, with EventName, Year and
+    Session columns to tell them apart. Feed this to fastest_lap_table with
+    by=SESSION_COLUMNS to get e.g. the fastest laps of every qualifying at once"""
+    return pd.concat([
+        pd.DataFrame(session.laps).assign(EventName=session.event['EventName'],
+                                          Year=session.event.year,
+                                          Session=session.name)
+        for session in sessions
+    ], ignore_index=True)
+
+
+@instrumented()
+def fastest_lap_table(laps, by=None):
+    """Fastest lap of every driver together with the delta to pole, the team and
+    the team color, computed in one grouped pass over the laps table.
+    laps can be a single session's laps or several sessions from
+    concat_session_laps, grouped by the columns in by.
+    Drivers without a timed lap are left out."""
+    by = list(by or [])
+    laps = pd.DataFrame(laps).reset_index(drop=True)
+    # Same laps pick_fastest considers: timed personal bests
+    timed = laps.loc[laps['LapTime'].notna()]
+    if 'IsPersonalBest' in timed.columns:
+        timed = timed.loc[timed['IsPersonalBest'] == True]
+
+    # One idxmin per (session, driver) instead of a pick_driver scan per driver
+    fastest_index = timed.groupby(by + ['Driver'], sort=False, observed=True)['LapTime'].idxmin()
+    fastest_laps = timed.loc[fastest_index.to_numpy()] \
+        .sort_values(by=by + ['LapTime']).reset_index(drop=True)
 
+    # plot is nicer to look at and more easily understandable if we just plot the time differences.
+    #  Therefore we subtract the fastest lap time from all other lap times.
+    if by:
+        pole_time = fastest_laps.groupby(by, sort=False, observed=True)['LapTime'].transform('min')
+    else:
+        pole_time = fastest_laps['LapTime'].min()
+    fastest_laps['LapTimeDelta'] = fastest_laps['LapTime'] - pole_time
+
+    # Only one color lookup per team
+    from fastf1 import plotting as ff1_plotting
+    team_colors = {team: ff1_plotting.team_color(team) for team in fastest_laps['Team'].dropna().unique()}
+    fastest_laps['TeamColor'] = fastest_laps['Team'].map(team_colors)
+
+    return fastest_laps
+
+
+def fastest_lap(session, driver):
+    """The fastest lap of a driver (pick_driver + pick_fastest)"""
+    with stage('pick_fastest', driver=driver):
+        return session.laps.pick_driver(driver).pick_fastest()
+
+
+def distinct_colors(teams):
+    """One color per driver: the team color for the first driver of a team and
+    lighter shades of it for teammates, so lines never share a color"""
+    import matplotlib as mpl
+    from fastf1 import plotting as ff1_plotting
+
+    seen = dict()
+    colors = list()
+    for team in teams:
+        shade = seen.get(team, 0)
+        seen[team] = shade + 1
+        color = np.array(mpl.colors.to_rgb(ff1_plotting.team_color(team)))
+        # mix in white for every further driver of the same team
+        colors.append(mpl.colors.to_hex(color + (1 - color) * (1 - 0.55 ** shade)))
+    return colors
+
+
+@instrumented()
+@needs_streams('laps')
+def fastest_laptimes(session, output=None, dpi=None):
+    """This will give you fastest lap times for a given session.
+    Drivers without a timed lap are left out. See render.finish_figure for output"""
+    fastest_laps = fastest_lap_table(session.laps)
+    return plot_fastest_laptimes(fastest_laps, f"{session.event['EventName']} {session.event.year}",
+                                 output=output, dpi=dpi)
+
+
+def plot_fastest_laptimes(fastest_laps, title, output=None, dpi=None):
+    """Bar chart of a fastest lap table (fastest_lap_table, or the running one
+    of live_session), the gap to the fastest lap per driver. Raises ValueError
+    when no driver has a timed lap yet"""
+    from timple.timedelta import strftimedelta
+
+    if fastest_laps.empty:
+        raise ValueError(f'No timed laps to plot for {title}')
+
+    plt = pyplot()
+    fastest_laps = fastest_laps.reset_index(drop=True)
+    pole_lap = fastest_laps.iloc[0]
 
-    
     fig, ax = plt.subplots(figsize=(12, 6.75))
     ax.barh(fastest_laps.index, fastest_laps['LapTimeDelta'],
-            color=team_colors, edgecolor='grey')
+            color=fastest_laps['TeamColor'].fillna(NO_TEAM_COLOR), edgecolor='grey')
     ax.set_yticks(fastest_laps.index)
     ax.set_yticklabels(fastest_laps['Driver'])
 
@@ -78,27 +146,44 @@ def fastest_laptimes(session):
 
     lap_time_string = strftimedelta(pole_lap['LapTime'], '%m:%s.%ms')
 
-    plt.suptitle(f"{session.event['EventName']} {session.event.year} \n"
+    fig.suptitle(f"{title} \n"
                 f"Fastest Lap: {lap_time_string} ({pole_lap['Driver']})")
 
-    plt.show()
-
+    return finish_figure(fig, output, dpi)
 
 
-def driver_speed_change(driver1, session):
-    """This will give you a visual of one drivers speed change over the course"""
-    
-    colormap = plt.cm.plasma
 
-    lap = session.laps.pick_driver(driver1).pick_fastest()
+@instrumented()
+@needs_streams('laps', 'car_data', 'pos_data')
+def driver_speed_change(driver1, session, output=None, dpi=None, max_segments=None):
+    """This will give you a visual of one drivers speed change over the course.
+    With max_segments the track is decimated to about that many segments
+    (speed in DEFAULT_BUCKETS colour levels), see track_decimation"""
+    import matplotlib as mpl
+    from matplotlib.collections import LineCollection
+    from track_decimation import DEFAULT_BUCKETS, decimate_line, decimate_track
 
-    # Get telemetry data
-    x = lap.telemetry['X']              # values for x-axis
-    y = lap.telemetry['Y']              # values for y-axis
-    color = lap.telemetry['Speed']      # value to base color gradient on
+    plt = pyplot()
+    colormap = plt.cm.plasma
 
-    points = np.array([x, y]).T.reshape(-1, 1, 2)
-    segments = np.concatenate([points[:-1], points[1:]], axis=1)
+    lap = fastest_lap(session, driver1)
+
+    # Get telemetry data, lap.telemetry merges car and position data on every access
+    with stage('get_telemetry') as event:
+        telemetry = lap.telemetry
+        event['rows'] = len(telemetry)
+    x = telemetry['X']              # values for x-axis
+    y = telemetry['Y']              # values for y-axis
+    color = telemetry['Speed']      # value to base color gradient on
+
+    if max_segments is None:
+        points = np.array([x, y]).T.reshape(-1, 1, 2)
+        segments = np.concatenate([points[:-1], points[1:]], axis=1)
+        segment_colors = color
+        track_x, track_y = x, y
+    else:
+        segments, segment_colors = decimate_track(x, y, color, max_segments, buckets=DEFAULT_BUCKETS)
+        track_x, track_y = decimate_line(x, y, max_segments)
 
         # We create a plot with title and adjust some setting to make it look good.
     fig, ax = plt.subplots(sharex=True, sharey=True, figsize=(12, 6.75))
@@ -106,20 +191,20 @@ def driver_speed_change(driver1, session):
 
 
     # Adjust margins and turn of axis
-    plt.subplots_adjust(left=0.1, right=0.9, top=0.9, bottom=0.12)
+    fig.subplots_adjust(left=0.1, right=0.9, top=0.9, bottom=0.12)
     ax.axis('off')
 
 
     # After this, we plot the data itself.
     # Create background track line
-    ax.plot(lap.telemetry['X'], lap.telemetry['Y'], color='black', linestyle='-', linewidth=16, zorder=0)
+    ax.plot(track_x, track_y, color='black', linestyle='-', linewidth=16, zorder=0)
 
     # Create a continuous norm to map from data points to colors
     norm = plt.Normalize(color.min(), color.max())
     lc = LineCollection(segments, cmap=colormap, norm=norm, linestyle='-', linewidth=5)
 
     # Set the values used for colormapping
-    lc.set_array(color)
+    lc.set_array(segment_colors)
 
     # Merge all line segments together
     line = ax.add_collection(lc)
@@ -132,31 +217,31 @@ def driver_speed_change(driver1, session):
 
 
     # Show the plot
-    plt.show()
+    return finish_figure(fig, output, dpi)
 
-def double_driver_lap_comparison(driver1, driver2, session):
+@instrumented()
+@needs_streams('laps', 'car_data')
+def double_driver_lap_comparison(driver1, driver2, session, output=None, dpi=300):
     
     '''This function is to take telementry data from each driver, and compare the respective
-    lap times in regard to fastest lap time data.'''
-
-    # Laps can now be accessed through the .laps object coming from the session
-    laps_driver_1 = session.laps.pick_driver(driver1)
-    laps_driver_2 = session.laps.pick_driver(driver2)
+    lap times in regard to fastest lap time data. Pass output='GP_images' to store the
+    figure under its generated file name like before.'''
+    plt = pyplot()
 
-    # Select the fastest lap
-    fastest_driver_1 = laps_driver_1.pick_fastest()
-    fastest_driver_2 = laps_driver_2.pick_fastest()
+    # Select the fastest lap of each driver
+    fastest_driver_1 = fastest_lap(session, driver1)
+    fastest_driver_2 = fastest_lap(session, driver2)
 
-    # Retrieve the telemetry and add the distance column
-    telemetry_driver_1 = fastest_driver_1.get_telemetry().add_distance()
-    telemetry_driver_2 = fastest_driver_2.get_telemetry().add_distance()
+    # Retrieve the telemetry of both laps once, aligned on a common distance grid
+    distance, telemetry = align_laps([fastest_driver_1, fastest_driver_2])
+    telemetry_driver_1 = aligned_frame(distance, telemetry, 0)
+    telemetry_driver_2 = aligned_frame(distance, telemetry, 1)
 
-    # Make sure whe know the team name for coloring
-    team_driver_1 = fastest_driver_1['Team']
-    team_driver_2 = fastest_driver_2['Team']
+    # Team colors, with the second driver made lighter when both are teammates
+    color_driver_1, color_driver_2 = distinct_colors([fastest_driver_1['Team'], fastest_driver_2['Team']])
 
-    # extract delta time
-    delta_time, ref_tel, compare_tel = utils.delta_time(fastest_driver_1, fastest_driver_2)
+    # extract delta time, both laps are already on the same distances
+    gap = delta_time(telemetry, 0, 1)
 
 
     plot_size = [15, 15]
@@ -166,59 +251,55 @@ def double_driver_lap_comparison(driver1, driver2, session):
     plot_filename = plot_title.replace(" ", "") + ".png"
 
 
-    # Make plot a bit bigger
-    plt.rcParams['figure.figsize'] = plot_size
-
-
     # Create subplots with different sizes
     #fig, ax = plt.subplots(6, gridspec_kw={'height_ratios': plot_ratios})
-    # Create subplots with different sizes which includes DRS data
-    fig, ax = plt.subplots(8, gridspec_kw={'height_ratios': plot_ratios})
+    # Create subplots with different sizes which includes DRS data, and make plot a bit bigger
+    fig, ax = plt.subplots(8, figsize=plot_size, gridspec_kw={'height_ratios': plot_ratios})
 
 
     # Set the plot title
     ax[0].title.set_text(plot_title)
 
     # Delta line
-    ax[0].plot(ref_tel['Distance'], delta_time)
+    ax[0].plot(distance, gap)
     ax[0].axhline(0)
     ax[0].set(ylabel=f"Gap to {driver2} (s)")
 
     # Speed trace
-    ax[1].plot(telemetry_driver_1['Distance'], telemetry_driver_1['Speed'], label=driver1, color=ff1.plotting.team_color(team_driver_1))
-    ax[1].plot(telemetry_driver_2['Distance'], telemetry_driver_2['Speed'], label=driver2, color=ff1.plotting.team_color(team_driver_2))
+    ax[1].plot(telemetry_driver_1['Distance'], telemetry_driver_1['Speed'], label=driver1, color=color_driver_1)
+    ax[1].plot(telemetry_driver_2['Distance'], telemetry_driver_2['Speed'], label=driver2, color=color_driver_2)
     ax[1].set(ylabel='Speed')
     ax[1].legend(loc="lower right")
 
     # Throttle trace
-    ax[2].plot(telemetry_driver_1['Distance'], telemetry_driver_1['Throttle'], label=driver1, color=ff1.plotting.team_color(team_driver_1))
-    ax[2].plot(telemetry_driver_2['Distance'], telemetry_driver_2['Throttle'], label=driver2, color=ff1.plotting.team_color(team_driver_2))
+    ax[2].plot(telemetry_driver_1['Distance'], telemetry_driver_1['Throttle'], label=driver1, color=color_driver_1)
+    ax[2].plot(telemetry_driver_2['Distance'], telemetry_driver_2['Throttle'], label=driver2, color=color_driver_2)
     ax[2].set(ylabel='Throttle')
 
     # Brake trace
-    ax[3].plot(telemetry_driver_1['Distance'], telemetry_driver_1['Brake'], label=driver1, color=ff1.plotting.team_color(team_driver_1))
-    ax[3].plot(telemetry_driver_2['Distance'], telemetry_driver_2['Brake'], label=driver2, color=ff1.plotting.team_color(team_driver_2))
+    ax[3].plot(telemetry_driver_1['Distance'], telemetry_driver_1['Brake'], label=driver1, color=color_driver_1)
+    ax[3].plot(telemetry_driver_2['Distance'], telemetry_driver_2['Brake'], label=driver2, color=color_driver_2)
     ax[3].set(ylabel='Brake')
 
     # Gear trace
-    ax[4].plot(telemetry_driver_1['Distance'], telemetry_driver_1['nGear'], label=driver1, color=ff1.plotting.team_color(team_driver_1))
-    ax[4].plot(telemetry_driver_2['Distance'], telemetry_driver_2['nGear'], label=driver2, color=ff1.plotting.team_color(team_driver_2))
+    ax[4].plot(telemetry_driver_1['Distance'], telemetry_driver_1['nGear'], label=driver1, color=color_driver_1)
+    ax[4].plot(telemetry_driver_2['Distance'], telemetry_driver_2['nGear'], label=driver2, color=color_driver_2)
     ax[4].set(ylabel='Gear')
 
     # RPM trace
-    ax[5].plot(telemetry_driver_1['Distance'], telemetry_driver_1['RPM'], label=driver1, color=ff1.plotting.team_color(team_driver_1))
-    ax[5].plot(telemetry_driver_2['Distance'], telemetry_driver_2['RPM'], label=driver2, color=ff1.plotting.team_color(team_driver_2))
+    ax[5].plot(telemetry_driver_1['Distance'], telemetry_driver_1['RPM'], label=driver1, color=color_driver_1)
+    ax[5].plot(telemetry_driver_2['Distance'], telemetry_driver_2['RPM'], label=driver2, color=color_driver_2)
     ax[5].set(ylabel='RPM')
 
     # DRS trace
-    ax[6].plot(telemetry_driver_1['Distance'], telemetry_driver_1['DRS'], label=driver1, color=ff1.plotting.team_color(team_driver_1))
-    ax[6].plot(telemetry_driver_2['Distance'], telemetry_driver_2['DRS'], label=driver2, color=ff1.plotting.team_color(team_driver_2))
+    ax[6].plot(telemetry_driver_1['Distance'], telemetry_driver_1['DRS'], label=driver1, color=color_driver_1)
+    ax[6].plot(telemetry_driver_2['Distance'], telemetry_driver_2['DRS'], label=driver2, color=color_driver_2)
     ax[6].set(ylabel='DRS')
     ax[6].set(xlabel='Lap distance (meters)')
 
 
-    ax[7].plot(telemetry_driver_1['Distance'], telemetry_driver_1['Time'],  label=driver1, color=ff1.plotting.team_color(team_driver_1))
-    ax[7].plot(telemetry_driver_2['Distance'], telemetry_driver_2['Time'], label=driver2, color=ff1.plotting.team_color(team_driver_2))
+    ax[7].plot(telemetry_driver_1['Distance'], telemetry_driver_1['Time'],  label=driver1, color=color_driver_1)
+    ax[7].plot(telemetry_driver_2['Distance'], telemetry_driver_2['Time'], label=driver2, color=color_driver_2)
     ax[7].set(ylabel='Laptime', xlabel='Lap')
     ax[7].legend(loc="upper center")
 
@@ -227,68 +308,24 @@ def double_driver_lap_comparison(driver1, driver2, session):
     for a in ax.flat:
         a.label_outer()
         
-     #this gives appropriate name
-    name = plot_filename
-    # Store figure
-    plt.savefig('GP_images/{}'.format(name), dpi=300)
-
-# Would be nice to have a conditional statement that ensures the colours are not the same
-    if ff1.plotting.team_color(team_driver_1) == ff1.plotting.team_color(team_driver_2):
-        print('Same Team Color')
-        
-        # Speed trace
-        ax[1].plot(telemetry_driver_1['Distance'], telemetry_driver_1['Speed'], label=driver1, color=ff1.plotting.team_color("RBR"))
-        ax[1].plot(telemetry_driver_2['Distance'], telemetry_driver_2['Speed'], label=driver2, color=ff1.plotting.team_color("FER"))
-        ax[1].set(ylabel='Speed')
-        ax[1].legend(loc="lower left")
-
-          # Throttle trace
-        ax[2].plot(telemetry_driver_1['Distance'], telemetry_driver_1['Throttle'], label=driver1, color=ff1.plotting.team_color("RBR"))
-        ax[2].plot(telemetry_driver_2['Distance'], telemetry_driver_2['Throttle'], label=driver2, color=ff1.plotting.team_color("FER"))
-        ax[2].set(ylabel='Throttle')
-
-        # Brake trace
-        ax[3].plot(telemetry_driver_1['Distance'], telemetry_driver_1['Brake'], label=driver1, color=ff1.plotting.team_color("RBR"))
-        ax[3].plot(telemetry_driver_2['Distance'], telemetry_driver_2['Brake'], label=driver2, color=ff1.plotting.team_color("FER"))
-        ax[3].set(ylabel='Brake')
-
-        # Gear trace
-        ax[4].plot(telemetry_driver_1['Distance'], telemetry_driver_1['nGear'], label=driver1, color=ff1.plotting.team_color("RBR"))
-        ax[4].plot(telemetry_driver_2['Distance'], telemetry_driver_2['nGear'], label=driver2, color=ff1.plotting.team_color("FER"))
-        ax[4].set(ylabel='Gear')
-
-        # RPM trace
-        ax[5].plot(telemetry_driver_1['Distance'], telemetry_driver_1['RPM'], label=driver1, color=ff1.plotting.team_color("RBR"))
-        ax[5].plot(telemetry_driver_2['Distance'], telemetry_driver_2['RPM'], label=driver2, color=ff1.plotting.team_color("FER"))
-        ax[5].set(ylabel='RPM')
-
-        # DRS trace
-        ax[6].plot(telemetry_driver_1['Distance'], telemetry_driver_1['DRS'], label=driver1, color=ff1.plotting.team_color("RBR"))
-        ax[6].plot(telemetry_driver_2['Distance'], telemetry_driver_2['DRS'], label=driver2, color=ff1.plotting.team_color("FER"))
-        ax[6].set(ylabel='DRS')
-        ax[6].set(xlabel='Lap distance (meters)')
-
-
-        ax[7].plot(telemetry_driver_1['Distance'], telemetry_driver_1['Time'],  label=driver1, color=ff1.plotting.team_color("RBR"))
-        ax[7].plot(telemetry_driver_2['Distance'], telemetry_driver_2['Time'], label=driver2, color=ff1.plotting.team_color("FER"))
-        ax[7].set(ylabel='Laptime', xlabel='Lap')
-        ax[7].legend(loc="upper center")
-            
-    
-    plt.show()
+    # Show or store figure, a directory as output gets the appropriate name
+    return finish_figure(fig, output, dpi, file_name=plot_filename)
 
-def fastest_lap_comparison(driverX, driverY, session):
+@instrumented()
+@needs_streams('laps', 'car_data')
+def fastest_lap_comparison(driverX, driverY, session, output=None, dpi=None):
     '''This gives you the fast lap telemtry data comparison between two drivers of interest'''
-   
+    plt = pyplot()
 
-    driver_X = session.laps.pick_driver(driverX).pick_fastest()
-    driver_Y = session.laps.pick_driver(driverY).pick_fastest()
+    lap_X = fastest_lap(session, driverX)
+    lap_Y = fastest_lap(session, driverY)
+    driverX_color, driverY_color = distinct_colors([lap_X['Team'], lap_Y['Team']])
 
-    driver_X = driver_X.get_car_data().add_distance()
-    driver_Y = driver_Y.get_car_data().add_distance()
+    # Reuses the telemetry already extracted for these laps by other comparisons
+    distance, telemetry = align_laps([lap_X, lap_Y])
+    driver_X = aligned_frame(distance, telemetry, 0)
+    driver_Y = aligned_frame(distance, telemetry, 1)
 
-    driverX_color = ff1.plotting.team_color("RBR")
-    driverY_color = ff1.plotting.team_color("FER")
 
     fig, ax = plt.subplots()
     ax.plot(driver_X['Distance'], driver_X['Speed'], color=driverX_color, label=driverX)
@@ -298,51 +335,127 @@ def fastest_lap_comparison(driverX, driverY, session):
     ax.set_ylabel('Speed in km/h')
 
     ax.legend()
-    plt.suptitle(f"Fastest Lap Comparison \n "
+    fig.suptitle(f"Fastest Lap Comparison \n "
                 f"{session.event['EventName']} {session.event.year} {session.name}")
 
-    plt.show()
-
-def driver_gear_changes(driver1, session):
-     # replace with your cache directory
-
-    colormap = plt.cm.plasma
-
-    lap = session.laps.pick_driver(driver1).pick_fastest()
-    tel = lap.get_telemetry()
+    return finish_figure(fig, output, dpi)
+
+@instrumented()
+@needs_streams('laps', 'car_data')
+def fastest_lap_cube(session, drivers=None, step=1.0):
+    """Fastest laps of any number of drivers (all by default, fastest first)
+    aligned on one distance grid. Returns the fastest lap table of those
+    drivers, the grid and an array of drivers x distance samples x CHANNELS.
+    Drivers without a timed lap are left out with a warning"""
+    from fastf1.core import Laps
+
+    fastest_laps = fastest_lap_table(session.laps)
+    if drivers is not None:
+        drivers = list(drivers)
+        missing = [driver for driver in drivers if driver not in set(fastest_laps['Driver'])]
+        if len(missing) == len(drivers):
+            raise ValueError(f'None of {drivers} has a timed lap')
+        if missing:
+            warnings.warn(f'Left out {missing}, they have no timed lap')
+        fastest_laps = fastest_laps.set_index('Driver').loc[[driver for driver in drivers
+                                                             if driver not in missing]].reset_index()
+
+    laps = Laps(fastest_laps, session=session.laps.session)
+    distance, telemetry = align_laps([lap for _, lap in laps.iterlaps()], step=step)
+    return fastest_laps, distance, telemetry
+
+
+@instrumented()
+@needs_streams('laps', 'car_data')
+def pairwise_lap_deltas(session, drivers=None):
+    """Delta time between the fastest laps of every pair of drivers (190 pairs
+    for a full grid), computed from one telemetry cube in a single pass"""
+    fastest_laps, distance, telemetry = fastest_lap_cube(session, drivers)
+    matrix = delta_time_matrix(telemetry)
+    return pairwise_delta_table(fastest_laps['Driver'], matrix)
+
+
+@instrumented()
+@needs_streams('laps', 'car_data')
+def multi_driver_lap_comparison(drivers, session, channels=('Speed', 'Throttle', 'Brake', 'nGear'),
+                                output=None, dpi=None):
+    """Overlays the fastest laps of any number of drivers, with the gap to the
+    fastest of them on top. drivers=None compares the whole field"""
+    plt = pyplot()
+    fastest_laps, distance, telemetry = fastest_lap_cube(session, drivers)
+    colors = distinct_colors(fastest_laps['Team'])
+    # every lap compared to the first, which is the fastest
+    gaps = delta_time_matrix(telemetry)[0]
+
+    fig, ax = plt.subplots(len(channels) + 1, figsize=(15, 3 + 2.5 * len(channels)), sharex=True,
+                           gridspec_kw={'height_ratios': [2] + [1] * len(channels)})
+    ax[0].set_title(f"{session.event.year} {session.event.EventName} - {session.name} - Fastest laps")
+
+    for i, driver in enumerate(fastest_laps['Driver']):
+        ax[0].plot(distance, gaps[i], label=driver, color=colors[i])
+        for a, channel in zip(ax[1:], channels):
+            a.plot(distance, telemetry[i, :, channel_index(channel)], color=colors[i])
+
+    ax[0].set(ylabel=f"Gap to {fastest_laps['Driver'].iloc[0]} (s)")
+    ax[0].legend(loc='upper left', ncol=min(len(colors), 10), fontsize='small')
+    for a, channel in zip(ax[1:], channels):
+        a.set(ylabel=channel)
+    ax[-1].set(xlabel='Lap distance (meters)')
+
+    return finish_figure(fig, output, dpi)
+
+
+@instrumented()
+@needs_streams('laps', 'car_data', 'pos_data')
+def driver_gear_changes(driver1, session, output=None, dpi=None, max_segments=None):
+    '''Track map of the fastest lap coloured by gear. With max_segments the
+    track is decimated to about that many segments, see track_decimation'''
+    from matplotlib import colormaps
+    from matplotlib.collections import LineCollection
+    from track_decimation import decimate_track
+
+    plt = pyplot()
+
+    lap = fastest_lap(session, driver1)
+    with stage('get_telemetry') as event:
+        tel = lap.get_telemetry()
+        event['rows'] = len(tel)
 
 
     x = np.array(tel['X'].values)
     y = np.array(tel['Y'].values)
 
-    points = np.array([x, y]).T.reshape(-1, 1, 2)
-    segments = np.concatenate([points[:-1], points[1:]], axis=1)
     gear = tel['nGear'].to_numpy().astype(float)
+    if max_segments is None:
+        points = np.array([x, y]).T.reshape(-1, 1, 2)
+        segments = np.concatenate([points[:-1], points[1:]], axis=1)
+    else:
+        segments, gear = decimate_track(x, y, gear, max_segments)
 
 
-    cmap = cm.get_cmap('Paired')
+    cmap = colormaps['Paired']
     lc_comp = LineCollection(segments, norm=plt.Normalize(1, cmap.N+1), cmap=cmap)
     lc_comp.set_array(gear)
     lc_comp.set_linewidth(4)
 
-    plt.subplots(sharex=True, sharey=True, figsize=(12, 6.75))
+    fig, ax = plt.subplots(sharex=True, sharey=True, figsize=(12, 6.75))
 
-    plt.gca().add_collection(lc_comp)
-    plt.axis('equal')
-    plt.tick_params(labelleft=False, left=False, labelbottom=False, bottom=False)
+    ax.add_collection(lc_comp)
+    ax.axis('equal')
+    ax.tick_params(labelleft=False, left=False, labelbottom=False, bottom=False)
 
-    title = plt.suptitle(
+    title = fig.suptitle(
         f"Fastest Lap Gear Shift Visualization\n"
         f"{driver1} - {session.event['EventName']} {session.event.year}")
 
         # Finally, we create a color bar as a legend.
-    cbar = plt.colorbar(mappable=lc_comp, label="Gear", boundaries=np.arange(1, 10))
+    cbar = fig.colorbar(mappable=lc_comp, ax=ax, label="Gear", boundaries=np.arange(1, 10))
     cbar.set_ticks(np.arange(1.5, 9.5))
     cbar.set_ticklabels(np.arange(1, 9))
     
 
 
-    plt.show()  
+    return finish_figure(fig, output, dpi)
 
 
 
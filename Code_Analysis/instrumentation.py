@@ -0,0 +1,209 @@
+# instrumentation.py
+# Opt-in timing, memory and row counts per stage of an analysis.
+#
+# Wrapping a piece of work in stage('name') records its wall time, the peak
+# memory allocated while it ran and how many rows it handled as one JSON line
+# per event. Nothing is recorded (and next to nothing is spent) unless
+# instrumentation is enabled, with enable(path) or F1_INSTRUMENT=path. Stages
+# nest, so a season batch shows how an analysis splits into loading, lap
+# picking, telemetry, alignment and savefig. summarize() aggregates the events
+# of a whole batch, profiled() runs a block under cProfile.
+#
+# Example:
+#   F1_INSTRUMENT=events.jsonl python season_batch.py 2022 --rounds 1-3
+#   python instrumentation.py events.jsonl
+
+import os
+import sys
+import json
+import time
+import cProfile
+import pstats
+import argparse
+import functools
+import threading
+import tracemalloc
+from contextlib import contextmanager
+
+import pandas as pd
+
+
+# JSON lines file events are appended to, None while disabled
+EVENTS_PATH = os.environ.get('F1_INSTRUMENT') or None
+
+_lock = threading.Lock()
+_local = threading.local()
+
+
+def enable(path, memory=True):
+    '''Starts recording events to path (appended, one JSON object per line).
+    memory traces allocations for peak memory per stage, which slows
+    allocation-heavy code down somewhat'''
+    global EVENTS_PATH
+    EVENTS_PATH = path
+    directory = os.path.dirname(os.path.abspath(path))
+    os.makedirs(directory, exist_ok=True)
+    # Worker processes pick the setting up from the environment
+    os.environ['F1_INSTRUMENT'] = path
+    if memory and not tracemalloc.is_tracing():
+        tracemalloc.start()
+
+
+def disable():
+    global EVENTS_PATH
+    EVENTS_PATH = None
+    os.environ.pop('F1_INSTRUMENT', None)
+    if tracemalloc.is_tracing():
+        tracemalloc.stop()
+
+
+def is_enabled():
+    return EVENTS_PATH is not None
+
+
+def _stack():
+    if not hasattr(_local, 'stack'):
+        _local.stack = list()
+    return _local.stack
+
+
+def _fold_peak(stack):
+    '''Hands the allocation peak since the last reset to every open stage'''
+    if not tracemalloc.is_tracing():
+        return
+    peak = tracemalloc.get_traced_memory()[1]
+    for open_stage in stack:
+        open_stage['_peak'] = max(open_stage['_peak'], peak)
+    tracemalloc.reset_peak()
+
+
+def record(event):
+    '''Appends one event to the events file'''
+    if EVENTS_PATH is None:
+        return
+    line = json.dumps(event, default=str)
+    with _lock, open(EVENTS_PATH, 'a') as f:
+        f.write(line + '\n')
+
+
+@contextmanager
+def stage(name, **fields):
+    '''Records the wall time, peak memory and rows of the block as one event.
+    Yields the event dict: set event['rows'] (or any other field) inside the
+    block. Extra keyword arguments are stored with the event'''
+    if EVENTS_PATH is None:
+        yield dict()
+        return
+
+    stack = _stack()
+    _fold_peak(stack)
+    current = tracemalloc.get_traced_memory()[0] if tracemalloc.is_tracing() else 0
+    event = {'event': 'stage', 'name': name,
+             'parent': stack[-1]['name'] if stack else None,
+             'depth': len(stack), **fields, '_peak': current, '_start': current}
+    stack.append(event)
+
+    started = time.perf_counter()
+    error = None
+    try:
+        yield event
+    except BaseException as exception:
+        error = type(exception).__name__
+        raise
+    finally:
+        event['seconds'] = time.perf_counter() - started
+        _fold_peak(stack)
+        stack.pop()
+        peak, start = event.pop('_peak'), event.pop('_start')
+        event['peak_bytes'] = peak - start if tracemalloc.is_tracing() else None
+        event.setdefault('rows', None)
+        event['error'] = error
+        event['pid'] = os.getpid()
+        event['time'] = time.time()
+        record(event)
+
+
+def instrumented(name=None):
+    '''Decorator that runs the function as a stage (named after the function
+    unless name is given)'''
+    def decorator(func):
+        stage_name = name or func.__name__
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if EVENTS_PATH is None:
+                return func(*args, **kwargs)
+            with stage(stage_name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+@contextmanager
+def profiled(path=None, top=25, sort='cumulative'):
+    '''Runs the block under cProfile. Saves the stats to path (for snakeviz,
+    pstats, ...) when given, otherwise prints the top entries'''
+    profile = cProfile.Profile()
+    profile.enable()
+    try:
+        yield profile
+    finally:
+        profile.disable()
+        if path:
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+            profile.dump_stats(path)
+        else:
+            pstats.Stats(profile, stream=sys.stdout).sort_stats(sort).print_stats(top)
+
+
+def read_events(*paths):
+    '''Events of one or more JSON lines files as a dataframe'''
+    events = list()
+    for path in paths:
+        with open(path) as f:
+            events.extend(json.loads(line) for line in f if line.strip())
+    return pd.DataFrame(events)
+
+
+def summarize(events):
+    '''Time, memory and rows per stage across a batch: how often it ran, total
+    and mean seconds, share of all top-level time, largest peak memory, rows
+    and errors. events is a dataframe from read_events or a path'''
+    if isinstance(events, (str, os.PathLike)):
+        events = read_events(events)
+    stages = events.loc[events['event'] == 'stage']
+    if stages.empty:
+        return pd.DataFrame()
+
+    top_level = stages.loc[stages['depth'] == 0, 'seconds'].sum()
+    summary = stages.groupby('name').agg(
+        count=('seconds', 'size'),
+        total_seconds=('seconds', 'sum'),
+        mean_seconds=('seconds', 'mean'),
+        max_seconds=('seconds', 'max'),
+        peak_mb=('peak_bytes', 'max'),
+        rows=('rows', 'sum'),
+        errors=('error', 'count'),
+    )
+    summary['peak_mb'] = summary['peak_mb'] / 2 ** 20
+    summary['share'] = summary['total_seconds'] / top_level if top_level else float('nan')
+    return summary.sort_values('total_seconds', ascending=False)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Summarize instrumentation events')
+    parser.add_argument('events', nargs='+', help='JSON lines files written with F1_INSTRUMENT')
+    args = parser.parse_args(argv)
+
+    pd.set_option('display.width', 200)
+    print(summarize(read_events(*args.events)).to_string(float_format=lambda value: f'{value:.3f}'))
+    return 0
+
+
+# Tracing memory from the start when enabled through the environment
+if EVENTS_PATH is not None and not tracemalloc.is_tracing():
+    tracemalloc.start()
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,161 @@
+# lazy_session.py
+# Lazy, per-stream loading of fastf1 sessions.
+#
+# session.load() pulls timing, car data, position data, weather and messages
+# even when an analysis only looks at the laps or the weather. A LazySession
+# only fetches a stream (from the session store, or else from the api) the
+# first time it is used, and the analysis functions declare which streams they
+# need with the needs_streams decorator.
+
+import functools
+
+from session_store import STREAMS, load_stream, save_stream
+from compact_frames import COMPACT, compact_stream
+from instrumentation import stage
+
+
+# The session.load() flags that fetch a stream from the api. Car and position
+# data always come together from the api, but are stored separately. The race
+# control messages are small and come (and are stored) with the laps.
+LOAD_FLAGS = {
+    'laps': 'laps',
+    'car_data': 'telemetry',
+    'pos_data': 'telemetry',
+    'weather': 'weather',
+}
+
+# Telemetry can only be sliced into laps (and loaded by fastf1) after the laps
+STREAM_DEPENDENCIES = {
+    'car_data': ('laps',),
+    'pos_data': ('laps',),
+}
+
+
+class LazySession:
+    '''Wraps a fastf1 session and loads laps, car data, position data and
+    weather on first access. Everything else (event, name, ...) is passed on to
+    the wrapped session.'''
+
+    def __init__(self, year, grand_prix, session, store_dir=None, compact=None):
+        import fastf1 as ff1
+        self.session = ff1.get_session(year, grand_prix, session)
+        self.store_dir = store_dir
+        # Narrow the dtypes of every stream after loading (compact_frames)
+        self.compact = COMPACT if compact is None else compact
+        self.loaded = set()
+        # Called without arguments whenever new streams were loaded (the
+        # session cache checks its memory budget then)
+        self.on_load = None
+
+    def __repr__(self):
+        return (f"LazySession({self.session.event.year} {self.session.event['EventName']} "
+                f"- {self.session.name}, loaded={sorted(self.loaded)})")
+
+    def load_streams(self, *streams):
+        '''Makes sure the given streams are loaded, returns the wrapped session'''
+        wanted = list()
+        for stream in streams:
+            if stream not in STREAMS:
+                raise ValueError(f"Unknown stream '{stream}', expected one of {STREAMS}")
+            wanted.extend(STREAM_DEPENDENCIES.get(stream, ()))
+            wanted.append(stream)
+
+        missing = [stream for stream in dict.fromkeys(wanted) if stream not in self.loaded]
+        if not missing:
+            return self.session
+
+        # Whatever is in the session store is read from there
+        for stream in list(missing):
+            with stage('store.load_stream', stream=stream) as event:
+                found = load_stream(self.session, stream, self.store_dir)
+                event['hit'] = bool(found)
+            if found:
+                if self.compact:
+                    compact_stream(self.session, stream)
+                self.loaded.add(stream)
+                missing.remove(stream)
+
+        # The rest comes from the api in a single session.load() call
+        if missing:
+            flags = dict(laps=False, telemetry=False, weather=False, messages=False)
+            for stream in missing:
+                flags[LOAD_FLAGS[stream]] = True
+            flags['messages'] = flags['laps']
+            with stage('session.load', streams=missing):
+                self.session.load(**flags)
+
+            for stream in STREAMS:
+                if flags[LOAD_FLAGS[stream]] and stream not in self.loaded:
+                    # Compacted before storing, so the store holds the small dtypes too
+                    if self.compact:
+                        with stage('compact', stream=stream):
+                            compact_stream(self.session, stream)
+                    with stage('store.save_stream', stream=stream):
+                        save_stream(self.session, stream, self.store_dir)
+                    self.loaded.add(stream)
+
+        if self.on_load is not None:
+            self.on_load()
+        return self.session
+
+    @property
+    def laps(self):
+        return self.load_streams('laps').laps
+
+    @property
+    def results(self):
+        return self.load_streams('laps').results
+
+    @property
+    def drivers(self):
+        return self.load_streams('laps').drivers
+
+    @property
+    def track_status(self):
+        return self.load_streams('laps').track_status
+
+    @property
+    def session_status(self):
+        return self.load_streams('laps').session_status
+
+    @property
+    def race_control_messages(self):
+        return self.load_streams('laps').race_control_messages
+
+    @property
+    def session_info(self):
+        return self.load_streams('laps').session_info
+
+    @property
+    def car_data(self):
+        return self.load_streams('car_data').car_data
+
+    @property
+    def pos_data(self):
+        return self.load_streams('pos_data').pos_data
+
+    @property
+    def weather_data(self):
+        return self.load_streams('weather').weather_data
+
+    def __getattr__(self, name):
+        # Only called for attributes not found on the wrapper itself
+        if name == 'session':
+            raise AttributeError(name)
+        return getattr(self.session, name)
+
+
+def needs_streams(*streams):
+    '''Declares which streams an analysis function uses. Any LazySession passed
+    to the function has those streams loaded before the function runs.'''
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            for arg in (*args, *kwargs.values()):
+                if isinstance(arg, LazySession):
+                    arg.load_streams(*streams)
+            return func(*args, **kwargs)
+
+        wrapper.streams = streams
+        return wrapper
+    return decorator
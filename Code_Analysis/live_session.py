@@ -0,0 +1,400 @@
+# live_session.py
+# Incremental analyses for a session whose data arrives in chunks.
+#
+# Every other module looks at a finished session loaded in one go. LiveTiming
+# instead takes laps and car data as they come in (a few seconds at a time
+# during a live session) and keeps running aggregates, so each chunk costs
+# time in proportion to its own size rather than to everything seen so far:
+#   - the fastest lap of every driver (and the fastest_laptimes chart)
+#   - gaps to the leader and to the car ahead
+#   - fuel-corrected stint pace and degradation, from running sums of the same
+#     least squares fit race_pace does in one go
+#   - car data per driver and its top speed
+#
+# Without a live feed at hand, replay_session cuts a finished (stored or
+# synthetic) session into the chunks a live feed would have delivered and
+# feeds them at 1x-100x speed, measuring the update latency of every chunk.
+#
+# Example:
+#   python live_session.py 2022 Monaco R --speed 50 --chunk 5
+#   python live_session.py 2022 Monaco R --synthetic --speed 0 --recompute
+
+import sys
+import time
+import bisect
+import argparse
+from collections import defaultdict
+
+import numpy as np
+import pandas as pd
+
+from race_pace import FUEL_CORRECTION, MIN_STINT_LAPS, NOT_GREEN, SLOW_LAP_FACTOR, STINT_COLUMNS
+from instrumentation import instrumented, stage
+
+
+# Seconds of session time per chunk when replaying
+DEFAULT_CHUNK_SECONDS = 5.0
+
+# Running sums of a stint: laps, tyre life, tyre life^2, time, tyre life * time, time^2
+_N, _X, _XX, _Y, _XY, _YY = range(6)
+
+
+class LiveTiming:
+    '''Running aggregates of laps and car data fed in with update().
+
+    The stint pace follows race_pace.clean_race_laps with one difference: a
+    lap counts as a slow outlier when it is slower than slow_lap_factor times
+    the median of the driver's clean laps so far, not of the whole race.
+    race_laps (for the fuel correction) defaults to the highest lap seen'''
+
+    def __init__(self, title='Live session', race_laps=None, correction=FUEL_CORRECTION,
+                 slow_lap_factor=SLOW_LAP_FACTOR, min_laps=MIN_STINT_LAPS):
+        self.title = title
+        self.race_laps = race_laps
+        self.correction = correction
+        self.slow_lap_factor = slow_lap_factor
+        self.min_laps = min_laps
+
+        self.laps_seen = 0
+        self.samples_seen = 0
+        self.max_lap = 0
+
+        # driver -> fastest timed lap (a row of the laps table)
+        self._fastest = dict()
+        # driver -> (last completed lap, session seconds it was completed)
+        self._last = dict()
+        # lap number -> session seconds the first car completed it
+        self._first_done = dict()
+        # driver -> sorted seconds of their clean laps, for the running median
+        self._clean = defaultdict(list)
+        # (driver, stint) -> running sums, and team, compound, first and last lap
+        self._stint_sums = dict()
+        self._stint_info = dict()
+        # driver -> list of car data chunks, and their top speed
+        self._car_chunks = defaultdict(list)
+        self._top_speed = dict()
+
+        self._team_colors = dict()
+        # (output, dpi) -> the last fastest_laptimes image while the fastest laps are unchanged
+        self._chart = dict()
+
+    @instrumented('LiveTiming.update')
+    def update(self, laps=None, car_data=None):
+        '''Adds a chunk: newly completed laps (rows of a laps table) and/or new
+        car data samples per driver. Returns what changed'''
+        changed = {'laps': 0, 'samples': 0, 'fastest': list()}
+        if laps is not None and len(laps):
+            laps = pd.DataFrame(laps)
+            changed['laps'] = len(laps)
+            changed['fastest'] = self._update_fastest(laps)
+            self._update_gaps(laps)
+            self._update_stints(laps)
+            self.laps_seen += len(laps)
+            self.max_lap = max(self.max_lap, int(laps['LapNumber'].max()))
+        for drv, telemetry in (car_data or dict()).items():
+            if len(telemetry):
+                self._car_chunks[drv].append(telemetry)
+                top = float(np.nanmax(telemetry['Speed'].to_numpy(dtype=float)))
+                self._top_speed[drv] = max(self._top_speed.get(drv, top), top)
+                changed['samples'] += len(telemetry)
+        self.samples_seen += changed['samples']
+        if changed['fastest']:
+            self._chart.clear()
+        return changed
+
+    def _update_fastest(self, laps):
+        # The same laps fastest_lap_table considers: timed personal bests
+        timed = laps.loc[laps['LapTime'].notna()]
+        if 'IsPersonalBest' in timed.columns:
+            timed = timed.loc[timed['IsPersonalBest'] == True]
+        if timed.empty:
+            return list()
+
+        improved = list()
+        best = timed.loc[timed.groupby('Driver', sort=False, observed=True)['LapTime'].idxmin()]
+        for _, lap in best.iterrows():
+            current = self._fastest.get(lap['Driver'])
+            if current is None or lap['LapTime'] < current['LapTime']:
+                self._fastest[lap['Driver']] = lap
+                improved.append(lap['Driver'])
+        return improved
+
+    def _update_gaps(self, laps):
+        done = laps.loc[laps['Time'].notna()]
+        seconds = done['Time'].dt.total_seconds().to_numpy()
+        for lap_number, driver, second in zip(done['LapNumber'].to_numpy(), done['Driver'], seconds):
+            lap_number = int(lap_number)
+            if second < self._first_done.get(lap_number, np.inf):
+                self._first_done[lap_number] = second
+            if lap_number >= self._last.get(driver, (0, 0))[0]:
+                self._last[driver] = (lap_number, second)
+
+    def _update_stints(self, laps):
+        # Everything clean_race_laps checks except the median, vectorized over the chunk
+        keep = laps['LapTime'].notna() & laps['Stint'].notna() & (laps['LapNumber'] > 1)
+        keep &= laps['PitInTime'].isna() & laps['PitOutTime'].isna()
+        if 'TrackStatus' in laps.columns:
+            keep &= ~laps['TrackStatus'].astype(str).str.contains(NOT_GREEN)
+        clean = laps.loc[keep]
+        if clean.empty:
+            return
+
+        lap_seconds = clean['LapTime'].dt.total_seconds().to_numpy()
+        lap_numbers = clean['LapNumber'].to_numpy(dtype=float)
+        tyre_life = clean['TyreLife'].to_numpy(dtype=float)
+        # Fuel correction without the race length: that only shifts the pace of
+        # every stint by the same amount, which is added back in stint_pace_table
+        corrected = lap_seconds + self.correction * lap_numbers
+
+        for i, (driver, stint) in enumerate(zip(clean['Driver'], clean['Stint'].to_numpy())):
+            history = self._clean[driver]
+            bisect.insort(history, lap_seconds[i])
+            middle = len(history) // 2
+            median = history[middle] if len(history) % 2 else (history[middle - 1] + history[middle]) / 2
+            if lap_seconds[i] > median * self.slow_lap_factor:
+                continue
+
+            key = (driver, int(stint))
+            sums = self._stint_sums.get(key)
+            if sums is None:
+                sums = self._stint_sums[key] = np.zeros(6)
+                self._stint_info[key] = {'Team': clean['Team'].iat[i], 'Compound': clean['Compound'].iat[i],
+                                         'FirstLap': int(lap_numbers[i]), 'LastLap': int(lap_numbers[i])}
+            x, y = tyre_life[i], corrected[i]
+            sums += (1, x, x * x, y, x * y, y * y)
+            info = self._stint_info[key]
+            info['FirstLap'] = min(info['FirstLap'], int(lap_numbers[i]))
+            info['LastLap'] = max(info['LastLap'], int(lap_numbers[i]))
+
+    @instrumented('LiveTiming.fastest_lap_table')
+    def fastest_lap_table(self):
+        '''The fastest lap of every driver so far, like fastest_lap_table'''
+        if not self._fastest:
+            return pd.DataFrame()
+        fastest_laps = pd.DataFrame(list(self._fastest.values())) \
+            .sort_values('LapTime').reset_index(drop=True)
+        fastest_laps['LapTimeDelta'] = fastest_laps['LapTime'] - fastest_laps['LapTime'].min()
+
+        from fastf1 import plotting as ff1_plotting
+        for team in fastest_laps['Team'].dropna().unique():
+            if team not in self._team_colors:
+                self._team_colors[team] = ff1_plotting.team_color(team)
+        fastest_laps['TeamColor'] = fastest_laps['Team'].map(self._team_colors)
+        return fastest_laps
+
+    @instrumented('LiveTiming.gap_table')
+    def gap_table(self):
+        '''Running order with the gap (seconds) to the leader on the same lap,
+        the laps down and the interval to the car ahead'''
+        if not self._last:
+            return pd.DataFrame(columns=['Position', 'Driver', 'Lap', 'GapToLeader', 'LapsDown', 'Interval'])
+        drivers = list(self._last)
+        lap, seconds = np.array([self._last[driver] for driver in drivers]).T
+        table = pd.DataFrame({'Driver': drivers, 'Lap': lap.astype(int), 'Seconds': seconds})
+        table = table.sort_values(['Lap', 'Seconds'], ascending=[False, True]).reset_index(drop=True)
+
+        first_done = table['Lap'].map(self._first_done)
+        table['GapToLeader'] = table['Seconds'] - first_done
+        table['LapsDown'] = table['Lap'].iat[0] - table['Lap']
+        interval = table['GapToLeader'].diff()
+        # Only comparable to the car ahead when on the same lap
+        table['Interval'] = interval.where(table['Lap'] == table['Lap'].shift(), np.nan)
+        table.insert(0, 'Position', np.arange(1, len(table) + 1))
+        return table.drop(columns='Seconds')
+
+    @instrumented('LiveTiming.stint_pace_table')
+    def stint_pace_table(self):
+        '''Fresh-tyre pace, degradation and mean fuel-corrected pace of every
+        stint with at least min_laps clean laps, like race_pace.stint_pace_table'''
+        keys = [key for key, sums in self._stint_sums.items() if sums[_N] >= self.min_laps]
+        if not keys:
+            return pd.DataFrame(columns=STINT_COLUMNS)
+
+        sums = np.array([self._stint_sums[key] for key in keys])
+        n, x, xx, y, xy, yy = sums.T
+        det = n * xx - x * x
+        solvable = np.abs(det) > 1e-9
+        with np.errstate(invalid='ignore', divide='ignore'):
+            pace = np.where(solvable, (xx * y - x * xy) / det, np.nan)
+            degradation = np.where(solvable, (n * xy - x * y) / det, np.nan)
+            residual = yy - pace * y - degradation * xy
+        residual_std = np.sqrt(np.clip(residual, 0, None) / np.maximum(n - 2, 1))
+
+        shift = self.correction * (self.race_laps or self.max_lap)
+        info = [self._stint_info[key] for key in keys]
+        table = pd.DataFrame({
+            'Driver': [key[0] for key in keys],
+            'Team': [item['Team'] for item in info],
+            'Stint': [key[1] for key in keys],
+            'Compound': [item['Compound'] for item in info],
+            'FirstLap': [item['FirstLap'] for item in info],
+            'LastLap': [item['LastLap'] for item in info],
+            'Laps': n.astype(int),
+            'Pace': pace - shift,
+            'Degradation': degradation,
+            'MeanPace': y / n - shift,
+            'ResidualStd': residual_std,
+        })
+        return table.sort_values('MeanPace').reset_index(drop=True)
+
+    def top_speeds(self):
+        return pd.Series(self._top_speed, name='TopSpeed').sort_values(ascending=False)
+
+    def car_data(self, drv):
+        '''All car data of a driver received so far'''
+        chunks = self._car_chunks.get(drv)
+        if not chunks:
+            return pd.DataFrame()
+        if len(chunks) > 1:
+            # Concatenated once on demand, then kept as a single chunk
+            self._car_chunks[drv] = chunks = [pd.concat(chunks)]
+        return chunks[0]
+
+    @instrumented('LiveTiming.fastest_laptimes')
+    def fastest_laptimes(self, output='png', dpi=None):
+        '''The fastest_laptimes chart of the laps so far, None before the first
+        timed lap. Only rendered again when a fastest lap has changed since
+        the last call'''
+        from driver_comparisons import plot_fastest_laptimes
+
+        key = (output, dpi)
+        if key not in self._chart:
+            fastest_laps = self.fastest_lap_table()
+            if fastest_laps.empty:
+                return None
+            self._chart[key] = plot_fastest_laptimes(fastest_laps, self.title, output=output, dpi=dpi)
+        return self._chart[key]
+
+
+def session_chunks(session, chunk_seconds=DEFAULT_CHUNK_SECONDS, car_data=True):
+    '''Cuts a finished session into what a live feed would have delivered
+    every chunk_seconds: the laps completed and the car data sampled in that
+    window. Yields (session seconds at the end of the chunk, laps, {driver: car data})'''
+    laps = pd.DataFrame(session.laps)
+    laps = laps.loc[laps['Time'].notna()].sort_values('Time', kind='stable')
+    lap_seconds = laps['Time'].dt.total_seconds().to_numpy()
+
+    telemetry = dict()
+    if car_data:
+        for drv, frame in session.car_data.items():
+            # A feed delivers plain rows, slicing fastf1's Telemetry costs more than the update
+            frame = pd.DataFrame(frame)
+            telemetry[drv] = (frame, frame['SessionTime'].dt.total_seconds().to_numpy())
+    start = min([lap_seconds[0]] + [seconds[0] for _, seconds in telemetry.values() if len(seconds)])
+    end = max([lap_seconds[-1]] + [seconds[-1] for _, seconds in telemetry.values() if len(seconds)])
+
+    # Chunk boundaries and where every table crosses them, found once up front
+    edges = np.arange(start, end + chunk_seconds, chunk_seconds)
+    lap_bounds = np.searchsorted(lap_seconds, edges, side='left')
+    car_bounds = {drv: np.searchsorted(seconds, edges, side='left')
+                  for drv, (_, seconds) in telemetry.items()}
+
+    for i in range(1, len(edges)):
+        yield (edges[i],
+               laps.iloc[lap_bounds[i - 1]:lap_bounds[i]],
+               {drv: frame.iloc[car_bounds[drv][i - 1]:car_bounds[drv][i]]
+                for drv, (frame, _) in telemetry.items()})
+
+
+def replay_session(session, speed=10.0, chunk_seconds=DEFAULT_CHUNK_SECONDS, live=None, render=True,
+                   recompute=False, car_data=True):
+    '''Feeds a finished session chunk by chunk into a LiveTiming at speed
+    times real time (0 or None: as fast as possible). With render the
+    fastest_laptimes chart is kept up to date, with recompute every chunk also
+    times the batch analyses on all laps so far, for comparison.
+
+    Returns the LiveTiming and a table per chunk: session time, new laps and
+    samples, milliseconds to update and render, and how late the chunk was
+    picked up compared to the schedule'''
+    from driver_comparisons import fastest_lap_table
+    from race_pace import stint_pace_table
+
+    if live is None:
+        live = LiveTiming(title=f"{session.event['EventName']} {session.event.year} - {session.name}")
+    all_laps = pd.DataFrame(session.laps)
+    lap_seconds = all_laps['Time'].dt.total_seconds()
+
+    rows = list()
+    first_edge = None
+    wall_start = time.perf_counter()
+    for chunk, (edge, laps, telemetry) in enumerate(session_chunks(session, chunk_seconds, car_data)):
+        first_edge = edge if first_edge is None else first_edge
+        late = 0.0
+        if speed:
+            due = wall_start + (edge - first_edge) / speed
+            wait = due - time.perf_counter()
+            if wait > 0:
+                time.sleep(wait)
+            late = max(time.perf_counter() - due, 0.0)
+
+        with stage('live.update', rows=len(laps)):
+            started = time.perf_counter()
+            changed = live.update(laps, telemetry)
+            update_seconds = time.perf_counter() - started
+
+        render_seconds = 0.0
+        if render and changed['fastest']:
+            started = time.perf_counter()
+            live.fastest_laptimes()
+            render_seconds = time.perf_counter() - started
+
+        row = {'chunk': chunk, 'session_seconds': edge, 'laps': changed['laps'],
+               'samples': changed['samples'], 'update_ms': 1000 * update_seconds,
+               'render_ms': 1000 * render_seconds, 'late_ms': 1000 * late}
+        if recompute and changed['laps']:
+            so_far = all_laps.loc[lap_seconds < edge]
+            started = time.perf_counter()
+            fastest_lap_table(so_far)
+            stint_pace_table(so_far)
+            row['recompute_ms'] = 1000 * (time.perf_counter() - started)
+        rows.append(row)
+
+    return live, pd.DataFrame(rows)
+
+
+def latency_summary(chunks):
+    '''Median, 95th percentile and worst milliseconds per chunk, of the chunks that brought laps'''
+    with_laps = chunks.loc[chunks['laps'] > 0]
+    columns = [column for column in ('update_ms', 'render_ms', 'recompute_ms', 'late_ms')
+               if column in chunks.columns]
+    return pd.DataFrame({
+        'all_p50': chunks[columns].median(),
+        'laps_p50': with_laps[columns].median(),
+        'laps_p95': with_laps[columns].quantile(0.95),
+        'max': chunks[columns].max(),
+    })
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Replay a finished session as a live feed')
+    parser.add_argument('year', type=int)
+    parser.add_argument('grand_prix')
+    parser.add_argument('session')
+    parser.add_argument('--speed', type=float, default=10,
+                        help='times real time, e.g. 1 to 100. 0 feeds as fast as possible')
+    parser.add_argument('--chunk', type=float, default=DEFAULT_CHUNK_SECONDS, help='seconds per chunk')
+    parser.add_argument('--no-render', action='store_true', help="don't keep the fastest laps chart up to date")
+    parser.add_argument('--recompute', action='store_true',
+                        help='also time the batch analyses on all laps so far for every chunk')
+    parser.add_argument('--synthetic', action='store_true', help='replay a synthetic session')
+    parser.add_argument('--output', help='write the per chunk latencies as csv')
+    args = parser.parse_args(argv)
+
+    if args.synthetic:
+        from synthetic_session import get_session
+    else:
+        from driver_comparisons import get_session
+    session = get_session(args.year, args.grand_prix, args.session)
+
+    live, chunks = replay_session(session, speed=args.speed, chunk_seconds=args.chunk,
+                                  render=not args.no_render, recompute=args.recompute)
+    pd.set_option('display.width', 200)
+    print(live.gap_table().head(10).to_string(index=False))
+    print(latency_summary(chunks).to_string(float_format=lambda value: f'{value:.2f}'))
+    if args.output:
+        chunks.to_csv(args.output, index=False)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
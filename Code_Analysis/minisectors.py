@@ -0,0 +1,227 @@
+# minisectors.py
+# Mini-sector times of every lap, who is fastest where, and theoretical best laps.
+#
+# Every lap is split into n equal-distance mini-sectors. Instead of pulling
+# and resampling the car data of each lap on its own (which is what makes
+# align_laps slow for a whole race), the distance of every driver is
+# integrated once over the whole session, and the times every lap crosses its
+# mini-sector boundaries are interpolated for all laps of the driver in one
+# call. A mini-sector is a fraction of the lap's own distance, so the
+# mini-sector times of a lap add up to its lap time.
+#
+# From the mini-sector times follow the fastest driver or team in every
+# mini-sector, drawn on the track map, and each driver's theoretical best lap:
+# the sum of their best time in every mini-sector.
+#
+# Example:
+#   python minisectors.py 2022 Monaco Q
+#   python minisectors.py 2022 Monaco R --sectors 50 --by Driver --output dominance.png
+
+import sys
+import argparse
+
+import numpy as np
+import pandas as pd
+
+from lazy_session import needs_streams
+from render import finish_figure, pyplot
+from instrumentation import instrumented, stage
+
+
+# Equal-distance mini-sectors per lap
+MINISECTORS = 25
+
+# Seconds a lap may start before the first or end after the last car data
+# sample; the samples rarely fall exactly on the lap edges
+EDGE_TOLERANCE = 1.0
+
+
+def lap_windows(laps):
+    '''Session seconds of the start and end of every lap'''
+    start = laps['LapStartTime'].fillna(laps['Time'] - laps['LapTime'])
+    return start.dt.total_seconds().to_numpy(), laps['Time'].dt.total_seconds().to_numpy()
+
+
+def driver_distance(telemetry):
+    '''Session seconds and distance driven (meters) at every car data sample,
+    integrated from the speed over the whole session at once'''
+    telemetry = pd.DataFrame(telemetry)
+    seconds = telemetry['SessionTime'].dt.total_seconds().to_numpy()
+    order = np.argsort(seconds, kind='stable')
+    seconds = seconds[order]
+    speed = np.nan_to_num(telemetry['Speed'].to_numpy(dtype=float)[order]) / 3.6
+    distance = np.concatenate([[0.0], np.cumsum(0.5 * (speed[1:] + speed[:-1]) * np.diff(seconds))])
+    return seconds, distance
+
+
+def boundary_times(seconds, distance, start, end, n_sectors=MINISECTORS):
+    '''When every lap (start and end in session seconds) crosses each of its
+    n_sectors + 1 mini-sector boundaries, as laps x (n_sectors + 1). NaN for
+    laps the car data doesn't cover'''
+    fractions = np.linspace(0, 1, n_sectors + 1)
+    start_distance = np.interp(start, seconds, distance)
+    end_distance = np.interp(end, seconds, distance)
+    boundaries = start_distance[:, None] + (end_distance - start_distance)[:, None] * fractions[None, :]
+
+    crossings = np.interp(boundaries, distance, seconds)
+    crossings[:, 0], crossings[:, -1] = start, end
+    covered = (start >= seconds[0] - EDGE_TOLERANCE) & (end <= seconds[-1] + EDGE_TOLERANCE) \
+        & (end_distance > start_distance)
+    crossings[~covered] = np.nan
+    return crossings
+
+
+@instrumented()
+@needs_streams('laps', 'car_data')
+def minisector_times(session, n_sectors=MINISECTORS, drivers=None):
+    '''Seconds through each of n_sectors mini-sectors of every timed lap of
+    the given drivers (all by default). Returns the laps (Driver, Team,
+    LapNumber, LapTime, Clean) and an array of laps x n_sectors. Clean laps are
+    neither in nor out laps'''
+    laps = pd.DataFrame(session.laps)
+    laps = laps.loc[laps['LapTime'].notna() & laps['Time'].notna()]
+    if drivers is not None:
+        laps = laps.loc[laps['Driver'].isin(drivers)]
+    laps = laps.sort_values(['DriverNumber', 'LapNumber']).reset_index(drop=True)
+
+    times = np.full((len(laps), n_sectors), np.nan)
+    with stage('minisectors', laps=len(laps), rows=len(laps) * n_sectors):
+        for number, rows in laps.groupby('DriverNumber', observed=True).indices.items():
+            telemetry = session.car_data.get(str(number))
+            if telemetry is None or len(telemetry) < 2:
+                continue
+            seconds, distance = driver_distance(telemetry)
+            start, end = lap_windows(laps.iloc[rows])
+            times[rows] = np.diff(boundary_times(seconds, distance, start, end, n_sectors), axis=1)
+
+    table = laps[['Driver', 'Team', 'LapNumber', 'LapTime']].copy()
+    table['Clean'] = (laps['PitInTime'].isna() & laps['PitOutTime'].isna()).to_numpy()
+    return table, times
+
+
+def best_minisectors(table, times):
+    '''Every driver's best time in every mini-sector over their clean laps,
+    as a frame of drivers x mini-sectors (numbered from 1)'''
+    clean = table['Clean'].to_numpy()
+    best = pd.DataFrame(times[clean], columns=np.arange(1, times.shape[1] + 1))
+    best.columns.name = 'MiniSector'
+    return best.groupby(table['Driver'].to_numpy()[clean]).min()
+
+
+def minisector_winners(table, times, by='Driver'):
+    '''Fastest driver (or team, by='Team') in every mini-sector, its time and
+    the margin to the next fastest'''
+    best = best_minisectors(table, times)
+    if by == 'Team':
+        teams = table.drop_duplicates('Driver').set_index('Driver')['Team']
+        best = best.groupby(teams.reindex(best.index).to_numpy()).min()
+    elif by != 'Driver':
+        raise ValueError(f"by must be 'Driver' or 'Team', not {by!r}")
+
+    ordered = np.sort(best.to_numpy(), axis=0)
+    margin = ordered[1] - ordered[0] if len(best) > 1 else np.full(best.shape[1], np.nan)
+    return pd.DataFrame({
+        'MiniSector': best.columns,
+        by: best.idxmin().to_numpy(),
+        'Seconds': ordered[0],
+        'Margin': margin,
+    })
+
+
+@instrumented()
+@needs_streams('laps', 'car_data')
+def theoretical_best(session, drivers=None, n_sectors=MINISECTORS):
+    '''Every driver's fastest lap next to the sum of their best mini-sectors
+    over all clean laps, and the time left on the table (seconds)'''
+    table, times = minisector_times(session, n_sectors, drivers)
+    best = best_minisectors(table, times)
+
+    clean = table.loc[table['Clean']]
+    fastest = clean.groupby('Driver', observed=True)['LapTime'].min().dt.total_seconds()
+    teams = table.drop_duplicates('Driver').set_index('Driver')['Team']
+    result = pd.DataFrame({
+        'Driver': best.index,
+        'Team': teams.reindex(best.index).to_numpy(),
+        'BestLap': fastest.reindex(best.index).to_numpy(),
+        # min_count, a driver missing a mini-sector has no theoretical best
+        'TheoreticalBest': best.sum(axis=1, min_count=n_sectors).to_numpy(),
+    })
+    result['Gain'] = result['BestLap'] - result['TheoreticalBest']
+    return result.sort_values('TheoreticalBest').reset_index(drop=True)
+
+
+@instrumented()
+@needs_streams('laps', 'car_data', 'pos_data')
+def minisector_dominance(session, output=None, dpi=None, n_sectors=MINISECTORS, by='Team'):
+    '''Track map coloured by the fastest team (or driver, by='Driver') in
+    every mini-sector over all clean laps of the session'''
+    import matplotlib as mpl
+    from matplotlib.collections import LineCollection
+    from fastf1 import plotting as ff1_plotting
+    from driver_comparisons import distinct_colors
+
+    plt = pyplot()
+    table, times = minisector_times(session, n_sectors)
+    winners = minisector_winners(table, times, by=by)
+
+    # The track as driven on the fastest lap, every point in its mini-sector
+    with stage('get_telemetry') as event:
+        telemetry = session.laps.pick_fastest().get_telemetry()
+        event['rows'] = len(telemetry)
+    distance = telemetry['Distance'].to_numpy(dtype=float)
+    sector = np.clip((distance / distance[-1] * n_sectors).astype(int), 0, n_sectors - 1)
+    points = np.column_stack([telemetry['X'].to_numpy(), telemetry['Y'].to_numpy()]).reshape(-1, 1, 2)
+    segments = np.concatenate([points[:-1], points[1:]], axis=1)
+
+    names = list(pd.unique(winners[by]))
+    if by == 'Team':
+        colors = [ff1_plotting.team_color(team) for team in names]
+    else:
+        teams = table.drop_duplicates('Driver').set_index('Driver')['Team']
+        colors = distinct_colors(teams.reindex(names).tolist())
+    color_of = dict(zip(names, colors))
+    segment_colors = winners[by].map(color_of).to_numpy()[sector[:-1]]
+
+    fig, ax = plt.subplots(figsize=(12, 6.75))
+    fig.suptitle(f'{session.event.year} {session.event.EventName} - {session.name} - '
+                 f'Fastest {by.lower()} per mini-sector', size=20, y=0.97)
+    fig.subplots_adjust(left=0.1, right=0.9, top=0.9, bottom=0.12)
+    ax.axis('off')
+
+    ax.plot(telemetry['X'], telemetry['Y'], color='black', linestyle='-', linewidth=16, zorder=0)
+    ax.add_collection(LineCollection(segments, colors=segment_colors, linestyle='-', linewidth=5))
+    ax.set_aspect('equal')
+
+    handles = [mpl.lines.Line2D([0], [0], color=color_of[name], linewidth=5) for name in names]
+    ax.legend(handles, names, loc='upper center', bbox_to_anchor=(0.5, 0.02), ncol=min(len(names), 5),
+              frameon=False)
+
+    return finish_figure(fig, output, dpi)
+
+
+def main(argv=None):
+    import time
+
+    parser = argparse.ArgumentParser(description='Mini-sector dominance and theoretical best laps')
+    parser.add_argument('year', type=int)
+    parser.add_argument('grand_prix')
+    parser.add_argument('session')
+    parser.add_argument('--sectors', type=int, default=MINISECTORS)
+    parser.add_argument('--by', choices=('Team', 'Driver'), default='Team')
+    parser.add_argument('--output', help='file for the dominance map, default: show it')
+    args = parser.parse_args(argv)
+
+    from driver_comparisons import get_session
+    session = get_session(args.year, args.grand_prix, args.session)
+    session.load_streams('laps', 'car_data', 'pos_data')
+
+    started = time.perf_counter()
+    best = theoretical_best(session, n_sectors=args.sectors)
+    print(f'{len(session.laps)} laps in {time.perf_counter() - started:.2f} s')
+    print(best.round(3).to_string(index=False))
+    minisector_dominance(session, output=args.output, n_sectors=args.sectors, by=args.by)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
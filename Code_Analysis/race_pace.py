@@ -0,0 +1,173 @@
+# race_pace.py
+# Race pace per stint: tyre degradation and fuel-corrected pace.
+#
+# Fastest laps say little about who could have won a race. Here every
+# driver's race is split into stints, laps that don't show pace (lap 1,
+# in/out laps, safety car and yellow flag laps, slow outliers) are dropped,
+# the fuel burnt is corrected for and a line lap time = pace + degradation *
+# tyre age is fitted to every stint. All stints are solved together from their
+# stacked normal equations instead of one fit per stint.
+
+import warnings
+
+import numpy as np
+import pandas as pd
+
+from lazy_session import needs_streams
+from render import finish_figure, pyplot
+from instrumentation import instrumented
+
+
+# Seconds a lap gets faster per lap of fuel burnt (~1.7 kg/lap at ~0.035 s/kg)
+FUEL_CORRECTION = 0.06
+
+# Track status codes other than green: yellow, SC, red flag, VSC, VSC ending
+NOT_GREEN = '[2-7]'
+
+# Laps slower than this factor times the driver's median clean lap are dropped
+SLOW_LAP_FACTOR = 1.07
+
+# Stints with fewer clean laps than this are not fitted
+MIN_STINT_LAPS = 3
+
+# Columns of stint_pace_table
+STINT_COLUMNS = ['Driver', 'Team', 'Stint', 'Compound', 'FirstLap', 'LastLap', 'Laps',
+                 'Pace', 'Degradation', 'MeanPace', 'ResidualStd']
+
+
+def clean_race_laps(laps, slow_lap_factor=SLOW_LAP_FACTOR):
+    '''Laps that show race pace: timed, not the opening lap, not an in or out
+    lap, fully under green flag and not a slow outlier for that driver'''
+    laps = pd.DataFrame(laps)
+    keep = laps['LapTime'].notna() & laps['Stint'].notna() & (laps['LapNumber'] > 1)
+    keep &= laps['PitInTime'].isna() & laps['PitOutTime'].isna()
+    if 'TrackStatus' in laps.columns:
+        keep &= ~laps['TrackStatus'].astype(str).str.contains(NOT_GREEN)
+
+    clean = laps.loc[keep].copy()
+    clean['LapSeconds'] = clean['LapTime'].dt.total_seconds()
+
+    median = clean.groupby('Driver', observed=True)['LapSeconds'].transform('median')
+    return clean.loc[clean['LapSeconds'] <= median * slow_lap_factor]
+
+
+def fuel_corrected(lap_number, lap_seconds, race_laps, correction=FUEL_CORRECTION):
+    '''Lap time as if the car carried the fuel of the last lap'''
+    return lap_seconds - correction * (race_laps - lap_number)
+
+
+def fit_stints(stint_ids, tyre_life, seconds):
+    '''Least squares seconds = pace + degradation * tyre_life for every stint
+    at once. stint_ids are 0..n-1. Returns pace, degradation and residual
+    standard deviation per stint (nan where a stint can't be fitted)'''
+    n_stints = stint_ids.max() + 1 if len(stint_ids) else 0
+
+    # Sums of the normal equations of all stints in one bincount each
+    def total(weights):
+        return np.bincount(stint_ids, weights=weights, minlength=n_stints)
+
+    count = total(None)
+    xtx = np.empty((n_stints, 2, 2))
+    xtx[:, 0, 0] = count
+    xtx[:, 0, 1] = xtx[:, 1, 0] = total(tyre_life)
+    xtx[:, 1, 1] = total(tyre_life ** 2)
+    xty = np.column_stack([total(seconds), total(tyre_life * seconds)])
+
+    # Stints with a single tyre age (or too few laps) have no slope
+    solvable = np.abs(np.linalg.det(xtx)) > 1e-9
+    coefficients = np.full((n_stints, 2), np.nan)
+    coefficients[solvable] = np.linalg.solve(xtx[solvable], xty[solvable][..., None])[..., 0]
+
+    residuals = seconds - coefficients[stint_ids, 0] - coefficients[stint_ids, 1] * tyre_life
+    dof = np.maximum(count - 2, 1)
+    residual_std = np.sqrt(total(residuals ** 2) / dof)
+
+    return coefficients[:, 0], coefficients[:, 1], residual_std
+
+
+def stint_pace_table(laps, min_laps=MIN_STINT_LAPS, correction=FUEL_CORRECTION,
+                     slow_lap_factor=SLOW_LAP_FACTOR):
+    '''One row per driver and stint with compound, clean laps, fresh-tyre pace,
+    degradation per lap of tyre age and mean fuel-corrected pace (seconds).
+    Also returns the clean laps with their FuelCorrected time and Fit'''
+    race_laps = pd.DataFrame(laps)['LapNumber'].max()
+    clean = clean_race_laps(laps, slow_lap_factor)
+    clean['FuelCorrected'] = fuel_corrected(clean['LapNumber'], clean['LapSeconds'], race_laps, correction)
+
+    clean['StintLaps'] = clean.groupby(['Driver', 'Stint'], observed=True)['LapNumber'].transform('size')
+    clean = clean.loc[clean['StintLaps'] >= min_laps].reset_index(drop=True)
+    if clean.empty:
+        # e.g. the first laps of a race, before any stint has enough clean laps
+        return pd.DataFrame(columns=STINT_COLUMNS), clean
+
+    stint_ids, stints = pd.factorize(pd.MultiIndex.from_frame(clean[['Driver', 'Stint']]))
+    tyre_life = clean['TyreLife'].to_numpy(dtype=float)
+    pace, degradation, residual_std = fit_stints(stint_ids, tyre_life, clean['FuelCorrected'].to_numpy(dtype=float))
+    clean['Fit'] = pace[stint_ids] + degradation[stint_ids] * tyre_life
+
+    grouped = clean.groupby(stint_ids)
+    table = pd.DataFrame({
+        'Driver': stints.get_level_values(0),
+        'Team': grouped['Team'].first().to_numpy(),
+        'Stint': stints.get_level_values(1).astype(int),
+        'Compound': grouped['Compound'].first().to_numpy(),
+        'FirstLap': grouped['LapNumber'].min().to_numpy().astype(int),
+        'LastLap': grouped['LapNumber'].max().to_numpy().astype(int),
+        'Laps': grouped.size().to_numpy(),
+        'Pace': pace,
+        'Degradation': degradation,
+        'MeanPace': grouped['FuelCorrected'].mean().to_numpy(),
+        'ResidualStd': residual_std,
+    })
+    return table.sort_values(['MeanPace']).reset_index(drop=True), clean
+
+
+@instrumented()
+@needs_streams('laps')
+def race_pace_table(session, drivers=None, min_laps=MIN_STINT_LAPS):
+    '''stint_pace_table of a race session, optionally for some drivers only'''
+    laps = session.laps
+    if drivers:
+        laps = laps.loc[laps['Driver'].isin(drivers)]
+    table, _ = stint_pace_table(laps, min_laps)
+    return table
+
+
+@instrumented()
+@needs_streams('laps')
+def race_pace(drivers, session, min_laps=MIN_STINT_LAPS, output=None, dpi=None):
+    '''Fuel-corrected lap times of the drivers with the fitted degradation line
+    of every stint (race_pace_table has the numbers). See
+    render.finish_figure for output'''
+    from matplotlib.lines import Line2D
+    from driver_comparisons import distinct_colors
+
+    drivers = list(drivers)
+    missing = [driver for driver in drivers if driver not in set(session.laps['Driver'])]
+    if len(missing) == len(drivers):
+        raise ValueError(f'None of {drivers} has laps in this session')
+    if missing:
+        warnings.warn(f'Left out {missing}, they have no laps in this session')
+        drivers = [driver for driver in drivers if driver not in missing]
+
+    plt = pyplot()
+    laps = session.laps.loc[session.laps['Driver'].isin(drivers)]
+    _, clean = stint_pace_table(laps, min_laps)
+    teams = [laps.loc[laps['Driver'] == driver, 'Team'].iloc[0] for driver in drivers]
+    colors = dict(zip(drivers, distinct_colors(teams)))
+
+    fig, ax = plt.subplots(figsize=(12, 6.75))
+    for (driver, stint), stint_laps in clean.groupby(['Driver', 'Stint'], sort=False, observed=True):
+        ax.scatter(stint_laps['LapNumber'], stint_laps['FuelCorrected'], s=12,
+                   color=colors[driver], alpha=0.6)
+        ax.plot(stint_laps['LapNumber'], stint_laps['Fit'], color=colors[driver], linewidth=2)
+
+    handles = [Line2D([], [], color=colors[driver], linewidth=2, label=driver) for driver in drivers]
+    ax.legend(handles=handles)
+    ax.set_xlabel('Lap')
+    ax.set_ylabel(f'Fuel-corrected lap time [s] ({FUEL_CORRECTION} s/lap)')
+    ax.grid(True, linestyle='--', alpha=0.5)
+    fig.suptitle(f"{session.event['EventName']} {session.event.year} - Race pace\n"
+                 f"{' vs '.join(drivers)}")
+
+    return finish_figure(fig, output, dpi)
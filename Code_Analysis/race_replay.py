@@ -0,0 +1,344 @@
+# race_replay.py
+# Animated replay of a whole race: every car as a dot on the track outline.
+#
+# Position data comes at its own irregular rate per car. Before anything is
+# drawn, all drivers are resampled onto one fixed-rate timeline in a single
+# vectorized pass (one searchsorted over the position data of all cars), so a
+# frame is just a row of a frames x drivers x 2 array. On screen only the car
+# markers, labels and the clock are redrawn per frame (blitting), the track is
+# drawn once. Exports stream every frame straight into ffmpeg, so a full race
+# never sits in memory as images.
+#
+# Example:
+#   python race_replay.py 2022 Monaco R --speed 20 --output monaco.mp4
+#   python race_replay.py 2022 Monaco R --measure
+
+import sys
+import time
+import argparse
+import warnings
+
+import numpy as np
+import pandas as pd
+
+from lazy_session import needs_streams
+from render import pyplot
+from instrumentation import instrumented, stage
+
+
+# Frames per second of the replay, and seconds of racing per second of replay
+DEFAULT_FPS = 30
+DEFAULT_SPEED = 20
+
+# A car without position samples for longer than this is hidden (retired, in the garage)
+MAX_GAP = 10.0
+
+# Points of the track outline
+OUTLINE_POINTS = 600
+
+
+def replay_timeline(laps, fps=DEFAULT_FPS, speed=DEFAULT_SPEED):
+    '''Session time (seconds) of every frame, from the start of the first lap
+    to the end of the last one, speed seconds of racing per second of replay'''
+    laps = pd.DataFrame(laps)
+    start = laps['LapStartTime'].min()
+    if pd.isna(start):
+        start = (laps['Time'] - laps['LapTime']).min()
+    end = laps['Time'].max()
+    return np.arange(start.total_seconds(), end.total_seconds(), speed / fps)
+
+
+def resample_positions(pos_data, drivers, timeline, max_gap=MAX_GAP):
+    '''X and Y of every driver at every time of the timeline, linearly
+    interpolated, as a float32 array of frames x drivers x 2. NaN before a
+    driver's first sample, after the last one and inside gaps longer than max_gap.
+
+    All drivers are done in one pass: their sample times are laid end to end,
+    each shifted by its own offset so the whole thing stays sorted, and the
+    timeline (shifted the same way per driver) is looked up with a single
+    searchsorted'''
+    timeline = np.asarray(timeline, dtype=float)
+    times, xs, ys, lengths = list(), list(), list(), list()
+    for drv in drivers:
+        telemetry = pos_data.get(drv)
+        if telemetry is None or len(telemetry) == 0:
+            lengths.append(0)
+            continue
+        seconds = telemetry['SessionTime'].dt.total_seconds().to_numpy()
+        order = np.argsort(seconds, kind='stable')
+        times.append(seconds[order])
+        xs.append(telemetry['X'].to_numpy(dtype=float)[order])
+        ys.append(telemetry['Y'].to_numpy(dtype=float)[order])
+        lengths.append(len(seconds))
+
+    n_drivers, n_frames = len(drivers), len(timeline)
+    positions = np.full((n_frames, n_drivers, 2), np.nan, dtype=np.float32)
+    if not times or n_frames == 0:
+        return positions
+
+    lengths = np.array(lengths)
+    all_times, all_x, all_y = np.concatenate(times), np.concatenate(xs), np.concatenate(ys)
+    low = min(all_times.min(), timeline.min())
+    span = max(all_times.max(), timeline.max()) - low + 2 * max_gap + 1
+    # shift driver k by k * span, so every driver's samples come after the previous one's
+    shift = np.repeat(np.arange(n_drivers) * span, lengths)
+    all_times = all_times - low + shift
+
+    first = np.concatenate([[0], np.cumsum(lengths)[:-1]])
+    last = first + lengths - 1
+    query = (timeline - low)[None, :] + (np.arange(n_drivers) * span)[:, None]
+
+    right = np.searchsorted(all_times, query.ravel(), side='right').reshape(n_drivers, n_frames)
+    right = np.clip(right, (first + 1)[:, None], np.maximum(last, first + 1)[:, None])
+    right = np.minimum(right, len(all_times) - 1)
+    left = right - 1
+
+    t_left, t_right = all_times[left], all_times[right]
+    interval = t_right - t_left
+    with np.errstate(invalid='ignore', divide='ignore'):
+        weight = np.clip((query - t_left) / interval, 0, 1)
+    x = all_x[left] + weight * (all_x[right] - all_x[left])
+    y = all_y[left] + weight * (all_y[right] - all_y[left])
+
+    valid = (lengths >= 2)[:, None] \
+        & (query >= all_times[first][:, None]) & (query <= all_times[last][:, None]) \
+        & (interval <= max_gap)
+    positions[..., 0] = np.where(valid, x, np.nan).T
+    positions[..., 1] = np.where(valid, y, np.nan).T
+    return positions
+
+
+def leader_laps(laps, timeline):
+    '''The lap the leader is on at every time of the timeline'''
+    laps = pd.DataFrame(laps)
+    # The first car to complete lap n does so at the earliest Time of lap n
+    completed = laps.groupby('LapNumber')['Time'].min().dropna().sort_index()
+    seconds = completed.dt.total_seconds().to_numpy()
+    lap = np.searchsorted(seconds, timeline, side='right') + 1
+    return np.minimum(lap, int(laps['LapNumber'].max()))
+
+
+def track_outline(session, points=OUTLINE_POINTS):
+    '''X and Y of the track from the position data of the fastest lap'''
+    from track_decimation import decimate_line
+
+    position = session.laps.pick_fastest().get_pos_data()
+    return decimate_line(position['X'].to_numpy(), position['Y'].to_numpy(), points)
+
+
+def _clock(seconds):
+    seconds = int(max(seconds, 0))
+    return f'{seconds // 3600}:{seconds // 60 % 60:02d}:{seconds % 60:02d}'
+
+
+def _label_collection(ax, names, colors, offsets):
+    '''Driver labels as one collection of text outlines next to the cars.
+    Twenty Text artists take most of a frame to lay out and draw, one
+    collection of paths is drawn in a single call'''
+    from matplotlib.collections import Collection, PathCollection
+    from matplotlib.textpath import TextPath
+    from matplotlib.transforms import Affine2D
+
+    paths = [TextPath((6, 6), name, size=8, prop={'weight': 'bold'}) for name in names]
+    # Paths are in points, placed at data coordinates. The keyword was called
+    # transOffset before matplotlib 3.6
+    offset_keyword = 'offset_transform' if hasattr(Collection, 'set_offset_transform') else 'transOffset'
+    labels = PathCollection(paths, offsets=offsets, transform=Affine2D().scale(ax.figure.dpi / 72),
+                            facecolors=colors, edgecolors='none', zorder=4, animated=True,
+                            **{offset_keyword: ax.transData})
+    # Labels of cars on the edge of the track map may stick out of the axes
+    labels.set_clip_on(False)
+    ax.add_collection(labels, autolim=False)
+    return labels
+
+
+class RaceReplay:
+    '''The frames of a race replay and the figure to play them in. Positions
+    of all frames are computed up front, drawing a frame only moves the
+    markers, labels and clock'''
+
+    def __init__(self, session, fps=DEFAULT_FPS, speed=DEFAULT_SPEED, drivers=None, labels=True,
+                 figsize=(10, 7.5)):
+        from driver_comparisons import distinct_colors
+
+        laps = session.laps
+        self.session = session
+        self.fps = fps
+        self.speed = speed
+        self.labels = labels
+        self.figsize = figsize
+
+        # pos_data is keyed by driver number, labels use the abbreviation
+        numbers = pd.DataFrame(laps).drop_duplicates('DriverNumber').set_index('DriverNumber')
+        if drivers is not None:
+            abbreviations = dict(zip(numbers['Driver'], numbers.index))
+            drivers = [abbreviations.get(driver, driver) for driver in drivers]
+        self.drivers = [str(drv) for drv in (drivers or numbers.index)]
+        self.abbreviations = [str(numbers.loc[drv, 'Driver']) for drv in self.drivers]
+        self.colors = distinct_colors([numbers.loc[drv, 'Team'] for drv in self.drivers])
+
+        with stage('replay.resample', drivers=len(self.drivers)) as event:
+            self.timeline = replay_timeline(laps, fps, speed)
+            self.positions = resample_positions(session.pos_data, self.drivers, self.timeline)
+            self.laps = leader_laps(laps, self.timeline)
+            self.total_laps = int(pd.DataFrame(laps)['LapNumber'].max())
+            event['rows'] = len(self.timeline)
+
+        self.fig = None
+        self._artists = list()
+
+    def __len__(self):
+        return len(self.timeline)
+
+    def figure(self):
+        '''Draws the static part (track, title) and creates the moving artists'''
+        plt = pyplot()
+        x, y = track_outline(self.session)
+
+        fig, ax = plt.subplots(figsize=self.figsize)
+        fig.patch.set_facecolor('black')
+        ax.set_facecolor('black')
+        ax.plot(x, y, color='grey', linewidth=8, alpha=0.5, solid_capstyle='round')
+        ax.set_aspect('equal')
+        ax.axis('off')
+        fig.suptitle(f"{self.session.event['EventName']} {self.session.event.year} - "
+                     f"{self.session.name}", color='white')
+
+        # Moving artists are animated: left out of normal draws and blitted instead
+        start = np.repeat([[x[0], y[0]]], len(self.drivers), axis=0)
+        self._cars = ax.scatter(start[:, 0], start[:, 1], s=80, c=self.colors, edgecolors='white',
+                                linewidths=0.8, zorder=3, animated=True)
+        self._moving = [self._cars]
+        if self.labels:
+            self._labels = _label_collection(ax, self.abbreviations, self.colors, start)
+            self._moving.append(self._labels)
+        self._clock = ax.text(0.01, 0.98, '', transform=ax.transAxes, color='white',
+                              fontsize=12, va='top', family='monospace', animated=True)
+
+        self.fig = fig
+        self._artists = [*self._moving, self._clock]
+        return fig
+
+    def update(self, frame):
+        '''Moves everything to a frame, returns the artists that changed.
+        Cars without a position (NaN) are not drawn'''
+        positions = self.positions[frame]
+        for collection in self._moving:
+            collection.set_offsets(positions)
+        self._clock.set_text(f'Lap {self.laps[frame]}/{self.total_laps}  '
+                             f'{_clock(self.timeline[frame] - self.timeline[0])}')
+        return self._artists
+
+    def animate(self):
+        '''A blitted FuncAnimation playing the replay at fps. Keep a reference
+        to it while it plays'''
+        from matplotlib.animation import FuncAnimation
+
+        fig = self.fig or self.figure()
+        return FuncAnimation(fig, self.update, frames=len(self), init_func=lambda: self.update(0),
+                             interval=1000 / self.fps, blit=True, cache_frame_data=False)
+
+    def save(self, path, dpi=100, frames=None, writer=None):
+        '''Streams the replay into a video: mp4 (or gif) through ffmpeg. Without
+        ffmpeg a gif falls back to pillow, which keeps every frame in memory.
+        frames limits the replay to a range of frames. Returns the path'''
+        from matplotlib import animation
+
+        fig = self.fig or self.figure()
+        if writer is None:
+            if animation.FFMpegWriter.isAvailable():
+                writer = animation.FFMpegWriter(fps=self.fps)
+            elif path.lower().endswith('.gif'):
+                warnings.warn('ffmpeg not found, pillow keeps all gif frames in memory')
+                writer = animation.PillowWriter(fps=self.fps)
+            else:
+                raise RuntimeError('Saving a replay needs ffmpeg (or a .gif path for pillow)')
+
+        frames = range(len(self)) if frames is None else frames
+        # grab_frame draws the whole figure, so the moving artists have to be part of it
+        for artist in self._artists:
+            artist.set_animated(False)
+        try:
+            with stage('replay.save', output=path, rows=len(frames)), writer.saving(fig, path, dpi):
+                for frame in frames:
+                    self.update(frame)
+                    writer.grab_frame(facecolor=fig.get_facecolor())
+        finally:
+            for artist in self._artists:
+                artist.set_animated(True)
+        return path
+
+    def measure_fps(self, frames=300):
+        '''Frames per second of blitted drawing on this machine: restore the
+        background, draw the moving artists, blit. Returns the mean and the
+        worst (slowest frame) rate'''
+        fig = self.fig or self.figure()
+        canvas = fig.canvas
+        canvas.draw()
+        background = canvas.copy_from_bbox(fig.bbox)
+
+        durations = list()
+        for frame in np.linspace(0, len(self) - 1, min(frames, len(self))).astype(int):
+            started = time.perf_counter()
+            canvas.restore_region(background)
+            for artist in self.update(frame):
+                fig.draw_artist(artist)
+            canvas.blit(fig.bbox)
+            durations.append(time.perf_counter() - started)
+
+        durations = np.array(durations)
+        return {'frames': len(durations), 'mean_fps': 1 / durations.mean(), 'worst_fps': 1 / durations.max()}
+
+    def close(self):
+        if self.fig is not None:
+            pyplot().close(self.fig)
+            self.fig = None
+
+
+@instrumented()
+@needs_streams('laps', 'pos_data')
+def race_replay(session, output=None, fps=DEFAULT_FPS, speed=DEFAULT_SPEED, drivers=None, dpi=100):
+    '''Replays the race: plays it on screen with output=None (returns the
+    animation, keep it alive while it plays) or writes a video to output
+    (.mp4 or .gif, returns the path)'''
+    replay = RaceReplay(session, fps=fps, speed=speed, drivers=drivers)
+    if output is None:
+        animation = replay.animate()
+        pyplot().show()
+        return animation
+    try:
+        return replay.save(output, dpi=dpi)
+    finally:
+        replay.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Replay a race on the track map')
+    parser.add_argument('year', type=int)
+    parser.add_argument('grand_prix')
+    parser.add_argument('session')
+    parser.add_argument('--fps', type=int, default=DEFAULT_FPS)
+    parser.add_argument('--speed', type=float, default=DEFAULT_SPEED,
+                        help='seconds of racing per second of replay')
+    parser.add_argument('--drivers', nargs='*', help='default: everyone')
+    parser.add_argument('--output', help='.mp4 or .gif file, default: play on screen')
+    parser.add_argument('--dpi', type=int, default=100)
+    parser.add_argument('--measure', action='store_true', help='only measure the blitted frame rate')
+    args = parser.parse_args(argv)
+
+    from driver_comparisons import get_session
+    session = get_session(args.year, args.grand_prix, args.session)
+
+    if args.measure:
+        session.load_streams('laps', 'pos_data')
+        replay = RaceReplay(session, fps=args.fps, speed=args.speed, drivers=args.drivers)
+        print(f'{len(replay)} frames', replay.measure_fps())
+        return 0
+
+    race_replay(session, output=args.output, fps=args.fps, speed=args.speed,
+                drivers=args.drivers, dpi=args.dpi)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,449 @@
+# race_simulator.py
+# Monte Carlo "what if" race simulator seeded from the laps of a race.
+#
+# Would a driver have beaten a rival if the race had run cleanly, or if they
+# hadn't retired? A RaceModel is fitted to the race: every driver's pace and
+# tyre degradation per stint (race_pace.stint_pace_table), their lap time
+# noise, the fuel effect, the time lost in the pits, their strategy as raced,
+# the grid, and the safety car periods and retirements that happened. The
+# simulator then races it again thousands of times with safety cars and
+# retirements kept, removed or injected.
+#
+# Runs are simulated in chunks as arrays of runs x drivers x laps: lap times are
+# drawn for all of them at once and summed with one cumsum. Safety car
+# restarts bunch the field up, which is applied once per restart over all runs
+# instead of lap by lap. Scenarios (and chunks of runs) are spread over a
+# process pool. Cars don't fight for position: the order is the order of their
+# race times, so the results answer "who was faster over the race".
+#
+# Example:
+#   python race_simulator.py 2022 Monaco R --driver LEC --rival VER
+#   python race_simulator.py 2022 Monaco R --runs 50000 --processes 8
+
+import sys
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+from lazy_session import needs_streams
+from instrumentation import instrumented, stage
+from race_pace import FUEL_CORRECTION, NOT_GREEN, clean_race_laps, stint_pace_table
+
+
+# Simulated races per scenario, and races simulated together in one array
+DEFAULT_RUNS = 10000
+RUN_CHUNK = 2000
+
+# Laps under safety car or virtual safety car take this much longer, and a
+# pit stop under either costs this share of a green flag one
+SC_LAP_FACTOR = 1.4
+VSC_LAP_FACTOR = 1.3
+NEUTRALISED_PIT_FACTOR = 0.55
+
+# Seconds between cars when the safety car comes in, and the length (laps) of
+# an injected safety car period
+SC_GAP = 0.8
+SC_LAPS = 4
+
+# Seconds between grid slots crossing the line, used when the lap 1 time is missing
+GRID_SLOT_SECONDS = 0.2
+START_LOSS = 4.0
+
+# Fallbacks when a race doesn't show them: pit lane time loss (seconds) and lap time noise
+PIT_LOSS = 22.0
+MIN_LAP_NOISE = 0.1
+
+# Standard deviation (seconds per lap) of a driver's pace from race to race
+PACE_UNCERTAINTY = 0.1
+
+# Finishing positions that score points
+POINTS_POSITIONS = 10
+
+# Scenarios of what_if, as simulate() arguments
+SCENARIOS = {
+    'as raced': {},
+    'no safety car': {'safety_car': 'none'},
+    'no retirements': {'retirements': 'none'},
+    'clean race': {'safety_car': 'none', 'retirements': 'none'},
+    'random incidents': {'safety_car': 'none', 'retirements': 'none',
+                         'sc_probability': 0.015, 'dnf_probability': 0.05},
+}
+
+
+def neutralised_laps(laps):
+    '''Lap numbers run (partly) under safety car and under virtual safety car'''
+    laps = pd.DataFrame(laps)
+    if 'TrackStatus' not in laps.columns:
+        return set(), set()
+    status = laps['TrackStatus'].astype(str)
+    safety_car = set(laps.loc[status.str.contains('4'), 'LapNumber'].astype(int))
+    virtual = set(laps.loc[status.str.contains('[67]'), 'LapNumber'].astype(int)) - safety_car
+    return safety_car, virtual
+
+
+def retirements(session, laps):
+    '''{driver: laps completed} of the drivers that didn't finish. The results
+    say who retired; lapped cars (Status "+1 Lap") finished'''
+    results = getattr(session, 'results', None)
+    if results is None or 'Status' not in results.columns:
+        return dict()
+    finished = results['Status'].astype(str).str.match(r'(Finished|\+\d+ Laps?)$')
+    retired = results.loc[~finished, 'Abbreviation'].astype(str)
+    completed = pd.DataFrame(laps).groupby('Driver', observed=True)['LapNumber'].max()
+    return {driver: int(completed.get(driver, 0)) for driver in retired}
+
+
+def grid_order(session, laps, drivers):
+    '''Grid position of every driver, from the results or else the order on
+    lap 1. Pit lane starters (grid position 0) start behind everyone else'''
+    results = getattr(session, 'results', None)
+    if results is not None and 'GridPosition' in results.columns:
+        grid = results.set_index(results['Abbreviation'].astype(str))['GridPosition']
+        grid = grid.reindex(drivers)
+        if grid.notna().all() and (grid > 0).any():
+            grid = grid.replace(0, grid.max() + 1)
+            return grid.rank(method='first').to_numpy()
+    first = pd.DataFrame(laps).loc[lambda frame: frame['LapNumber'] == 1].set_index('Driver')['Time']
+    first = first.reindex(drivers).dt.total_seconds()
+    return first.rank(method='first', na_option='bottom').to_numpy()
+
+
+class RaceModel:
+    '''Everything simulate needs, as arrays of drivers x laps: the expected lap
+    time (pace, degradation, fuel, start) and where each driver pits, plus
+    per driver lap noise, grid offset and retirement lap'''
+
+    def __init__(self, drivers, teams, base, pit, noise, grid_offset, pit_loss,
+                 safety_car=(), virtual_safety_car=(), retired=None):
+        self.drivers = list(drivers)
+        self.teams = list(teams)
+        self.base = np.asarray(base, dtype=float)
+        self.pit = np.asarray(pit, dtype=float)
+        self.noise = np.asarray(noise, dtype=float)
+        self.grid_offset = np.asarray(grid_offset, dtype=float)
+        self.pit_loss = float(pit_loss)
+        self.safety_car = set(safety_car)
+        self.virtual_safety_car = set(virtual_safety_car)
+        self.retired = dict(retired or dict())
+
+    @property
+    def race_laps(self):
+        return self.base.shape[1]
+
+    @classmethod
+    def from_session(cls, session, correction=FUEL_CORRECTION):
+        '''Fits the model to a race session'''
+        laps = pd.DataFrame(session.laps)
+        race_laps = int(laps['LapNumber'].max())
+        drivers = list(pd.unique(laps.sort_values('LapNumber')['Driver'].astype(str)))
+        teams = laps.drop_duplicates('Driver').set_index('Driver')['Team'].reindex(drivers)
+
+        stints, _ = stint_pace_table(laps, correction=correction)
+        clean = clean_race_laps(laps)
+        clean['FuelCorrected'] = clean['LapSeconds'] - correction * (race_laps - clean['LapNumber'])
+
+        # Fallbacks for stints too short to fit: the driver's own mean pace, and
+        # the field's typical degradation (per compound where it is known)
+        field_degradation = stints['Degradation'].median() if len(stints) else 0.0
+        compound_degradation = stints.groupby('Compound')['Degradation'].median()
+        driver_pace = stints.groupby('Driver')['Pace'].mean()
+        clean_pace = clean.groupby('Driver', observed=True)['FuelCorrected'].median()
+        slowest = clean_pace.max() if len(clean_pace) else 100.0
+        stint_fit = stints.set_index(['Driver', 'Stint'])[['Pace', 'Degradation']]
+        noise = stints.groupby('Driver')['ResidualStd'].median()
+        field_noise = noise.median() if len(noise) else MIN_LAP_NOISE
+
+        # A car retiring into the pits has a PitInTime on its last lap, that is no stop
+        retired = retirements(session, laps)
+        last_lap = laps['Driver'].astype(str).map(retired)
+        laps = laps.assign(PitInTime=laps['PitInTime'].mask(laps['LapNumber'] == last_lap))
+
+        stops = laps.loc[laps['PitInTime'].notna() & (laps['LapNumber'] < race_laps)]
+        first_stop = int(stops.groupby('Driver', observed=True)['LapNumber'].min().median()) \
+            if len(stops) else race_laps // 2
+
+        n_drivers = len(drivers)
+        base = np.zeros((n_drivers, race_laps))
+        pit = np.zeros((n_drivers, race_laps))
+        lap_numbers = np.arange(1, race_laps + 1)
+        for i, driver in enumerate(drivers):
+            own = laps.loc[laps['Driver'] == driver].drop_duplicates('LapNumber').set_index('LapNumber')
+            own = own.reindex(lap_numbers)
+            # After a retirement the car carries on with its last stint
+            stint = own['Stint'].ffill().fillna(1).to_numpy()
+            compound = own['Compound'].ffill().bfill()
+            tyre_life = own['TyreLife'].ffill().fillna(1).to_numpy()
+            raced = int(own['TyreLife'].last_valid_index() or 0)
+            tyre_life[raced:] += np.arange(1, race_laps - raced + 1)
+            pit[i] = own['PitInTime'].notna().to_numpy() & (lap_numbers < race_laps)
+
+            # ... and when it retired before its stop, stops when the field typically did
+            stop = max(raced + 1, first_stop)
+            if raced < race_laps and not pit[i].any() and stop < race_laps:
+                pit[i, stop - 1] = 1
+                stint[stop:] = stint.max() + 1
+                tyre_life[stop:] = np.arange(1, race_laps - stop + 1)
+
+            pace = np.full(race_laps, np.nan)
+            degradation = np.full(race_laps, np.nan)
+            for stint_number in np.unique(stint):
+                on_stint = stint == stint_number
+                if (driver, int(stint_number)) in stint_fit.index:
+                    pace[on_stint], degradation[on_stint] = stint_fit.loc[(driver, int(stint_number))]
+                else:
+                    pace[on_stint] = driver_pace.get(driver, clean_pace.get(driver, slowest))
+                    degradation[on_stint] = compound_degradation.get(compound[on_stint].iloc[0],
+                                                                     field_degradation)
+            degradation = np.nan_to_num(degradation, nan=field_degradation)
+            base[i] = pace + degradation * tyre_life + correction * (race_laps - lap_numbers)
+
+        start_loss, pit_loss = cls._losses(laps, drivers, base)
+        base[:, 0] += start_loss
+        grid = grid_order(session, laps, drivers)
+        safety_car, virtual = neutralised_laps(laps)
+        return cls(drivers, teams, base, pit,
+                   noise=np.maximum(noise.reindex(drivers).fillna(field_noise).to_numpy(), MIN_LAP_NOISE),
+                   grid_offset=(grid - 1) * GRID_SLOT_SECONDS, pit_loss=pit_loss,
+                   safety_car=safety_car, virtual_safety_car=virtual, retired=retired)
+
+    @staticmethod
+    def _losses(laps, drivers, base):
+        '''Seconds lost on the opening lap and in a pit stop (in lap plus out
+        lap) against the fitted lap times, medians over the field under green'''
+        def per_lap(column):
+            table = laps.drop_duplicates(['Driver', 'LapNumber']).pivot(index='Driver', columns='LapNumber',
+                                                                        values=column)
+            return table.reindex(index=drivers, columns=np.arange(1, base.shape[1] + 1))
+
+        laps = laps.assign(LapSeconds=laps['LapTime'].dt.total_seconds())
+        seconds = per_lap('LapSeconds').to_numpy(dtype=float)
+        if 'TrackStatus' in laps.columns:
+            green = ~per_lap('TrackStatus').apply(lambda column: column.astype(str).str.contains(NOT_GREEN))
+            green = green.to_numpy()
+        else:
+            green = np.ones(seconds.shape, dtype=bool)
+
+        start = seconds[:, 0] - base[:, 0]
+        start_loss = np.nanmedian(start) if np.isfinite(start).any() else START_LOSS
+
+        in_laps = laps.loc[laps['PitInTime'].notna(), ['Driver', 'LapNumber']]
+        losses = list()
+        for driver, lap in zip(in_laps['Driver'].astype(str), in_laps['LapNumber'].astype(int)):
+            if driver not in drivers or lap >= base.shape[1]:
+                continue
+            i = drivers.index(driver)
+            both = slice(lap - 1, lap + 1)
+            if green[i, both].all():
+                losses.append(np.sum(seconds[i, both] - base[i, both]))
+        losses = np.array(losses)
+        pit_loss = np.nanmedian(losses) if np.isfinite(losses).any() else PIT_LOSS
+        return start_loss, pit_loss
+
+    def driver_index(self, driver):
+        if driver not in self.drivers:
+            raise KeyError(f"Unknown driver '{driver}', expected one of {self.drivers}")
+        return self.drivers.index(driver)
+
+
+def _neutralised(model, runs, rng, safety_car, sc_probability):
+    '''Safety car and virtual safety car laps of every run (runs x laps)'''
+    n_laps = model.race_laps
+    sc = np.zeros((runs, n_laps), dtype=bool)
+    vsc = np.zeros((runs, n_laps), dtype=bool)
+    if safety_car == 'actual':
+        sc[:, [lap - 1 for lap in model.safety_car if lap <= n_laps]] = True
+        vsc[:, [lap - 1 for lap in model.virtual_safety_car if lap <= n_laps]] = True
+    elif safety_car not in ('none', None):
+        sc[:, [lap - 1 for lap in safety_car if 1 <= lap <= n_laps]] = True
+
+    if sc_probability:
+        # A deployment on a lap keeps the safety car out for SC_LAPS laps, never on lap 1
+        deployed = rng.random((runs, n_laps)) < sc_probability
+        deployed[:, 0] = False
+        started = np.cumsum(deployed, axis=1)
+        shifted = np.zeros_like(started)
+        shifted[:, SC_LAPS:] = started[:, :-SC_LAPS]
+        sc |= started - shifted > 0
+    # The last lap is never neutralised, there has to be a restart to bunch up
+    sc[:, -1] = False
+    return sc, vsc & ~sc
+
+
+def _completed_laps(model, runs, rng, retirements, dnf_probability):
+    '''Laps every driver completes in every run (runs x drivers), race_laps for finishers'''
+    n_laps = model.race_laps
+    completed = np.full((runs, len(model.drivers)), n_laps)
+    if retirements == 'actual':
+        retired = model.retired
+    elif retirements in ('none', None):
+        retired = dict()
+    else:
+        retired = dict(retirements)
+    for driver, laps_done in retired.items():
+        completed[:, model.driver_index(driver)] = min(int(laps_done), n_laps)
+
+    if dnf_probability:
+        out = rng.random(completed.shape) < dnf_probability
+        completed = np.where(out, np.minimum(completed, rng.integers(0, n_laps, completed.shape)), completed)
+    return completed
+
+
+def simulate(model, runs=DEFAULT_RUNS, seed=None, safety_car='actual', retirements='actual',
+             sc_probability=0.0, dnf_probability=0.0, pace_uncertainty=PACE_UNCERTAINTY, chunk=RUN_CHUNK):
+    '''Simulates runs races. Returns the finishing position (1 = winner) of
+    every driver in every run, as runs x drivers.
+
+    safety_car: 'actual' (as raced), 'none' or lap numbers to put it out on;
+    sc_probability adds a random deployment chance per lap on top.
+    retirements: 'actual', 'none' or {driver: laps completed}; dnf_probability
+    adds a random retirement chance per driver and race'''
+    rng = np.random.default_rng(seed)
+    positions = np.empty((runs, len(model.drivers)), dtype=np.int16)
+    with stage('simulate', rows=runs * len(model.drivers) * model.race_laps):
+        for first in range(0, runs, chunk):
+            size = min(chunk, runs - first)
+            positions[first:first + size] = _simulate_chunk(model, size, rng, safety_car, retirements,
+                                                            sc_probability, dnf_probability, pace_uncertainty)
+    return positions
+
+
+def _simulate_chunk(model, runs, rng, safety_car, retirements, sc_probability, dnf_probability,
+                    pace_uncertainty):
+    n_drivers, n_laps = model.base.shape
+    sc, vsc = _neutralised(model, runs, rng, safety_car, sc_probability)
+    completed = _completed_laps(model, runs, rng, retirements, dnf_probability)
+
+    # Lap times of every run: expected time, noise per lap and form per race
+    lap_times = model.base[None] + rng.standard_normal((runs, n_drivers, n_laps)) * model.noise[None, :, None]
+    lap_times += rng.standard_normal((runs, n_drivers, 1)) * pace_uncertainty
+    lap_times *= np.where(sc, SC_LAP_FACTOR, np.where(vsc, VSC_LAP_FACTOR, 1.0))[:, None, :]
+    lap_times += model.pit[None] * model.pit_loss * np.where(sc | vsc, NEUTRALISED_PIT_FACTOR, 1.0)[:, None, :]
+    elapsed = np.cumsum(lap_times, axis=2)
+    offset = np.broadcast_to(model.grid_offset, (runs, n_drivers)).copy()
+
+    # Every restart closes the field up behind the leader. Restarts are
+    # handled in order, all runs with a k-th restart at once
+    restarts = sc[:, :-1] & ~sc[:, 1:]
+    number = np.cumsum(restarts, axis=1) - 1
+    for k in range(int(restarts.sum(axis=1).max(initial=0))):
+        run, lap = np.nonzero(restarts & (number == k))
+        now = offset[run] + elapsed[run, :, lap]
+        running = completed[run] > lap[:, None]
+        now = np.where(running, now, np.inf)
+        rank = np.argsort(np.argsort(now, axis=1), axis=1)
+        bunched = now.min(axis=1)[:, None] + rank * SC_GAP
+        offset[run] = np.where(running, bunched - elapsed[run, :, lap], offset[run])
+
+    # Finishers by race time, then the retired cars by laps completed
+    last = np.clip(completed - 1, 0, n_laps - 1)
+    time_at_stop = offset + np.take_along_axis(elapsed, last[..., None], axis=2)[..., 0]
+    key = np.where(completed >= n_laps, time_at_stop, 1e9 + (n_laps - completed) * 1e6 + time_at_stop)
+    return np.argsort(np.argsort(key, axis=1), axis=1) + 1
+
+
+def position_distribution(model, positions):
+    '''Share of the runs every driver finished in every position, with the
+    mean position and the chance of a win, a podium and points'''
+    n_runs, n_drivers = positions.shape
+    counts = np.zeros((n_drivers, n_drivers))
+    np.add.at(counts, (np.broadcast_to(np.arange(n_drivers), positions.shape), positions - 1), 1)
+    table = pd.DataFrame(counts / n_runs, index=pd.Index(model.drivers, name='Driver'),
+                         columns=[f'P{position}' for position in range(1, n_drivers + 1)])
+    table.insert(0, 'Team', model.teams)
+    table.insert(1, 'MeanPosition', positions.mean(axis=0))
+    table.insert(2, 'Win', (positions == 1).mean(axis=0))
+    table.insert(3, 'Podium', (positions <= 3).mean(axis=0))
+    table.insert(4, 'Points', (positions <= POINTS_POSITIONS).mean(axis=0))
+    return table.sort_values('MeanPosition')
+
+
+def ahead_probability(model, positions, driver, rival):
+    '''Share of the runs driver finished ahead of rival'''
+    return float(np.mean(positions[:, model.driver_index(driver)] < positions[:, model.driver_index(rival)]))
+
+
+def _scenario_chunk(model, kwargs, runs, seed):
+    return simulate(model, runs=runs, seed=seed, **kwargs)
+
+
+def simulate_scenarios(model, scenarios=None, runs=DEFAULT_RUNS, processes=None, seed=0, chunk=RUN_CHUNK):
+    '''Runs every scenario ({name: simulate arguments}, default SCENARIOS)
+    runs times, split into chunks over a process pool (processes=1 runs
+    here). Every chunk gets its own seed from one SeedSequence, so a sweep
+    is reproducible whatever the number of processes. Returns {name: positions}'''
+    scenarios = SCENARIOS if scenarios is None else scenarios
+    seeds = iter(np.random.SeedSequence(seed).spawn(len(scenarios) * (runs // chunk + 1)))
+    tasks = [(name, kwargs, min(chunk, runs - first), next(seeds))
+             for name, kwargs in scenarios.items() for first in range(0, runs, chunk)]
+
+    with stage('simulate_scenarios', rows=len(scenarios) * runs):
+        if processes == 1:
+            chunks = [_scenario_chunk(model, kwargs, size, chunk_seed) for _, kwargs, size, chunk_seed in tasks]
+        else:
+            with ProcessPoolExecutor(max_workers=processes) as pool:
+                futures = [pool.submit(_scenario_chunk, model, kwargs, size, chunk_seed)
+                           for _, kwargs, size, chunk_seed in tasks]
+                chunks = [future.result() for future in futures]
+
+    results = {name: list() for name in scenarios}
+    for (name, *_), positions in zip(tasks, chunks):
+        results[name].append(positions)
+    return {name: np.concatenate(parts) for name, parts in results.items()}
+
+
+@instrumented()
+@needs_streams('laps')
+def what_if(driver, session, rival=None, runs=DEFAULT_RUNS, scenarios=None, processes=None, seed=0):
+    '''How driver would have done in every scenario (default SCENARIOS):
+    mean position, chances of a win, podium and points and, with a rival, of
+    finishing ahead of them'''
+    model = RaceModel.from_session(session)
+    results = simulate_scenarios(model, scenarios, runs=runs, processes=processes, seed=seed)
+
+    rows = list()
+    for name, positions in results.items():
+        row = position_distribution(model, positions).loc[driver, ['MeanPosition', 'Win', 'Podium', 'Points']]
+        row = {'Scenario': name, **row.to_dict()}
+        if rival is not None:
+            row[f'Ahead of {rival}'] = ahead_probability(model, positions, driver, rival)
+        rows.append(row)
+    return pd.DataFrame(rows)
+
+
+def main(argv=None):
+    import time
+
+    parser = argparse.ArgumentParser(description='Simulate a race again under different scenarios')
+    parser.add_argument('year', type=int)
+    parser.add_argument('grand_prix')
+    parser.add_argument('session', nargs='?', default='R')
+    parser.add_argument('--driver', help='show the scenarios for this driver')
+    parser.add_argument('--rival', help='and the chance of beating this one')
+    parser.add_argument('--runs', type=int, default=DEFAULT_RUNS)
+    parser.add_argument('--processes', type=int, default=None)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args(argv)
+
+    from driver_comparisons import get_session
+    session = get_session(args.year, args.grand_prix, args.session)
+    session.load_streams('laps')
+    model = RaceModel.from_session(session)
+
+    started = time.perf_counter()
+    results = simulate_scenarios(model, runs=args.runs, processes=args.processes, seed=args.seed)
+    print(f'{len(results)} scenarios x {args.runs} races in {time.perf_counter() - started:.1f} s')
+
+    for name, positions in results.items():
+        table = position_distribution(model, positions)
+        print(f'\n{name}')
+        print(table[['Team', 'MeanPosition', 'Win', 'Podium', 'Points']].round(3).to_string())
+        if args.driver and args.rival:
+            print(f'{args.driver} ahead of {args.rival}: '
+                  f'{ahead_probability(model, positions, args.driver, args.rival):.1%}')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
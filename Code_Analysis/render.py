@@ -0,0 +1,116 @@
+# render.py
+# One output mode for all plotting functions.
+#
+# Every plot either shows interactively (output=None, like before), saves to a
+# file (output='some/file.png' or an existing directory), or returns the image
+# as bytes (output='png', 'svg' or 'pdf'). Figures that are saved or returned
+# are closed right away, so batch jobs don't pile up hundreds of open figures.
+
+import io
+import os
+import sys
+import time
+from contextlib import contextmanager
+
+from instrumentation import stage
+
+
+# Formats we can hand back as bytes
+FORMATS = ('png', 'svg', 'pdf')
+
+# Active render_timer dicts
+_TIMERS = list()
+
+# setup_plotting has run in this process
+_PLOTTING_READY = False
+
+
+def is_headless():
+    '''True when there is no display (and no notebook) to draw on'''
+    if 'ipykernel' in sys.modules:
+        return False
+    if sys.platform.startswith('linux'):
+        return not (os.environ.get('DISPLAY') or os.environ.get('WAYLAND_DISPLAY'))
+    return False
+
+
+def select_backend():
+    '''Switches to the non-interactive Agg backend when running headless, e.g.
+    in a batch job or a service'''
+    if is_headless():
+        import matplotlib
+        matplotlib.use('Agg')
+
+
+def setup_plotting():
+    '''The one-time plotting setup that get_session used to redo for every
+    session: backend, fastf1's matplotlib setup (timedelta axes, colors) and
+    quieter pandas. Runs on the first plot, call it yourself to set up earlier.
+    Calling it again does nothing'''
+    global _PLOTTING_READY
+    if _PLOTTING_READY:
+        return
+
+    import pandas as pd
+    from fastf1 import plotting
+
+    select_backend()
+    plotting.setup_mpl()
+
+    # Get rid of some pandas warnings that are not relevant for us at the moment
+    pd.options.mode.chained_assignment = None
+    _PLOTTING_READY = True
+
+
+def pyplot():
+    '''matplotlib.pyplot, imported and set up on first use. Plotting functions
+    get plt from here so that importing them stays cheap'''
+    setup_plotting()
+    from matplotlib import pyplot as plt
+    return plt
+
+
+@contextmanager
+def render_timer():
+    '''Adds up the time finish_figure spends drawing and writing figures
+    inside the with block, e.g. to tell rendering apart from data preparation.
+    Yields a dict with seconds and figures'''
+    timer = {'seconds': 0.0, 'figures': 0}
+    _TIMERS.append(timer)
+    try:
+        yield timer
+    finally:
+        _TIMERS.remove(timer)
+
+
+def finish_figure(fig, output=None, dpi=None, file_name='figure.png'):
+    '''Shows, saves or returns a finished figure depending on output:
+    None shows it, 'png'/'svg'/'pdf' returns the image bytes, a path saves it
+    there (file_name is used when the path is a directory). Returns the bytes
+    or the path that was written.'''
+    plt = pyplot()
+    if output is None:
+        plt.show()
+        return None
+
+    # Paths may be pathlib.Path as well
+    output = os.fspath(output)
+    started = time.perf_counter()
+    try:
+        with stage('savefig', output=output, dpi=dpi):
+            if output in FORMATS:
+                buffer = io.BytesIO()
+                fig.savefig(buffer, format=output, dpi=dpi)
+                return buffer.getvalue()
+
+            if os.path.isdir(output) or output.endswith(os.sep):
+                os.makedirs(output, exist_ok=True)
+                output = os.path.join(output, file_name)
+            fig.savefig(output, dpi=dpi)
+            return output
+    finally:
+        plt.close(fig)
+        for timer in _TIMERS:
+            timer['seconds'] += time.perf_counter() - started
+            timer['figures'] += 1
+
@@ -0,0 +1,272 @@
+# season_batch.py
+# Runs a list of analyses over every round of a season with a process pool.
+#
+# Instead of a hand-edited notebook per race, this loads each (round, session)
+# once in a worker process, runs all requested analyses on it and writes the
+# figures to an output directory. A failing analysis or session is recorded and
+# the rest of the season carries on, also when a session crashes its worker.
+#
+# Example:
+#   python season_batch.py 2022 --sessions Q R --rounds 1-10 \
+#       --analyses fastest_laptimes double_driver_lap_comparison:VER,LEC
+#
+# With --instrument events.jsonl every stage (loading, lap picking, telemetry,
+# savefig, ...) is recorded and summarized at the end, --profile DIR writes a
+# cProfile file per session.
+
+import os
+import sys
+import json
+import time
+import argparse
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+
+from session_store import slug
+
+
+# Name -> (module, function). Every analysis takes the session as last argument
+ANALYSES = {
+    'fastest_laptimes': ('driver_comparisons', 'fastest_laptimes'),
+    'fastest_lap_comparison': ('driver_comparisons', 'fastest_lap_comparison'),
+    'double_driver_lap_comparison': ('driver_comparisons', 'double_driver_lap_comparison'),
+    'multi_driver_lap_comparison': ('driver_comparisons', 'multi_driver_lap_comparison'),
+    'driver_speed_change': ('driver_comparisons', 'driver_speed_change'),
+    'driver_gear_changes': ('driver_comparisons', 'driver_gear_changes'),
+    'get_driver_aws_data': ('F1_aws_plot', 'get_driver_aws_data'),
+    'corner_comparison': ('F1_aws_plot', 'corner_comparison'),
+    'static_track_temp': ('static_plot', 'static_track_temp'),
+    'static_track_conditions': ('static_plot', 'static_track_conditions'),
+    'laptime_vs_track_temp': ('static_plot', 'laptime_vs_track_temp'),
+    'race_pace': ('race_pace', 'race_pace'),
+    'minisector_dominance': ('minisectors', 'minisector_dominance'),
+}
+
+# Analyses whose first argument is a list of drivers, e.g. "race_pace:VER,LEC,HAM"
+DRIVER_LIST_ANALYSES = ('multi_driver_lap_comparison', 'race_pace')
+
+
+def parse_analysis(spec):
+    '''Turns "name" or "name:arg1,arg2" into a (name, arg1, arg2) tuple.
+    Numbers are converted, so "get_driver_aws_data:VER,LEC,1200,2100" works'''
+    if not isinstance(spec, str):
+        return tuple(spec)
+
+    name, _, args = spec.partition(':')
+    parsed = list()
+    for arg in filter(None, args.split(',')):
+        try:
+            parsed.append(int(arg))
+        except ValueError:
+            try:
+                parsed.append(float(arg))
+            except ValueError:
+                parsed.append(arg)
+    return (name, *parsed)
+
+
+def analysis_label(analysis):
+    return '_'.join(str(part) for part in analysis)
+
+
+def season_rounds(year):
+    '''Round numbers of all race weekends in a season (testing excluded)'''
+    import fastf1 as ff1
+
+    schedule = ff1.get_event_schedule(year, include_testing=False)
+    return [int(round_number) for round_number in schedule['RoundNumber'] if round_number > 0]
+
+
+def run_session_task(year, round_number, session_name, analyses, output_dir, image_format='png',
+                     profile_dir=None):
+    '''Loads one session and runs every analysis on it, saving each figure
+    into the session's output directory. Runs inside a worker process.
+    With profile_dir the task runs under cProfile and leaves a .prof file there'''
+    if profile_dir:
+        from instrumentation import profiled
+
+        path = os.path.join(profile_dir, f'{year}_{round_number:02d}_{slug(session_name)}.prof')
+        with profiled(path):
+            return run_session_task(year, round_number, session_name, analyses, output_dir, image_format)
+
+    # Never try to open windows from a worker
+    import matplotlib
+    matplotlib.use('Agg')
+    from matplotlib import pyplot as plt
+    import importlib
+
+    from driver_comparisons import get_session
+    from session_cache import SESSION_CACHE
+    from instrumentation import stage
+
+    started = time.perf_counter()
+    result = {'year': year, 'round': round_number, 'session': session_name,
+              'event': None, 'analyses': list()}
+
+    try:
+        with stage('get_session', year=year, round=round_number, session=session_name):
+            session = get_session(year, round_number, session_name)
+        result['event'] = str(session.event['EventName'])
+        session_dir = os.path.join(output_dir, str(year),
+                                   f"{round_number:02d}_{slug(result['event'])}",
+                                   slug(session.name))
+        os.makedirs(session_dir, exist_ok=True)
+    except Exception:
+        result['error'] = traceback.format_exc()
+        result['seconds'] = time.perf_counter() - started
+        return result
+
+    for analysis in analyses:
+        name, *args = analysis
+        label = analysis_label(analysis)
+        outcome = {'analysis': label, 'files': list()}
+        analysis_started = time.perf_counter()
+
+        try:
+            module_name, function_name = ANALYSES[name]
+            function = getattr(importlib.import_module(module_name), function_name)
+            if name in DRIVER_LIST_ANALYSES:
+                args = [list(args)]
+            with stage('analysis', analysis=label, year=year, round=round_number, session=session_name):
+                path = function(*args, session, output=os.path.join(session_dir, f'{label}.{image_format}'))
+            outcome['files'].append(path)
+            outcome['ok'] = True
+        except Exception:
+            outcome['ok'] = False
+            outcome['error'] = traceback.format_exc()
+        finally:
+            # finish_figure closes its figure, this catches anything left over after an error
+            plt.close('all')
+
+        outcome['seconds'] = time.perf_counter() - analysis_started
+        result['analyses'].append(outcome)
+
+    # One session per worker at a time, don't keep it around for the next task
+    SESSION_CACHE.clear()
+    result['seconds'] = time.perf_counter() - started
+    return result
+
+
+def _progress(done, total, result):
+    ok = sum(outcome['ok'] for outcome in result['analyses'])
+    failed = len(result['analyses']) - ok
+    status = 'session failed' if 'error' in result else f'{ok} ok, {failed} failed'
+    print(f"[{done}/{total}] {result['year']} R{result['round']:02d} "
+          f"{result['event'] or ''} {result['session']}: {status} "
+          f"({result.get('seconds', 0):.1f}s)", flush=True)
+
+
+def _failed_task(task, error):
+    task_year, round_number, session_name = task[:3]
+    return {'year': task_year, 'round': round_number, 'session': session_name,
+            'event': None, 'analyses': list(), 'error': error}
+
+
+def _run_tasks(tasks, processes, on_result):
+    '''Runs session tasks in a process pool, passing every result to
+    on_result. Returns the tasks left unfinished because a worker died hard
+    (segfault, killed when out of memory), which breaks the whole pool'''
+    unfinished = list()
+    with ProcessPoolExecutor(max_workers=processes) as pool:
+        futures = {pool.submit(run_session_task, *task): task for task in tasks}
+        for future in as_completed(futures):
+            try:
+                result = future.result()
+            except BrokenProcessPool:
+                unfinished.append(futures[future])
+                continue
+            except Exception:
+                result = _failed_task(futures[future], traceback.format_exc())
+            on_result(result)
+    return unfinished
+
+
+def run_season(year, sessions, analyses, output_dir, rounds=None, processes=None, image_format='png',
+               profile_dir=None):
+    '''Runs all analyses for every (round, session) of a season in a process
+    pool and writes the figures plus a summary.json to output_dir.
+    analyses are names from ANALYSES or tuples/strings with arguments, e.g.
+    ('double_driver_lap_comparison', 'VER', 'LEC') or "get_driver_aws_data:VER,LEC,1200,2100"'''
+    analyses = [parse_analysis(analysis) for analysis in analyses]
+    unknown = [analysis[0] for analysis in analyses if analysis[0] not in ANALYSES]
+    if unknown:
+        raise ValueError(f"Unknown analyses {unknown}, expected some of {sorted(ANALYSES)}")
+
+    if rounds is None:
+        rounds = season_rounds(year)
+    tasks = [(year, round_number, session_name, analyses, output_dir, image_format, profile_dir)
+             for round_number in rounds for session_name in sessions]
+    os.makedirs(output_dir, exist_ok=True)
+
+    results = list()
+    started = time.perf_counter()
+
+    def record(result):
+        results.append(result)
+        _progress(len(results), len(tasks), result)
+
+    # A dead worker takes the pool and every unfinished task with it. Those
+    # get a fresh pool, and if that breaks too, a pool of their own one at a
+    # time, so a session that keeps crashing its worker only fails itself
+    unfinished = _run_tasks(tasks, processes, record)
+    if unfinished:
+        unfinished = _run_tasks(unfinished, processes, record)
+    for task in unfinished:
+        for crashed in _run_tasks([task], 1, record):
+            record(_failed_task(crashed, 'The worker process died while running this session'))
+
+    results.sort(key=lambda result: (result['round'], str(result['session'])))
+    summary = {
+        'year': year,
+        'seconds': time.perf_counter() - started,
+        'tasks': len(tasks),
+        'failed_sessions': sum('error' in result for result in results),
+        'failed_analyses': sum(not outcome['ok'] for result in results for outcome in result['analyses']),
+        'results': results,
+    }
+    with open(os.path.join(output_dir, 'summary.json'), 'w') as f:
+        json.dump(summary, f, indent=1)
+
+    return summary
+
+
+def _parse_rounds(text):
+    rounds = list()
+    for part in text.split(','):
+        first, _, last = part.partition('-')
+        rounds.extend(range(int(first), int(last or first) + 1))
+    return rounds
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Run analyses over a whole season')
+    parser.add_argument('year', type=int)
+    parser.add_argument('--sessions', nargs='+', default=['Q', 'R'])
+    parser.add_argument('--analyses', nargs='+', default=['fastest_laptimes'],
+                        help='e.g. fastest_laptimes double_driver_lap_comparison:VER,LEC')
+    parser.add_argument('--rounds', type=_parse_rounds, default=None, help='e.g. 1-5,8')
+    parser.add_argument('--output', default='season_output')
+    parser.add_argument('--processes', type=int, default=None)
+    parser.add_argument('--format', default='png', choices=['png', 'svg', 'pdf'])
+    parser.add_argument('--instrument', help='record stage events as JSON lines to this file')
+    parser.add_argument('--profile', help='write a cProfile file per session to this directory')
+    args = parser.parse_args(argv)
+
+    if args.instrument:
+        import instrumentation
+        instrumentation.enable(args.instrument)
+
+    summary = run_season(args.year, args.sessions, args.analyses, args.output,
+                         rounds=args.rounds, processes=args.processes, image_format=args.format,
+                         profile_dir=args.profile)
+    print(f"Finished {summary['tasks']} sessions in {summary['seconds']:.0f}s, "
+          f"{summary['failed_sessions']} sessions and {summary['failed_analyses']} analyses failed")
+
+    if args.instrument:
+        print(instrumentation.summarize(args.instrument).to_string(float_format=lambda value: f'{value:.3f}'))
+    return 1 if summary['failed_sessions'] or summary['failed_analyses'] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
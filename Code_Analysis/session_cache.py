@@ -0,0 +1,144 @@
+# session_cache.py
+# In-process cache of sessions shared by everything that calls get_session.
+#
+# Notebooks and batch jobs ask for the same race over and over. The cache keeps
+# the session objects keyed by (year, event, session type) and hands back the
+# already loaded object. When the loaded data outgrows the byte budget the
+# least recently used sessions are dropped, checked on every lookup and
+# whenever a cached session has loaded more streams.
+
+import os
+import threading
+from collections import OrderedDict
+
+import pandas as pd
+
+from lazy_session import LazySession
+
+
+# Default budget of 4 GiB, can be set with F1_SESSION_CACHE_BYTES
+DEFAULT_MAX_BYTES = int(os.environ.get('F1_SESSION_CACHE_BYTES', 4 * 1024 ** 3))
+
+
+def session_nbytes(session):
+    '''Memory held by the loaded streams of a LazySession'''
+    nbytes = 0
+    if 'laps' in session.loaded:
+        nbytes += pd.DataFrame(session.session.laps).memory_usage(deep=True).sum()
+        nbytes += pd.DataFrame(session.session.results).memory_usage(deep=True).sum()
+    for stream in ('car_data', 'pos_data'):
+        if stream in session.loaded:
+            for telemetry in getattr(session.session, stream).values():
+                nbytes += telemetry.memory_usage(deep=True).sum()
+    if 'weather' in session.loaded:
+        nbytes += session.session.weather_data.memory_usage(deep=True).sum()
+    return int(nbytes)
+
+
+class SessionCache:
+    '''LRU cache of LazySessions with a memory budget in bytes'''
+
+    def __init__(self, max_bytes=DEFAULT_MAX_BYTES, store_dir=None):
+        self.max_bytes = max_bytes
+        self.store_dir = store_dir
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        # (year, event name, session name) -> session, oldest first
+        self._sessions = OrderedDict()
+        # the measured size of each session and the streams it was measured with
+        self._sizes = dict()
+        # what callers asked for, e.g. (2022, 'Hungary GP', 'R') -> canonical key
+        self._aliases = dict()
+        self._lock = threading.RLock()
+
+    def __len__(self):
+        return len(self._sessions)
+
+    def get(self, year, grand_prix, session):
+        '''Returns the cached session, creating it on a miss'''
+        alias = (year, str(grand_prix).lower(), str(session).lower())
+
+        with self._lock:
+            key = self._aliases.get(alias)
+            if key in self._sessions:
+                self.hits += 1
+                self._sessions.move_to_end(key)
+                cached = self._sessions[key]
+                self.trim()
+                return cached
+
+        # Creating the session resolves the event name, which tells us whether
+        # it is the same race under another name
+        new_session = LazySession(year, grand_prix, session, store_dir=self.store_dir)
+        key = (int(new_session.event.year), str(new_session.event['EventName']), str(new_session.name))
+
+        with self._lock:
+            self._aliases[alias] = key
+            if key in self._sessions:
+                self.hits += 1
+            else:
+                self.misses += 1
+                self._sessions[key] = new_session
+                new_session.on_load = lambda: self._streams_loaded(key)
+            self._sessions.move_to_end(key)
+            cached = self._sessions[key]
+            self.trim()
+            return cached
+
+    def nbytes(self):
+        '''Total size of the cached sessions. Sessions load lazily, so sizes are
+        measured again whenever a session has loaded new streams'''
+        with self._lock:
+            total = 0
+            for key, session in self._sessions.items():
+                loaded = frozenset(session.loaded)
+                if key not in self._sizes or self._sizes[key][0] != loaded:
+                    self._sizes[key] = (loaded, session_nbytes(session))
+                total += self._sizes[key][1]
+            return total
+
+    def trim(self):
+        '''Evicts least recently used sessions until we are within budget. The
+        most recently used session is always kept'''
+        with self._lock:
+            while len(self._sessions) > 1 and self.nbytes() > self.max_bytes:
+                key, _ = self._sessions.popitem(last=False)
+                self._sizes.pop(key, None)
+                self.evictions += 1
+
+    def _streams_loaded(self, key):
+        # The session that just loaded is in use, the others go first
+        with self._lock:
+            if key in self._sessions:
+                self._sessions.move_to_end(key)
+                self.trim()
+
+    def set_max_bytes(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.trim()
+
+    def clear(self):
+        with self._lock:
+            self._sessions.clear()
+            self._sizes.clear()
+            self._aliases.clear()
+
+    def stats(self):
+        '''Hit/miss statistics and memory use of the cache'''
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+                'evictions': self.evictions,
+                'sessions': len(self._sessions),
+                'bytes': self.nbytes(),
+                'max_bytes': self.max_bytes,
+            }
+
+
+# The cache shared by get_session in driver_comparisons and F1_aws_plot
+SESSION_CACHE = SessionCache()
@@ -0,0 +1,374 @@
+# session_store.py
+# Columnar on-disk store for loaded fastf1 sessions.
+#
+# A full session.load() rebuilds laps, car data and position data from the raw
+# api cache every time, which takes tens of seconds per race. Here we write the
+# frames of a loaded session once as one .npy file per column and memory-map
+# them back on later loads, so reopening a race only costs reading the arrays.
+#
+# Layout:  <store>/<year>/<event>/<session>/meta.json
+#                                          /laps/...  /results/...  /weather/...
+#                                          /track_status/...  /session_status/...
+#                                          /race_control_messages/...
+#                                          /car_data/<driver number>/...
+#                                          /pos_data/<driver number>/...
+#
+# The track status, session status, race control messages and session info
+# are stored with the laps (session_info in meta.json).
+
+import os
+import json
+import shutil
+import datetime
+
+import numpy as np
+import pandas as pd
+
+# fastf1 is imported where it's used, the store can be read and written
+# without paying for it up front
+
+
+# Bump this whenever the on-disk layout changes, old entries are then rebuilt
+STORE_VERSION = 3
+
+# The streams we can store and restore independently of each other
+STREAMS = ('laps', 'car_data', 'pos_data', 'weather')
+
+# Smaller frames loaded together with the laps, stored with them when the
+# session has them
+LAP_FRAMES = ('track_status', 'session_status', 'race_control_messages')
+
+# Where fastf1 keeps its raw api cache, and where we keep our columnar copies
+CACHE_DIR = os.environ.get(
+    'F1_CACHE_DIR',
+    os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'cache'))
+STORE_DIR = os.environ.get('F1_SESSION_STORE', os.path.join(CACHE_DIR, 'session_store'))
+
+
+def enable_cache(cache_dir=None):
+    '''Enables the fastf1 api cache in a configurable location instead of a
+    hardcoded path (set F1_CACHE_DIR or pass cache_dir)'''
+    import fastf1 as ff1
+
+    cache_dir = cache_dir or CACHE_DIR
+    os.makedirs(cache_dir, exist_ok=True)
+    ff1.Cache.enable_cache(cache_dir)
+
+
+def slug(name):
+    '''name with everything but letters and digits replaced by _, for file names'''
+    return ''.join(c if c.isalnum() else '_' for c in str(name)).strip('_')
+
+
+def store_version():
+    '''The invalidation key of stored sessions. Entries written with another
+    store layout or fastf1 version are thrown away and rebuilt'''
+    import fastf1 as ff1
+    return f"{STORE_VERSION}-{ff1.__version__}"
+
+
+def session_path(session, store_dir=None):
+    '''Directory of a (year, grand_prix, session) entry in the store. We key on
+    the event name fastf1 resolved, so "Hungary" and "Hungary GP" share one entry'''
+    return os.path.join(store_dir or STORE_DIR,
+                        str(session.event.year),
+                        slug(session.event['EventName']),
+                        slug(session.name))
+
+
+def _set_session_data(session, name, value):
+    # Newer fastf1 versions expose the loaded data as read-only properties
+    # backed by an underscore attribute, older ones use plain attributes
+    if isinstance(getattr(type(session), name, None), property):
+        setattr(session, '_' + name, value)
+    else:
+        setattr(session, name, value)
+
+
+def _to_json(value):
+    if value is None or pd.isna(value):
+        return None
+    return str(value)
+
+
+def _loaded(session, name):
+    '''A data attribute of the session, None when it isn't loaded'''
+    try:
+        return getattr(session, name)
+    except Exception:
+        # DataNotLoadedError in newer fastf1 versions, AttributeError in older ones
+        return None
+
+
+def _info_to_json(value):
+    # session_info is nested dicts with dates and the utc offset in it
+    if isinstance(value, dict):
+        return {key: _info_to_json(item) for key, item in value.items()}
+    if isinstance(value, datetime.datetime):
+        return {'__datetime__': value.isoformat()}
+    if isinstance(value, datetime.timedelta):
+        return {'__timedelta__': value.total_seconds()}
+    return value
+
+
+def _info_from_json(value):
+    if isinstance(value, dict):
+        if '__datetime__' in value:
+            return datetime.datetime.fromisoformat(value['__datetime__'])
+        if '__timedelta__' in value:
+            return datetime.timedelta(seconds=value['__timedelta__'])
+        return {key: _info_from_json(item) for key, item in value.items()}
+    return value
+
+
+def _fill_lap_start_dates(session):
+    '''LapStartDate is only known once the telemetry gave t0_date, laps
+    stored from a load without telemetry have NaT there'''
+    laps, t0_date = _loaded(session, 'laps'), _loaded(session, 't0_date')
+    if laps is None or t0_date is None or pd.isna(t0_date) or 'LapStartDate' not in laps.columns:
+        return
+    if laps['LapStartDate'].isna().any():
+        laps['LapStartDate'] = laps['LapStartDate'].fillna(laps['LapStartTime'] + t0_date)
+
+
+##############################
+#
+# Single frames
+#
+##############################
+def save_frame(df, path):
+    '''Writes a dataframe as one .npy file per column. Object columns are
+    stored as fixed width strings (or floats for booleans) with a null mask and
+    categoricals as their codes plus the categories, so that nothing has to be
+    pickled. The index is not stored.'''
+    tmp_path = path + '.tmp'
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    os.makedirs(tmp_path)
+
+    columns = list()
+    for i, name in enumerate(df.columns):
+        values = df[name]
+        file_name = f'{i:03d}.npy'
+        extra = dict()
+
+        # String categories keep their codes (-1 for missing), other
+        # categoricals are stored like the plain column
+        if isinstance(values.dtype, pd.CategoricalDtype) \
+                and pd.api.types.infer_dtype(values.cat.categories, skipna=True) != 'string':
+            values = values.astype(object)
+
+        if isinstance(values.dtype, pd.CategoricalDtype):
+            kind = 'category'
+            array = values.cat.codes.to_numpy()
+            extra['categories'] = [str(category) for category in values.cat.categories]
+        elif values.dtype != object:
+            kind = 'array'
+            array = values.to_numpy()
+        else:
+            inferred = pd.api.types.infer_dtype(values, skipna=True)
+            mask = values.isna().to_numpy()
+            if inferred == 'boolean':
+                kind = 'bool_object'
+                array = values.astype(float).to_numpy()
+            elif inferred == 'timedelta':
+                kind = 'array'
+                array = pd.to_timedelta(values).to_numpy()
+            else:
+                kind = 'str_object'
+                array = values.fillna('').astype(str).to_numpy().astype(str)
+                np.save(os.path.join(tmp_path, f'{i:03d}.mask.npy'), mask)
+
+        np.save(os.path.join(tmp_path, file_name), array, allow_pickle=False)
+        columns.append({'name': str(name), 'kind': kind, 'file': file_name, **extra})
+
+    # columns.json is written last and marks the frame as complete
+    with open(os.path.join(tmp_path, 'columns.json'), 'w') as f:
+        json.dump({'columns': columns, 'rows': len(df)}, f)
+
+    shutil.rmtree(path, ignore_errors=True)
+    os.replace(tmp_path, path)
+
+
+def load_frame(path, mmap=True):
+    '''Reads a frame written by save_frame. Numeric columns are memory-mapped
+    unless mmap is False'''
+    with open(os.path.join(path, 'columns.json')) as f:
+        spec = json.load(f)
+
+    data = dict()
+    for column in spec['columns']:
+        # empty files cannot be memory-mapped
+        array = np.load(os.path.join(path, column['file']),
+                        mmap_mode='r' if mmap and spec['rows'] else None, allow_pickle=False)
+
+        if column['kind'] == 'category':
+            data[column['name']] = pd.Categorical.from_codes(np.asarray(array), column['categories'])
+        elif column['kind'] == 'bool_object':
+            values = pd.Series(array).map({1.0: True, 0.0: False})
+            data[column['name']] = values.astype(object).where(values.notna(), np.nan)
+        elif column['kind'] == 'str_object':
+            mask = np.load(os.path.join(path, column['file'].replace('.npy', '.mask.npy')))
+            values = array.astype(object)
+            values[mask] = np.nan
+            data[column['name']] = values
+        else:
+            data[column['name']] = array
+
+    return pd.DataFrame(data, columns=[c['name'] for c in spec['columns']])
+
+
+def has_frame(path):
+    return os.path.exists(os.path.join(path, 'columns.json'))
+
+
+##############################
+#
+# Whole streams of a session
+#
+##############################
+def _read_meta(path):
+    try:
+        with open(os.path.join(path, 'meta.json')) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def _write_meta(session, path, **updates):
+    meta = _read_meta(path) or dict()
+    meta.update({
+        'version': store_version(),
+        'year': int(session.event.year),
+        'grand_prix': str(session.event['EventName']),
+        'session': str(session.name),
+    })
+    meta.update(updates)
+    with open(os.path.join(path, 'meta.json'), 'w') as f:
+        json.dump(meta, f, indent=1)
+
+
+def _check_version(path):
+    '''Wipes an entry written by another store version, returns its meta'''
+    meta = _read_meta(path)
+    if meta is not None and meta.get('version') != store_version():
+        shutil.rmtree(path, ignore_errors=True)
+        return None
+    return meta
+
+
+def has_stream(session, stream, store_dir=None):
+    path = session_path(session, store_dir)
+    meta = _check_version(path)
+    return meta is not None and stream in meta.get('streams', [])
+
+
+def save_stream(session, stream, store_dir=None):
+    '''Writes one loaded stream ('laps', 'car_data', 'pos_data' or 'weather')
+    of a session to the store'''
+    path = session_path(session, store_dir)
+    _check_version(path)
+    os.makedirs(path, exist_ok=True)
+
+    updates = dict()
+    if stream == 'laps':
+        save_frame(pd.DataFrame(session.laps), os.path.join(path, 'laps'))
+        save_frame(pd.DataFrame(session.results), os.path.join(path, 'results'))
+        updates['session_start_time'] = _to_json(session.session_start_time)
+        updates['drivers'] = list(session.drivers)
+
+        updates['lap_frames'] = list()
+        for name in LAP_FRAMES:
+            frame = _loaded(session, name)
+            if frame is not None:
+                save_frame(pd.DataFrame(frame), os.path.join(path, name))
+                updates['lap_frames'].append(name)
+        session_info = _loaded(session, 'session_info')
+        updates['session_info'] = None if session_info is None else _info_to_json(session_info)
+    elif stream in ('car_data', 'pos_data'):
+        for drv, telemetry in getattr(session, stream).items():
+            save_frame(pd.DataFrame(telemetry), os.path.join(path, stream, str(drv)))
+        updates['t0_date'] = _to_json(session.t0_date)
+    elif stream == 'weather':
+        save_frame(pd.DataFrame(session.weather_data), os.path.join(path, 'weather'))
+    else:
+        raise ValueError(f"Unknown stream '{stream}', expected one of {STREAMS}")
+
+    streams = set((_read_meta(path) or dict()).get('streams', []))
+    streams.add(stream)
+    updates['streams'] = sorted(streams)
+    _write_meta(session, path, **updates)
+
+
+def load_stream(session, stream, store_dir=None, mmap=True):
+    '''Restores one stream from the store into a (not yet loaded) fastf1
+    session. Returns False if the stream is not stored for this session'''
+    from fastf1.core import Laps, Telemetry, SessionResults
+
+    if not has_stream(session, stream, store_dir):
+        return False
+    path = session_path(session, store_dir)
+    meta = _read_meta(path)
+
+    if stream == 'laps':
+        _set_session_data(session, 'results', SessionResults(load_frame(os.path.join(path, 'results'), mmap)))
+        _set_session_data(session, 'laps', Laps(load_frame(os.path.join(path, 'laps'), mmap), session=session))
+        if meta.get('session_start_time') is not None:
+            _set_session_data(session, 'session_start_time', pd.Timedelta(meta['session_start_time']))
+        if not isinstance(getattr(type(session), 'drivers', None), property):
+            session.drivers = meta.get('drivers', [])
+        for name in meta.get('lap_frames', []):
+            _set_session_data(session, name, load_frame(os.path.join(path, name), mmap))
+        if meta.get('session_info') is not None:
+            _set_session_data(session, 'session_info', _info_from_json(meta['session_info']))
+        _fill_lap_start_dates(session)
+    elif stream in ('car_data', 'pos_data'):
+        stream_path = os.path.join(path, stream)
+        data = dict()
+        for drv in sorted(os.listdir(stream_path)):
+            if has_frame(os.path.join(stream_path, drv)):
+                data[drv] = Telemetry(load_frame(os.path.join(stream_path, drv), mmap),
+                                      session=session, driver=drv)
+        _set_session_data(session, stream, data)
+        if meta.get('t0_date') is not None:
+            _set_session_data(session, 't0_date', pd.Timestamp(meta['t0_date']))
+        _fill_lap_start_dates(session)
+    elif stream == 'weather':
+        _set_session_data(session, 'weather_data', load_frame(os.path.join(path, 'weather'), mmap))
+    else:
+        raise ValueError(f"Unknown stream '{stream}', expected one of {STREAMS}")
+
+    return True
+
+
+def store_session(session, store_dir=None):
+    '''Writes laps, car data, position data and weather of a loaded session'''
+    for stream in STREAMS:
+        save_stream(session, stream, store_dir)
+
+
+def restore_session(session, store_dir=None, mmap=True):
+    '''Restores all streams of a session, returns False if any is missing'''
+    if not all(has_stream(session, stream, store_dir) for stream in STREAMS):
+        return False
+    for stream in STREAMS:
+        load_stream(session, stream, store_dir, mmap)
+    return True
+
+
+def invalidate_session(session, store_dir=None):
+    '''Removes a session from the store, so that it is rebuilt on next load'''
+    shutil.rmtree(session_path(session, store_dir), ignore_errors=True)
+
+
+def load_session(year, grand_prix, session, store_dir=None):
+    '''Returns a loaded fastf1 session, from the store when possible. The first
+    load of a session goes through session.load() and fills the store'''
+    import fastf1 as ff1
+
+    session = ff1.get_session(year, grand_prix, session)
+
+    if not restore_session(session, store_dir):
+        session.load()
+        store_session(session, store_dir)
+
+    return session
@@ -1,22 +1,126 @@
 # static_plot.py
 # import necessary packages
 
-from matplotlib import pyplot
-import matplotlib.pyplot as plt
+import weakref
+
+import numpy as np
+import pandas as pd
+
+from lazy_session import needs_streams
+from render import finish_figure, pyplot
+from instrumentation import instrumented, stage
+
+# Weather columns attached to every lap
+WEATHER_COLUMNS = ['AirTemp', 'TrackTemp', 'Humidity', 'Pressure', 'Rainfall', 'WindDirection', 'WindSpeed']
+
+# session -> laps with weather. Not kept in the session store: the join is
+# cheap, and a stored copy could go stale against the laps and weather
+_LAPS_WEATHER = weakref.WeakKeyDictionary()
+
+
+def session_minutes(times):
+    '''Session time (timedelta) in minutes, for x-axes'''
+    return pd.to_timedelta(times).dt.total_seconds() / 60
+
+
+def attach_weather(laps, weather):
+    '''Every lap with the weather sample nearest to the middle of the lap, in
+    one sorted as-of join on session time'''
+    laps = pd.DataFrame(laps)
+    lap_start = laps['LapStartTime'].fillna(laps['Time'] - laps['LapTime'])
+    midpoint = (lap_start + (laps['Time'] - lap_start) / 2).fillna(laps['Time'])
+
+    weather = pd.DataFrame(weather)[['Time'] + [c for c in WEATHER_COLUMNS if c in weather.columns]]
+    weather = weather.rename(columns={'Time': 'WeatherTime'}).sort_values('WeatherTime')
+
+    timed = laps.assign(LapMidTime=midpoint).reset_index().rename(columns={'index': 'LapIndex'})
+    # merge_asof needs sorted keys without gaps, laps without any time keep no weather
+    with_time = timed.loc[timed['LapMidTime'].notna()].sort_values('LapMidTime')
+    with stage('merge_asof', rows=len(with_time)):
+        merged = pd.merge_asof(with_time, weather, left_on='LapMidTime', right_on='WeatherTime',
+                               direction='nearest')
+
+    merged = pd.concat([merged, timed.loc[timed['LapMidTime'].isna()]], ignore_index=True)
+    return merged.sort_values('LapIndex').set_index('LapIndex').rename_axis(None)
+
+
+@instrumented()
+@needs_streams('laps', 'weather')
+def laps_with_weather(session):
+    '''attach_weather for a session, computed once per session object'''
+    if session not in _LAPS_WEATHER:
+        _LAPS_WEATHER[session] = attach_weather(session.laps, session.weather_data)
+    return _LAPS_WEATHER[session]
+
+
+def concat_session_laps_weather(sessions):
+    '''laps_with_weather of several sessions in one table, with the same
+    Year, EventName and Session columns as concat_session_laps'''
+    return pd.concat([
+        laps_with_weather(session).assign(EventName=session.event['EventName'],
+                                          Year=session.event.year,
+                                          Session=session.name)
+        for session in sessions
+    ], ignore_index=True)
+
+
+@instrumented()
+@needs_streams('weather')
+def static_track_temp(session, output=None, dpi=None):
 
-def static_track_temp(session):
-    
     # create the figure and axis objects
+    plt = pyplot()
     fig, ax = plt.subplots()
-    # plot the data and customize
-    ax.plot(session.weather_data['TrackTemp'])
-    ax.set_xlabel('Laps')
+    # plot the data and customize, weather is sampled about once a minute
+    ax.plot(session_minutes(session.weather_data['Time']), session.weather_data['TrackTemp'])
+    ax.set_xlabel('Session time (min)')
     ax.set_ylabel('Temperature (*C)')
-    plt.show()
+    return finish_figure(fig, output, dpi)
 
 
-def static_track_conditions(session):
+@instrumented()
+@needs_streams('weather')
+def static_track_conditions(session, output=None, dpi=None):
+    pyplot()
     silverstone_tracktemp = session.weather_data[['TrackTemp',"AirTemp","Humidity","WindSpeed"]]
+    silverstone_tracktemp.index = session_minutes(session.weather_data['Time'])
+
+    ax = silverstone_tracktemp.plot()
+    ax.set_xlabel('Session time (min)')
+    return finish_figure(ax.figure, output, dpi)
+
+
+@instrumented()
+@needs_streams('laps', 'weather')
+def laptime_vs_track_temp(session, drivers=None, output=None, dpi=None):
+    '''Lap time against the track temperature during the lap, one color and
+    trend line per compound. In/out laps, non-green laps and slow laps are
+    left out (see race_pace.clean_race_laps)'''
+    from fastf1 import plotting as ff1_plotting
+    from race_pace import clean_race_laps
+
+    plt = pyplot()
+    laps = laps_with_weather(session)
+    if drivers:
+        laps = laps.loc[laps['Driver'].isin(drivers)]
+    laps = clean_race_laps(laps)
+
+    fig, ax = plt.subplots(figsize=(12, 6.75))
+    for compound, compound_laps in laps.groupby('Compound', observed=True):
+        color = ff1_plotting.COMPOUND_COLORS.get(compound, 'grey')
+        ax.scatter(compound_laps['TrackTemp'], compound_laps['LapSeconds'], s=12,
+                   color=color, edgecolor='black', linewidth=0.3, label=compound)
+
+        # trend per compound, only where the temperature actually varies
+        if compound_laps['TrackTemp'].nunique() > 1:
+            slope, intercept = np.polyfit(compound_laps['TrackTemp'], compound_laps['LapSeconds'], 1)
+            temps = np.linspace(compound_laps['TrackTemp'].min(), compound_laps['TrackTemp'].max(), 2)
+            ax.plot(temps, intercept + slope * temps, color=color, linewidth=2)
 
-    silverstone_tracktemp.plot()
-    pyplot.show()
+    ax.set_xlabel('Track temperature (*C)')
+    ax.set_ylabel('Lap time (s)')
+    ax.legend(title='Compound')
+    ax.grid(True, linestyle='--', alpha=0.5)
+    fig.suptitle(f"{session.event['EventName']} {session.event.year} - {session.name}\n"
+                 f"Lap time vs track temperature")
+    return finish_figure(fig, output, dpi)
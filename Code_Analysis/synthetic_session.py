@@ -0,0 +1,289 @@
+# synthetic_session.py
+# An offline stand-in for a loaded fastf1 session.
+#
+# SyntheticSession builds laps, car data, position data and weather that look
+# like a real race (a track with corners, pit stops, tyre wear, fuel burn, a
+# safety car) at any scale of drivers, laps and sample rate, from a seed and
+# without touching the api. Every analysis takes it in place of a session, so
+# it serves benchmarks and quick checks without a network or a cache.
+#
+# Example:
+#   session = SyntheticSession(drivers=20, laps=50, hz=4)
+#   fastest_laptimes(session, output='png')
+
+import numpy as np
+import pandas as pd
+
+from fastf1.core import Laps, Telemetry, SessionResults
+
+
+# (code, number, team) of the 2022 grid, teams in the spelling team_color knows
+GRID = [
+    ('VER', '1', 'Red Bull'), ('PER', '11', 'Red Bull'),
+    ('LEC', '16', 'Ferrari'), ('SAI', '55', 'Ferrari'),
+    ('HAM', '44', 'Mercedes'), ('RUS', '63', 'Mercedes'),
+    ('NOR', '4', 'McLaren'), ('RIC', '3', 'McLaren'),
+    ('ALO', '14', 'Alpine'), ('OCO', '31', 'Alpine'),
+    ('BOT', '77', 'Alfa Romeo'), ('ZHO', '24', 'Alfa Romeo'),
+    ('VET', '5', 'Aston Martin'), ('STR', '18', 'Aston Martin'),
+    ('MAG', '20', 'Haas'), ('MSC', '47', 'Haas'),
+    ('GAS', '10', 'AlphaTauri'), ('TSU', '22', 'AlphaTauri'),
+    ('ALB', '23', 'Williams'), ('LAT', '6', 'Williams'),
+]
+
+# Corners as (distance [m], length [m], speed lost [km/h])
+CORNERS = [(620, 140, 210), (1150, 90, 120), (1800, 110, 165), (2650, 190, 110),
+           (3350, 80, 190), (3900, 130, 140), (4650, 100, 175)]
+LAP_LENGTH = 5200.0
+TOP_SPEED = 322.0
+
+# Distance between the points the lap is integrated over
+KNOT_STEP = 10.0
+
+# Seconds per lap of tyre age and extra seconds per lap of fuel on board
+DEGRADATION = {'SOFT': 0.09, 'MEDIUM': 0.055, 'HARD': 0.035}
+FUEL_EFFECT = 0.06
+
+# Gear upper speed limits [km/h]
+GEAR_LIMITS = np.array([95, 130, 160, 190, 220, 250, 280, np.inf])
+
+
+def speed_profile(distance):
+    '''Flat-out speed [km/h] at every lap distance'''
+    speed = np.full_like(distance, TOP_SPEED, dtype=float)
+    for center, length, loss in CORNERS:
+        speed -= loss * np.exp(-0.5 * ((distance - center) / length) ** 2)
+    return speed
+
+
+def track_xy(distance):
+    '''A closed, non-crossing track outline (1/10 m, like fastf1 position data)'''
+    angle = 2 * np.pi * distance / LAP_LENGTH
+    radius = 8000 + 1500 * np.sin(3 * angle) + 600 * np.cos(5 * angle)
+    return radius * np.cos(angle), 0.65 * radius * np.sin(angle)
+
+
+class SyntheticSession:
+    '''Laps, car_data, pos_data, weather_data and results of a made-up race
+    with the attributes the analyses use from a loaded fastf1 session.
+    drivers (up to 20), laps and hz (car and position samples per second)
+    set the size'''
+
+    def __init__(self, drivers=20, laps=50, hz=4, name='Race', year=2022,
+                 event_name='Synthetic Grand Prix', safety_car=True, seed=0):
+        if not 1 <= drivers <= len(GRID):
+            raise ValueError(f'drivers must be between 1 and {len(GRID)}')
+
+        self._rng = np.random.default_rng(seed)
+        self.n_laps = laps
+        self.hz = hz
+        self.name = name
+        self.event = pd.Series({'EventName': event_name, 'year': year, 'RoundNumber': 1,
+                                'Country': 'Nowhere', 'Location': 'Synthetic',
+                                'EventDate': pd.Timestamp(f'{year}-07-03')})
+        self.t0_date = pd.Timestamp(f'{year}-07-03 13:00:00')
+        self.session_start_time = pd.Timedelta(minutes=5)
+
+        # Laps under safety car, somewhere in the middle of the race
+        self.safety_car_laps = set()
+        if safety_car and laps >= 10:
+            first = int(self._rng.integers(laps // 3, laps // 2))
+            self.safety_car_laps = set(range(first, first + 3))
+
+        self._knots = np.arange(0, LAP_LENGTH, KNOT_STEP)
+        self._profile = speed_profile(self._knots)
+
+        laps_frames, schedules = list(), dict()
+        for position, (code, number, team) in enumerate(GRID[:drivers]):
+            lap_frame, schedule = self._driver_laps(position, code, number, team)
+            laps_frames.append(lap_frame)
+            schedules[number] = schedule
+
+        laps_table = pd.concat(laps_frames, ignore_index=True)
+        laps_table['Position'] = laps_table.groupby('LapNumber')['Time'].rank(method='first')
+        self.laps = Laps(laps_table, session=self)
+
+        # All cars are sampled on one session clock, like the live timing feed
+        end = max(schedule[0][-1] for schedule in schedules.values())
+        car_clock = np.arange(self.session_start_time.total_seconds(), end, 1 / hz)
+        pos_clock = car_clock + 0.5 / hz
+        self.car_data = {number: self._car_data(number, *schedule, car_clock)
+                         for number, schedule in schedules.items()}
+        self.pos_data = {number: self._pos_data(number, *schedule, pos_clock)
+                         for number, schedule in schedules.items()}
+        self.drivers = list(schedules)
+
+        self.weather_data = self._weather(end)
+        final_lap = laps_table.loc[laps_table['LapNumber'] == laps].sort_values('Position')
+        self.results = SessionResults(pd.DataFrame({
+            'DriverNumber': final_lap['DriverNumber'].to_numpy(),
+            'Abbreviation': final_lap['Driver'].to_numpy(),
+            'TeamName': final_lap['Team'].to_numpy(),
+            'Position': np.arange(1.0, len(final_lap) + 1),
+        }))
+
+    def __repr__(self):
+        return (f"SyntheticSession({len(self.drivers)} drivers, {self.n_laps} laps, "
+                f"{self.hz} Hz)")
+
+    def load(self, **kwargs):
+        '''Everything is there from the start'''
+
+    def _driver_laps(self, position, code, number, team):
+        '''The laps table of one driver and the (time, distance) schedule
+        the car follows over the race'''
+        n_laps = self.n_laps
+        lap_numbers = np.arange(1, n_laps + 1)
+
+        # One stop around half distance
+        stop = int(self._rng.integers(max(2, int(n_laps * 0.35)), max(3, int(n_laps * 0.6)) + 1))
+        stop = min(stop, n_laps)
+        stint = np.where(lap_numbers <= stop, 1.0, 2.0)
+        compounds = ['SOFT', 'HARD'] if position % 2 else ['MEDIUM', 'HARD']
+        compound = np.where(stint == 1, compounds[0], compounds[1])
+        tyre_life = np.where(stint == 1, lap_numbers, lap_numbers - stop).astype(float)
+        degradation = np.array([DEGRADATION[c] for c in compound])
+
+        # Seconds on top of the ideal lap: fuel, tyres, driver, noise
+        base_lap = (KNOT_STEP / (self._profile / 3.6)).sum()
+        lap_seconds = (base_lap * (1 + 0.0025 * position)
+                       + FUEL_EFFECT * (n_laps - lap_numbers)
+                       + degradation * tyre_life
+                       + self._rng.normal(0, 0.25, n_laps))
+        lap_seconds[0] += 4.0                      # standing start
+        in_lap, out_lap = stop, stop + 1
+        lap_seconds[in_lap - 1] += 8.0
+        if out_lap <= n_laps:
+            lap_seconds[out_lap - 1] += 14.0
+        status = np.array(['4' if lap in self.safety_car_laps else '1' for lap in lap_numbers])
+        lap_seconds[status == '4'] *= 1.35
+
+        # Spread every lap over the distance knots proportional to the ideal lap
+        ideal = KNOT_STEP / (self._profile / 3.6)
+        knot_seconds = ideal[None, :] * (lap_seconds / base_lap)[:, None]
+        start = self.session_start_time.total_seconds() + 0.3 * position
+        times = start + np.concatenate([[0], np.cumsum(knot_seconds)])
+        distances = np.arange(len(times)) * KNOT_STEP
+
+        knots = len(self._knots)
+        lap_start = times[lap_numbers * knots - knots]
+        lap_end = times[lap_numbers * knots]
+        sector_ends = [times[(lap_numbers - 1) * knots + knots * part // 3] for part in (1, 2)] + [lap_end]
+        sector_starts = [lap_start] + sector_ends[:2]
+
+        def seconds(values):
+            return pd.to_timedelta(values, unit='s')
+
+        lap_time = seconds(lap_end - lap_start)
+        pit_in = np.where(lap_numbers == in_lap, lap_end, np.nan)
+        pit_out = np.where(lap_numbers == out_lap, lap_start + 2.0, np.nan)
+        clean = (status == '1') & (lap_numbers != in_lap) & (lap_numbers != out_lap) & (lap_numbers > 1)
+        best_so_far = np.minimum.accumulate(np.where(clean, lap_end - lap_start, np.inf))
+
+        laps = pd.DataFrame({
+            'Time': seconds(lap_end),
+            'Driver': code,
+            'DriverNumber': number,
+            'LapTime': lap_time,
+            'LapNumber': lap_numbers.astype(float),
+            'Stint': stint,
+            'PitOutTime': seconds(pit_out),
+            'PitInTime': seconds(pit_in),
+            'Sector1Time': seconds(sector_ends[0] - sector_starts[0]),
+            'Sector2Time': seconds(sector_ends[1] - sector_starts[1]),
+            'Sector3Time': seconds(sector_ends[2] - sector_starts[2]),
+            'Sector1SessionTime': seconds(sector_ends[0]),
+            'Sector2SessionTime': seconds(sector_ends[1]),
+            'Sector3SessionTime': seconds(sector_ends[2]),
+            'SpeedI1': np.interp(LAP_LENGTH / 6, self._knots, self._profile),
+            'SpeedI2': np.interp(LAP_LENGTH / 2, self._knots, self._profile),
+            'SpeedFL': np.interp(LAP_LENGTH - 50, self._knots, self._profile),
+            'SpeedST': TOP_SPEED,
+            'IsPersonalBest': clean & (lap_end - lap_start == best_so_far),
+            'Compound': compound,
+            'TyreLife': tyre_life,
+            'FreshTyre': True,
+            'Team': team,
+            'LapStartTime': seconds(lap_start),
+            'LapStartDate': self.t0_date + seconds(lap_start),
+            'TrackStatus': status,
+            'IsAccurate': clean,
+        })
+        return laps, (times, distances, lap_seconds / base_lap)
+
+    def _channels(self, times, distances, lap_factor, clock):
+        '''Lap distance and speed on the session clock while the car is out'''
+        clock = clock[(clock >= times[0]) & (clock <= times[-1])]
+        distance = np.interp(clock, times, distances)
+        lap_index = np.minimum((distance // LAP_LENGTH).astype(int), len(lap_factor) - 1)
+        lap_distance = distance - lap_index * LAP_LENGTH
+        speed = np.interp(lap_distance, self._knots, self._profile) / lap_factor[lap_index]
+        return clock, lap_distance, speed
+
+    def _frame(self, number, clock, columns):
+        frame = pd.DataFrame(columns)
+        session_time = pd.to_timedelta(clock, unit='s')
+        frame.insert(0, 'Date', self.t0_date + session_time)
+        frame.insert(1, 'SessionTime', session_time)
+        frame.insert(2, 'Time', session_time - session_time[0])
+        return Telemetry(frame, session=self, driver=number)
+
+    def _car_data(self, number, times, distances, lap_factor, clock):
+        clock, lap_distance, speed = self._channels(times, distances, lap_factor, clock)
+
+        # Accelerating or braking follows the flat-out profile ahead of the car
+        slope = np.gradient(self._profile, KNOT_STEP)
+        ahead = np.interp(lap_distance, self._knots, slope)
+        gear = np.searchsorted(GEAR_LIMITS, speed) + 1
+        low = np.concatenate([[0], GEAR_LIMITS[:-1]])[gear - 1]
+        high = np.minimum(GEAR_LIMITS[gear - 1], TOP_SPEED)
+
+        return self._frame(number, clock, {
+            'RPM': 9500 + 2300 * np.clip((speed - low) / (high - low), 0, 1),
+            'Speed': speed,
+            'nGear': gear,
+            'Throttle': np.where(ahead >= -0.05, 100.0, np.clip(100 + 60 * ahead, 0, 99)),
+            'Brake': ahead < -0.4,
+            'DRS': np.where((speed > 290) & (ahead >= 0), 12, 1),
+            'Source': 'car',
+        })
+
+    def _pos_data(self, number, times, distances, lap_factor, clock):
+        clock, lap_distance, _ = self._channels(times, distances, lap_factor, clock)
+        x, y = track_xy(lap_distance)
+        return self._frame(number, clock, {
+            'X': x, 'Y': y, 'Z': 50 * np.sin(2 * np.pi * lap_distance / LAP_LENGTH),
+            'Status': 'OnTrack',
+            'Source': 'pos',
+        })
+
+    def _weather(self, end):
+        '''One sample per minute, the track slowly heating up'''
+        minutes = np.arange(0, end / 60 + 1)
+        return pd.DataFrame({
+            'Time': pd.to_timedelta(minutes, unit='min'),
+            'AirTemp': 26 + 1.5 * minutes / max(minutes[-1], 1) + self._rng.normal(0, 0.1, len(minutes)),
+            'Humidity': 45 + self._rng.normal(0, 0.5, len(minutes)),
+            'Pressure': 1012 + self._rng.normal(0, 0.1, len(minutes)),
+            'Rainfall': False,
+            'TrackTemp': 38 + 6 * minutes / max(minutes[-1], 1) + self._rng.normal(0, 0.3, len(minutes)),
+            'WindDirection': self._rng.integers(0, 360, len(minutes)),
+            'WindSpeed': np.abs(1.5 + self._rng.normal(0, 0.4, len(minutes))),
+        })
+
+
+# (year, grand prix, session) -> SyntheticSession, see get_session
+_SESSIONS = dict()
+
+
+def get_session(year, grand_prix, session, **kwargs):
+    '''Drop-in for driver_comparisons.get_session that makes up the session
+    instead of loading it (once per year, grand prix and session, seeded from
+    them). Keyword arguments go to SyntheticSession'''
+    key = (int(year), str(grand_prix), str(session), tuple(sorted(kwargs.items())))
+    if key not in _SESSIONS:
+        seed = sum(key[1].encode()) + 31 * sum(key[2].encode()) + key[0]
+        kwargs.setdefault('seed', seed)
+        _SESSIONS[key] = SyntheticSession(name=str(session), year=int(year),
+                                          event_name=str(grand_prix), **kwargs)
+    return _SESSIONS[key]
@@ -0,0 +1,126 @@
+# telemetry_alignment.py
+# Distance-aligned telemetry shared by all driver comparisons.
+#
+# Comparing laps means putting them on the same x-axis. Instead of every
+# function pulling telemetry for the same laps again (and utils.delta_time
+# doing it once more internally), each lap's car data is extracted once, kept
+# per session, and resampled onto a common distance grid with one vectorized
+# interpolation for all channels. Delta time then is a plain subtraction.
+
+import weakref
+
+import numpy as np
+import pandas as pd
+
+from instrumentation import stage
+
+
+# Channels of the aligned telemetry, in this order along the last axis
+CHANNELS = ('Speed', 'Throttle', 'Brake', 'nGear', 'RPM', 'DRS', 'Time')
+
+# Channels that hold a state rather than a measurement are not interpolated
+# linearly, they keep the last sampled value
+STEP_CHANNELS = ('Brake', 'nGear', 'DRS')
+
+# Default distance between grid points in meters
+DEFAULT_STEP = 1.0
+
+# session -> {(driver number, lap number): (distance, values)}. Entries go away
+# together with their session, e.g. when it is evicted from the session cache
+_LAP_TELEMETRY = weakref.WeakKeyDictionary()
+
+
+def channel_index(channel):
+    return CHANNELS.index(channel)
+
+
+def lap_telemetry(lap):
+    '''Distance and raw channel values (samples x CHANNELS) of a single lap,
+    extracted from the car data only once per lap. Time is in seconds'''
+    laps_of_session = _LAP_TELEMETRY.setdefault(lap.session, dict())
+    key = (str(lap['DriverNumber']), float(lap['LapNumber']))
+
+    if key not in laps_of_session:
+        with stage('get_car_data', driver=key[0], lap=key[1]) as event:
+            telemetry = lap.get_car_data().add_distance()
+            event['rows'] = len(telemetry)
+        values = np.column_stack([
+            telemetry['Time'].dt.total_seconds().to_numpy(dtype=float) if channel == 'Time'
+            else telemetry[channel].to_numpy(dtype=float)
+            for channel in CHANNELS
+        ])
+        laps_of_session[key] = (telemetry['Distance'].to_numpy(dtype=float), values)
+
+    return laps_of_session[key]
+
+
+def resample(distance, values, grid):
+    '''Resamples channel values (samples x channels) onto the distance grid.
+    One searchsorted finds the neighbouring samples for all channels at once'''
+    upper = np.clip(np.searchsorted(distance, grid, side='right'), 1, len(distance) - 1)
+    lower = upper - 1
+
+    span = distance[upper] - distance[lower]
+    weight = np.divide(grid - distance[lower], span, out=np.zeros_like(grid), where=span > 0)
+    weight = np.clip(weight, 0, 1)[:, None]
+
+    # written as an offset so that equal neighbours (e.g. full throttle) stay exact
+    resampled = values[lower] + (values[upper] - values[lower]) * weight
+
+    # State channels keep the value of the last sample before the grid point
+    step = [channel_index(channel) for channel in STEP_CHANNELS]
+    last = np.where(weight[:, 0] >= 1, upper, lower)
+    resampled[:, step] = values[last][:, step]
+    return resampled
+
+
+def distance_grid(laps, step=DEFAULT_STEP):
+    '''Common grid up to the shortest of the laps, so nothing is extrapolated'''
+    length = min(lap_telemetry(lap)[0][-1] for lap in laps)
+    return np.arange(0, length, step)
+
+
+def align_laps(laps, step=DEFAULT_STEP, grid=None):
+    '''Resamples a list of laps onto a common distance grid.
+    Returns the grid and an array of shape (laps x grid points x CHANNELS)'''
+    if grid is None:
+        grid = distance_grid(laps, step)
+    with stage('align_laps', laps=len(laps), rows=len(grid)):
+        cube = np.stack([resample(*lap_telemetry(lap), grid) for lap in laps])
+    return grid, cube
+
+
+def aligned_frame(grid, cube, i):
+    '''The aligned telemetry of lap i as a dataframe with a Distance column'''
+    frame = pd.DataFrame(cube[i], columns=CHANNELS)
+    frame.insert(0, 'Distance', grid)
+    return frame
+
+
+def delta_time(cube, reference=0, compare=1):
+    '''Time the compare lap is behind the reference lap at every grid point
+    (same sign as fastf1.utils.delta_time)'''
+    time = cube[..., channel_index('Time')]
+    return time[compare] - time[reference]
+
+
+def delta_time_matrix(cube):
+    '''Delta time between every pair of laps at every grid point in one pass.
+    Entry [i, j] is how far lap j is behind lap i, shape (laps x laps x grid points)'''
+    time = cube[..., channel_index('Time')]
+    return time[None, :, :] - time[:, None, :]
+
+
+def pairwise_delta_table(labels, matrix):
+    '''One row per pair of laps (i before j) with the gap at the end of the
+    lap and the largest gap along the way, from a delta_time_matrix'''
+    first, second = np.triu_indices(len(labels), k=1)
+    pair_deltas = matrix[first, second]
+    labels = np.asarray(labels)
+    return pd.DataFrame({
+        'Reference': labels[first],
+        'Compare': labels[second],
+        'FinalDelta': pair_deltas[:, -1],
+        'MaxDelta': pair_deltas.max(axis=1),
+        'MinDelta': pair_deltas.min(axis=1),
+    })
@@ -0,0 +1,82 @@
+# The analysis modules are scripts next to each other in Code_Analysis and
+# import each other by name, the tests do the same
+
+import os
+import sys
+import time
+import threading
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# Recorded Ergast responses (trimmed to a few drivers), laid out like the api:
+# <season>/<round>/driverStandings.json
+ERGAST_FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures', 'ergast')
+
+
+class ErgastStandIn(ThreadingHTTPServer):
+    '''Serves the recorded Ergast responses at /api/f1. failures maps a path
+    (e.g. "2022/2/driverStandings") to how many 503s it answers first, or to
+    -1 for always, and delay holds every response back for some seconds. It
+    counts the requests per path and the most that were in flight at once'''
+
+    daemon_threads = True
+
+    def __init__(self):
+        super().__init__(('127.0.0.1', 0), _ErgastHandler)
+        self.failures = dict()
+        self.delay = 0.0
+        self.requests = dict()
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.lock = threading.Lock()
+
+    @property
+    def url(self):
+        return f'http://127.0.0.1:{self.server_port}/api/f1'
+
+    def handle_error(self, request, client_address):
+        # Clients that timed out hang up before the answer, that is expected
+        pass
+
+
+class _ErgastHandler(SimpleHTTPRequestHandler):
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, directory=ERGAST_FIXTURES, **kwargs)
+
+    def do_GET(self):
+        server = self.server
+        endpoint = self.path.split('?')[0].replace('/api/f1/', '', 1)[:-len('.json')]
+        with server.lock:
+            server.requests[endpoint] = server.requests.get(endpoint, 0) + 1
+            server.in_flight += 1
+            server.max_in_flight = max(server.max_in_flight, server.in_flight)
+            failures = server.failures.get(endpoint, 0)
+            if failures > 0:
+                server.failures[endpoint] = failures - 1
+        try:
+            time.sleep(server.delay)
+            if failures:
+                self.send_error(503)
+            else:
+                self.path = self.path.replace('/api/f1', '', 1)
+                super().do_GET()
+        finally:
+            with server.lock:
+                server.in_flight -= 1
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def ergast_server():
+    server = ErgastStandIn()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
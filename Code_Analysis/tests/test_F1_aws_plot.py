@@ -0,0 +1,24 @@
+import numpy as np
+
+from F1_aws_plot import action_spans
+
+
+def test_action_spans_run_length():
+    distance = [0, 1, 2, 3, 4, 5]
+    codes = [0, 0, 1, 1, 2, 0]
+    lap_ids = [0, 0, 0, 1, 1, 1]
+
+    start, end, action, lap = action_spans(distance, codes, lap_ids)
+
+    # The same action goes on over the lap change but makes a new run, and
+    # runs join onto the previous run of their own lap only
+    np.testing.assert_array_equal(start, [0, 1, 3, 3, 4])
+    np.testing.assert_array_equal(end, [1, 2, 3, 4, 5])
+    np.testing.assert_array_equal(action, [0, 1, 1, 2, 0])
+    np.testing.assert_array_equal(lap, [0, 0, 1, 1, 1])
+
+
+def test_action_spans_single_lap():
+    start, end, action, lap = action_spans([0, 10, 20, 30], [2, 2, 2, 2])
+
+    assert (start.tolist(), end.tolist(), action.tolist(), lap.tolist()) == ([0], [30], [2], [0])
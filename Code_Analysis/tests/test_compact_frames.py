@@ -0,0 +1,14 @@
+import fastf1.plotting
+import pytest
+
+from compact_frames import verify_compaction
+from synthetic_session import SyntheticSession
+
+
+# fastest_lap_table colors the teams with team_color of fastf1 2.x (requirements.txt)
+@pytest.mark.skipif(not hasattr(fastf1.plotting, 'team_color'), reason='needs fastf1.plotting.team_color')
+def test_analyses_unchanged_by_compaction():
+    checks = verify_compaction(SyntheticSession(drivers=4, laps=12))
+
+    assert len(checks) == 5
+    assert checks['ok'].all(), checks.to_string()
@@ -0,0 +1,81 @@
+# The Ergast fetch layer against a local stand-in for the api (conftest.py)
+# that serves recorded responses
+
+import os
+
+import pytest
+import requests
+
+from constructor_standings import driver_standings, ergast_retrieve, fetch_driver_standings, http_session
+
+
+def test_standings_downloaded_and_cached(ergast_server, tmp_path):
+    season, table, teams = driver_standings('current', cache_dir=tmp_path, base_url=ergast_server.url)
+
+    assert season == 2022
+    assert table['round'].tolist() == [1, 2, 3]
+    assert table['LEC'].tolist() == [1, 1, 1]
+    assert table['VER'].tolist() == [19, 3, 6]
+    assert teams['SAI'] == 'Ferrari'
+    # The latest standings are round 3, only the rounds before it are asked for
+    assert '2022/3/driverStandings' not in ergast_server.requests
+    assert all(os.path.exists(tmp_path / '2022' / str(round_number) / 'driverStandings.json')
+               for round_number in (1, 2, 3))
+
+    requests_before = dict(ergast_server.requests)
+    _, offline_table, _ = driver_standings('current', offline=True, cache_dir=tmp_path)
+    assert offline_table.equals(table)
+    assert ergast_server.requests == requests_before
+
+
+def test_rounds_not_raced_are_not_cached(ergast_server, tmp_path):
+    _, table, _ = driver_standings(2022, rounds=[1, 2, 3, 4], cache_dir=tmp_path, base_url=ergast_server.url)
+
+    assert table['round'].tolist() == [1, 2, 3]
+    assert not os.path.exists(tmp_path / '2022' / '4')
+
+
+def test_server_errors_are_retried(ergast_server, tmp_path):
+    ergast_server.failures['2022/2/driverStandings'] = 2
+
+    _, table, _ = driver_standings(2022, rounds=[1, 2, 3], cache_dir=tmp_path, base_url=ergast_server.url,
+                                   http=http_session(backoff=0))
+
+    assert table['round'].tolist() == [1, 2, 3]
+    assert ergast_server.requests['2022/2/driverStandings'] == 3
+    assert ergast_server.requests['2022/1/driverStandings'] == 1
+
+
+def test_slow_responses_time_out(ergast_server):
+    ergast_server.delay = 0.5
+
+    with pytest.raises(requests.RequestException):
+        ergast_retrieve('2022/1/driverStandings', http=http_session(retries=0), base_url=ergast_server.url,
+                        timeout=0.1)
+
+
+def test_rounds_are_fetched_concurrently(ergast_server):
+    ergast_server.delay = 0.2
+
+    responses = fetch_driver_standings([1, 2, 3], season=2022, base_url=ergast_server.url, max_workers=3)
+
+    assert sorted(responses) == [1, 2, 3]
+    assert responses[2]['StandingsTable']['round'] == '2'
+    assert ergast_server.max_in_flight > 1
+
+
+def test_failed_rounds_keep_the_downloaded_ones(ergast_server, tmp_path):
+    ergast_server.failures['2022/2/driverStandings'] = -1
+
+    with pytest.raises(ConnectionError, match=r'rounds \[2\]'):
+        driver_standings(2022, rounds=[1, 2, 3], cache_dir=tmp_path, base_url=ergast_server.url,
+                         http=http_session(retries=1, backoff=0))
+
+    assert os.path.exists(tmp_path / '2022' / '1' / 'driverStandings.json')
+    assert os.path.exists(tmp_path / '2022' / '3' / 'driverStandings.json')
+    assert not os.path.exists(tmp_path / '2022' / '2')
+
+    del ergast_server.failures['2022/2/driverStandings']
+    _, table, _ = driver_standings(2022, rounds=[1, 2, 3], cache_dir=tmp_path, base_url=ergast_server.url)
+    assert table['round'].tolist() == [1, 2, 3]
+    assert ergast_server.requests['2022/1/driverStandings'] == 1
@@ -0,0 +1,20 @@
+# Every analysis module has to import quickly, without plotting, seaborn or
+# requests: each one is imported in a fresh interpreter by benchmarks.import_times
+
+import pytest
+
+from benchmarks import IMPORT_BUDGET, IMPORT_MODULES, LAZY_MODULES, import_times
+
+
+@pytest.mark.parametrize('module', IMPORT_MODULES)
+def test_import_budget(module):
+    row = import_times([module]).iloc[0]
+    assert not row['loaded'], f'{module} imports {row["loaded"]}, they should load lazily'
+    assert row['seconds'] <= IMPORT_BUDGET, f'{module} took {row["seconds"]:.2f}s to import'
+
+
+def test_lazy_modules_detected():
+    # The probe itself has to notice a module that is imported eagerly
+    row = import_times(['json'], lazy=('json',)).iloc[0]
+    assert row['loaded'] == 'json' and row['violation']
+    assert set(LAZY_MODULES) >= {'matplotlib.pyplot', 'seaborn', 'requests'}
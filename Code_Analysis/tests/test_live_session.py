@@ -0,0 +1,18 @@
+import numpy as np
+
+from live_session import replay_session
+from race_pace import stint_pace_table
+from synthetic_session import SyntheticSession
+
+
+def test_replayed_stint_pace_matches_batch():
+    session = SyntheticSession(drivers=6, laps=30)
+
+    live, chunks = replay_session(session, speed=0, chunk_seconds=30, render=False, car_data=False)
+    batch, _ = stint_pace_table(session.laps)
+    replayed = live.stint_pace_table()
+
+    assert chunks['laps'].sum() == len(session.laps)
+    assert replayed[['Driver', 'Stint', 'Laps']].equals(batch[['Driver', 'Stint', 'Laps']])
+    for column in ('Pace', 'Degradation', 'MeanPace'):
+        np.testing.assert_allclose(replayed[column], batch[column], rtol=0, atol=1e-11)
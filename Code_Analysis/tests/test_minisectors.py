@@ -0,0 +1,15 @@
+import numpy as np
+
+from minisectors import minisector_times
+from synthetic_session import SyntheticSession
+
+
+def test_minisectors_add_up_to_the_lap_time():
+    table, times = minisector_times(SyntheticSession(drivers=4, laps=8), n_sectors=10)
+
+    assert times.shape == (len(table), 10)
+    covered = ~np.isnan(times).any(axis=1)
+    assert covered.mean() > 0.9
+    np.testing.assert_allclose(times[covered].sum(axis=1),
+                               table.loc[covered, 'LapTime'].dt.total_seconds(), atol=1e-6)
+    assert (times[covered] > 0).all()
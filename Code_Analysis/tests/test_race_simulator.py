@@ -0,0 +1,18 @@
+import numpy as np
+
+from race_simulator import RaceModel, simulate_scenarios
+from synthetic_session import SyntheticSession
+
+
+def test_same_result_whatever_the_processes():
+    model = RaceModel.from_session(SyntheticSession(drivers=6, laps=15))
+    scenarios = {'actual': dict(), 'no safety car': dict(safety_car='none', dnf_probability=0.1)}
+
+    here = simulate_scenarios(model, scenarios, runs=300, processes=1, seed=3, chunk=100)
+    pooled = simulate_scenarios(model, scenarios, runs=300, processes=2, seed=3, chunk=100)
+
+    for name in scenarios:
+        assert here[name].shape == (300, 6)
+        np.testing.assert_array_equal(here[name], pooled[name])
+    # Every run is a permutation of the positions
+    assert (np.sort(here['actual'], axis=1) == np.arange(1, 7)).all()
@@ -0,0 +1,49 @@
+import fastf1
+import pytest
+
+from session_cache import SessionCache
+from synthetic_session import SyntheticSession
+
+
+@pytest.fixture
+def synthetic_api(monkeypatch):
+    # Every grand prix is a small made-up race instead of a download
+    monkeypatch.setattr(fastf1, 'get_session', lambda year, grand_prix, session: SyntheticSession(
+        drivers=4, laps=6, name=session, year=year, event_name=grand_prix))
+
+
+def test_least_recently_used_is_evicted(synthetic_api, tmp_path):
+    cache = SessionCache(store_dir=str(tmp_path))
+    cache.get(2022, 'Monaco', 'R').laps
+    # Room for two sessions with their laps
+    cache.set_max_bytes(int(2.5 * cache.nbytes()))
+
+    cache.get(2022, 'Silverstone', 'R').laps
+    cache.get(2022, 'Monaco', 'R')
+    cache.get(2022, 'Monza', 'R').laps
+
+    assert len(cache) == 2
+    assert cache.stats()['evictions'] == 1
+    assert cache.nbytes() <= cache.max_bytes
+    # Silverstone was used least recently and is gone, Monaco is still there
+    misses = cache.stats()['misses']
+    cache.get(2022, 'Monaco', 'R')
+    assert cache.stats()['misses'] == misses
+    cache.get(2022, 'Silverstone', 'R')
+    assert cache.stats()['misses'] == misses + 1
+
+
+def test_budget_checked_after_lazy_loads(synthetic_api, tmp_path):
+    cache = SessionCache(store_dir=str(tmp_path))
+    first = cache.get(2022, 'Monaco', 'R')
+    second = cache.get(2022, 'Monza', 'R')
+    first.laps
+    cache.set_max_bytes(int(1.5 * cache.nbytes()))
+    assert len(cache) == 2
+
+    # Loading the laps of the second session puts the cache over budget
+    second.laps
+
+    assert len(cache) == 1
+    assert cache.get(2022, 'Monza', 'R') is second
+    assert cache.nbytes() <= cache.max_bytes
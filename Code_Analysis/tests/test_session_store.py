@@ -0,0 +1,18 @@
+import numpy as np
+import pandas as pd
+
+from session_store import load_frame, save_frame
+from synthetic_session import SyntheticSession
+
+
+def test_frame_round_trip(tmp_path):
+    laps = pd.DataFrame(SyntheticSession(drivers=3, laps=5).laps)
+    laps['Compound'] = laps['Compound'].astype('category')
+    laps.loc[0, 'Team'] = np.nan
+    path = str(tmp_path / 'laps')
+
+    save_frame(laps, path)
+
+    for mmap in (True, False):
+        loaded = load_frame(path, mmap=mmap)
+        pd.testing.assert_frame_equal(loaded, laps.reset_index(drop=True))
@@ -0,0 +1,36 @@
+import numpy as np
+
+from synthetic_session import SyntheticSession
+from telemetry_alignment import CHANNELS, align_laps, channel_index, delta_time, resample
+
+
+def lap(distance, seconds):
+    values = np.zeros((len(distance), len(CHANNELS)))
+    values[:, channel_index('Speed')] = 200.0
+    values[:, channel_index('Time')] = seconds
+    return np.asarray(distance, dtype=float), values
+
+
+def test_delta_by_hand():
+    grid = np.array([0.0, 50.0, 100.0, 150.0, 200.0])
+    # 100 m in 1 s against 100 m in 2 s, sampled at different distances
+    fast = resample(*lap([0, 100, 200], [0, 1, 2]), grid)
+    slow = resample(*lap([0, 40, 120, 200], [0, 0.8, 2.4, 4]), grid)
+
+    delta = delta_time(np.stack([fast, slow]))
+
+    np.testing.assert_allclose(delta, [0, 0.5, 1, 1.5, 2])
+    assert (fast[:, channel_index('Speed')] == 200).all()
+
+
+def test_delta_at_the_line_is_the_lap_time_difference():
+    laps = SyntheticSession(drivers=2, laps=3).laps.pick_laps(2)
+    first, second = (lap for _, lap in laps.iterlaps())
+
+    grid, cube = align_laps([first, second], step=1.0)
+    delta = delta_time(cube)
+
+    assert cube.shape == (2, len(grid), len(CHANNELS))
+    # Samples are 0.25 s apart, the grid ends a few metres before the line
+    difference = (second['LapTime'] - first['LapTime']).total_seconds()
+    assert abs(delta[-1] - difference) < 0.05
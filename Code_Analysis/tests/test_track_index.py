@@ -0,0 +1,11 @@
+from synthetic_session import SyntheticSession
+from track_index import field_gaps
+
+
+def test_leader_is_first_running_car():
+    gaps = field_gaps(SyntheticSession(drivers=8, laps=12))
+
+    assert (gaps.groupby('SessionTime')['Position'].min() == 1).all()
+    assert (gaps.loc[gaps['Position'] == 1, 'GapToLeader'] == 0).all()
+    assert (gaps['GapToLeader'].dropna() >= 0).all()
+    assert (gaps['GapToAhead'].dropna() >= 0).all()
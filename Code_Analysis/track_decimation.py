@@ -0,0 +1,162 @@
+# track_decimation.py
+# Fewer line segments for the coloured track maps.
+#
+# The speed and gear maps draw one LineCollection segment per telemetry
+# sample, which makes rendering slow and SVG/PDF output large. Here the track
+# is cut into runs of the same colour (gear, or speed bucket), each run is
+# simplified with Ramer-Douglas-Peucker on X/Y and drawn as one polyline. The
+# tolerance is raised until the map fits a target number of segments, so the
+# shape of the track and every colour change are kept.
+
+import time
+
+import numpy as np
+import pandas as pd
+
+
+# Segments of a decimated track map. A few hundred are plenty at poster size
+DEFAULT_MAX_SEGMENTS = 800
+
+# Colour levels when a continuous channel (speed) is bucketed
+DEFAULT_BUCKETS = 48
+
+
+def rdp_mask(points, epsilon):
+    '''Ramer-Douglas-Peucker on a (n x 2) polyline. Returns a boolean mask of
+    the points to keep, the first and last point are always kept'''
+    keep = np.zeros(len(points), dtype=bool)
+    if len(points) == 0:
+        return keep
+    keep[[0, -1]] = True
+
+    # Iterative instead of recursive, laps have thousands of samples
+    stack = [(0, len(points) - 1)]
+    while stack:
+        first, last = stack.pop()
+        if last - first < 2:
+            continue
+
+        start, end = points[first], points[last]
+        interior = points[first + 1:last]
+        chord = end - start
+        length = np.hypot(*chord)
+        if length > 0:
+            # perpendicular distance to the chord
+            distance = np.abs(chord[0] * (interior[:, 1] - start[1]) - chord[1] * (interior[:, 0] - start[0])) / length
+        else:
+            distance = np.hypot(*(interior - start).T)
+
+        farthest = int(np.argmax(distance))
+        if distance[farthest] > epsilon:
+            split = first + 1 + farthest
+            keep[split] = True
+            stack.append((first, split))
+            stack.append((split, last))
+
+    return keep
+
+
+def bucket_values(values, buckets=None):
+    '''Colour level of every sample. With buckets=None the values are used as
+    they are (e.g. gears), otherwise they are cut into that many equal bins and
+    replaced by the bin centre'''
+    values = np.asarray(values, dtype=float)
+    if buckets is None:
+        return values
+
+    low, high = np.nanmin(values), np.nanmax(values)
+    if high == low:
+        return values
+    width = (high - low) / buckets
+    level = np.clip(((values - low) // width), 0, buckets - 1)
+    return low + (level + 0.5) * width
+
+
+def colour_runs(levels):
+    '''Start index of every run of equal colour levels, plus the end'''
+    changes = np.flatnonzero(levels[1:] != levels[:-1]) + 1
+    return np.concatenate([[0], changes, [len(levels)]])
+
+
+def _simplify_runs(points, levels, bounds, epsilon):
+    polylines = list()
+    for start, end in zip(bounds[:-1], bounds[1:]):
+        # Include the first point of the next run so the line stays connected
+        run = points[start:min(end + 1, len(points))]
+        if len(run) < 2:
+            continue
+        polylines.append(run[rdp_mask(run, epsilon)])
+    return polylines
+
+
+def decimate_track(x, y, values, max_segments=DEFAULT_MAX_SEGMENTS, buckets=None):
+    '''Simplifies a coloured track line to at most max_segments segments
+    (or one per colour run, if there are more runs than that).
+    Returns the polylines for a LineCollection and the colour value of each'''
+    points = np.column_stack([np.asarray(x, dtype=float), np.asarray(y, dtype=float)])
+    levels = bucket_values(values, buckets)
+    bounds = colour_runs(levels)
+    colours = levels[bounds[:-1]]
+
+    # Start below the sampling noise and grow the tolerance until it fits
+    extent = np.ptp(points, axis=0).max() if len(points) else 0
+    epsilon = extent * 1e-4
+    while True:
+        polylines = _simplify_runs(points, levels, bounds, epsilon)
+        segments = sum(len(polyline) - 1 for polyline in polylines)
+        if segments <= max_segments or epsilon > extent:
+            break
+        epsilon *= 1.5
+
+    colours = colours[:len(polylines)]
+    return polylines, colours
+
+
+def decimate_line(x, y, max_points=DEFAULT_MAX_SEGMENTS):
+    '''A single-colour line (e.g. the background track) with at most max_points'''
+    polylines, _ = decimate_track(x, y, np.zeros(len(x)), max_segments=max_points - 1)
+    return polylines[0][:, 0], polylines[0][:, 1]
+
+
+def render_cost(plot, *args, formats=('png', 'svg'), **kwargs):
+    '''Seconds and bytes to render plot(*args, output=format, **kwargs) in
+    every format, as a list of dicts'''
+    rows = list()
+    for image_format in formats:
+        started = time.perf_counter()
+        image = plot(*args, output=image_format, **kwargs)
+        rows.append({'format': image_format, 'seconds': time.perf_counter() - started, 'bytes': len(image)})
+    return rows
+
+
+def compare_decimation(driver, session, max_segments=DEFAULT_MAX_SEGMENTS, formats=('png', 'svg')):
+    '''Render time and file size of the speed and gear maps at full resolution
+    and decimated to max_segments, as a dataframe'''
+    from driver_comparisons import driver_gear_changes, driver_speed_change
+
+    rows = list()
+    for plot in (driver_speed_change, driver_gear_changes):
+        # Render once first so loading and telemetry extraction are not measured
+        plot(driver, session, output='png')
+        for segments in (None, max_segments):
+            for row in render_cost(plot, driver, session, formats=formats, max_segments=segments):
+                rows.append({'plot': plot.__name__, 'max_segments': segments, **row})
+
+    table = pd.DataFrame(rows)
+    full = table[table['max_segments'].isna()].set_index(['plot', 'format'])
+    table['speedup'] = table.apply(
+        lambda row: full.loc[(row['plot'], row['format']), 'seconds'] / row['seconds'], axis=1)
+    table['size_ratio'] = table.apply(
+        lambda row: row['bytes'] / full.loc[(row['plot'], row['format']), 'bytes'], axis=1)
+    return table
+
+
+if __name__ == '__main__':
+    import sys
+    from driver_comparisons import get_session
+
+    # python track_decimation.py 2022 Monaco Q LEC [max_segments]
+    year, grand_prix, session_name, driver = sys.argv[1:5]
+    max_segments = int(sys.argv[5]) if len(sys.argv) > 5 else DEFAULT_MAX_SEGMENTS
+    session = get_session(int(year), grand_prix, session_name)
+    print(compare_decimation(driver, session, max_segments).to_string(index=False))
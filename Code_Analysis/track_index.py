@@ -0,0 +1,295 @@
+# track_index.py
+# Where on the lap every car is, and how far it is behind the others.
+#
+# X/Y position data only says where a car is on the map. A reference
+# centreline is built once per circuit from the fastest lap (a point every
+# metre of lap distance) and put in a KD-tree, so the position samples of all
+# drivers are projected onto lap distance with one batched nearest-neighbour
+# query instead of a search per point. Lap distance is unwrapped into race
+# distance, anchored on the lap completion times, and from that the gap to the
+# car ahead and to the leader follow for the whole field: the time since the
+# other car passed the same point of the race.
+#
+# Example:
+#   python track_index.py 2022 Monaco R
+#   python track_index.py 2022 Monaco R --step 0.5 --output gaps.csv
+
+import sys
+import argparse
+
+import numpy as np
+import pandas as pd
+
+from lazy_session import needs_streams
+from instrumentation import instrumented, stage
+from race_replay import MAX_GAP, replay_timeline
+
+
+# Meters of lap distance between points of the reference centreline
+REFERENCE_STEP = 1.0
+
+# Seconds between rows of the gap table
+DEFAULT_GAP_STEP = 1.0
+
+# (year, circuit, step) -> TrackIndex, the centreline of every circuit seen so far
+_TRACK_INDEXES = dict()
+
+
+class TrackIndex:
+    '''Reference centreline of a circuit, a point every step meters of lap
+    distance, in a KD-tree. Z is used as well when there is one, so the two
+    levels of a crossing circuit (Suzuka) are told apart'''
+
+    def __init__(self, distance, x, y, z=None, step=REFERENCE_STEP):
+        from scipy.spatial import cKDTree
+
+        distance = np.asarray(distance, dtype=float)
+        order = np.argsort(distance, kind='stable')
+        distance = distance[order]
+        self.length = float(distance[-1])
+        self.step = step
+        self.distance = np.arange(0, self.length, step)
+
+        columns = [x, y] if z is None else [x, y, z]
+        self.points = np.column_stack([np.interp(self.distance, distance, np.asarray(values, dtype=float)[order])
+                                       for values in columns])
+        self.tree = cKDTree(self.points)
+
+    @classmethod
+    def from_lap(cls, lap, step=REFERENCE_STEP):
+        '''Centreline along a single (fastest) lap'''
+        telemetry = lap.get_telemetry()
+        telemetry = telemetry.loc[telemetry[['Distance', 'X', 'Y']].notna().all(axis=1)]
+        z = telemetry['Z'].to_numpy() if 'Z' in telemetry.columns else None
+        return cls(telemetry['Distance'].to_numpy(), telemetry['X'].to_numpy(),
+                   telemetry['Y'].to_numpy(), z, step=step)
+
+    def __len__(self):
+        return len(self.distance)
+
+    def project(self, x, y, z=None):
+        '''Lap distance (meters) of every position, NaN where a coordinate is missing'''
+        columns = [x, y] if self.points.shape[1] == 2 else [x, y, z]
+        points = np.column_stack([np.asarray(values, dtype=float) for values in columns])
+        valid = np.isfinite(points).all(axis=1)
+
+        lap_distance = np.full(len(points), np.nan)
+        with stage('track_index.query', rows=int(valid.sum())):
+            _, nearest = self.tree.query(points[valid], workers=-1)
+        lap_distance[valid] = self.distance[nearest]
+        return lap_distance
+
+
+def circuit_key(session):
+    return int(session.event.year), str(session.event['Location'])
+
+
+@needs_streams('laps', 'car_data', 'pos_data')
+def track_index(session, step=REFERENCE_STEP):
+    '''The TrackIndex of the session's circuit, built from its fastest lap
+    the first time the circuit (in that year's layout) is asked for'''
+    key = (*circuit_key(session), step)
+    if key not in _TRACK_INDEXES:
+        with stage('track_index.build', circuit=key[1]):
+            _TRACK_INDEXES[key] = TrackIndex.from_lap(session.laps.pick_fastest(), step=step)
+    return _TRACK_INDEXES[key]
+
+
+def driver_numbers(laps, drivers=None):
+    '''{abbreviation: driver number} of the given drivers (all by default)'''
+    numbers = pd.DataFrame(laps)[['Driver', 'DriverNumber']].drop_duplicates('Driver')
+    mapping = dict(zip(numbers['Driver'].astype(str), numbers['DriverNumber'].astype(str)))
+    if drivers is None:
+        return mapping
+    return {drv: mapping[drv] for drv in drivers if drv in mapping}
+
+
+def race_distance(seconds, lap_distance, length, completed):
+    '''Unwraps lap distance into distance since the start line of the race.
+    completed holds (session seconds, lap number) of the driver's finished
+    laps; every one is where race distance passes lap number x length'''
+    lap_distance = np.asarray(lap_distance, dtype=float)
+    valid = np.isfinite(lap_distance)
+    distance = np.full(len(lap_distance), np.nan)
+    if not valid.any():
+        return distance
+
+    # Crossing the line takes lap distance from the end back to 0
+    step = np.diff(lap_distance[valid])
+    jumps = np.where(step < -length / 2, length, 0.0) - np.where(step > length / 2, length, 0.0)
+    unwrapped = lap_distance[valid] + np.concatenate([[0.0], np.cumsum(jumps)])
+
+    # Whole laps to add: the formation lap and the grid behind the line say
+    # nothing about the lap count, the completion times do
+    laps_done = 0
+    if len(completed):
+        completion_seconds, lap_numbers = np.asarray(completed, dtype=float).T
+        at_completion = np.interp(completion_seconds, np.asarray(seconds, dtype=float)[valid], unwrapped)
+        laps_done = np.round(np.median(lap_numbers * length - at_completion) / length)
+    distance[valid] = unwrapped + laps_done * length
+    return distance
+
+
+@instrumented()
+@needs_streams('laps', 'car_data', 'pos_data')
+def project_positions(session, drivers=None, index=None):
+    '''Every position sample of the given drivers (all by default) on the
+    reference centreline: {driver: DataFrame of SessionTime, LapDistance and
+    RaceDistance (meters)}. All drivers are projected in one query'''
+    index = track_index(session) if index is None else index
+    laps = pd.DataFrame(session.laps)
+    numbers = driver_numbers(laps, drivers)
+
+    frames, columns = dict(), list()
+    for drv, number in numbers.items():
+        telemetry = session.pos_data.get(number)
+        if telemetry is None or len(telemetry) == 0:
+            continue
+        frame = pd.DataFrame({'SessionTime': telemetry['SessionTime'].to_numpy()})
+        frames[drv] = frame.sort_values('SessionTime', kind='stable').reset_index(drop=True)
+        order = np.argsort(telemetry['SessionTime'].to_numpy(), kind='stable')
+        columns.append([telemetry[axis].to_numpy(dtype=float)[order] for axis in ('X', 'Y', 'Z')
+                        if axis in telemetry.columns])
+    if not frames:
+        return frames
+
+    # One query for the whole field
+    lengths = np.cumsum([0] + [len(frame) for frame in frames.values()])
+    lap_distance = index.project(*[np.concatenate(axis) for axis in zip(*columns)])
+
+    completed = laps.loc[laps['Time'].notna(), ['Driver', 'Time', 'LapNumber']]
+    completed = {str(drv): np.column_stack([group['Time'].dt.total_seconds(), group['LapNumber']])
+                 for drv, group in completed.groupby('Driver', observed=True)}
+    for i, (drv, frame) in enumerate(frames.items()):
+        seconds = frame['SessionTime'].dt.total_seconds().to_numpy()
+        frame['LapDistance'] = lap_distance[lengths[i]:lengths[i + 1]]
+        frame['RaceDistance'] = race_distance(seconds, frame['LapDistance'].to_numpy(), index.length,
+                                              completed.get(drv, np.empty((0, 2))))
+    return frames
+
+
+def _on_timeline(seconds, values, timeline, start, end, max_gap=MAX_GAP):
+    '''values interpolated at every time of the timeline between start and
+    end, NaN outside of that and inside gaps of more than max_gap seconds'''
+    valid = np.isfinite(values)
+    seconds, values = seconds[valid], values[valid]
+    resampled = np.full(len(timeline), np.nan)
+    if len(seconds) < 2:
+        return resampled
+
+    resampled = np.interp(timeline, seconds, values)
+    right = np.clip(np.searchsorted(seconds, timeline), 1, len(seconds) - 1)
+    covered = (timeline >= max(start, seconds[0])) & (timeline <= min(end, seconds[-1])) \
+        & (seconds[right] - seconds[right - 1] <= max_gap)
+    return np.where(covered, resampled, np.nan)
+
+
+def _time_at(distance, seconds, query):
+    '''When a car first reached each query distance, NaN for distances it
+    hasn't reached. Race distance goes backwards a little where the car cuts
+    across the centreline, the running maximum keeps it in order'''
+    valid = np.isfinite(distance)
+    distance, seconds = np.maximum.accumulate(distance[valid]), seconds[valid]
+    if len(distance) < 2:
+        return np.full(len(query), np.nan)
+    first = np.concatenate([[True], np.diff(distance) > 0])
+    return np.interp(query, distance[first], seconds[first], left=np.nan, right=np.nan)
+
+
+@instrumented()
+@needs_streams('laps', 'car_data', 'pos_data')
+def field_gaps(session, drivers=None, step=DEFAULT_GAP_STEP, index=None):
+    '''Position, race distance, gap to the car ahead and gap to the leader
+    (seconds) of the whole field every step seconds of the race. Gaps are the
+    time since the other car was at the same point, so a lapped car's gap to
+    the leader includes the laps it is down. Only the given drivers are
+    listed (all by default), but the field decides who is ahead'''
+    laps = pd.DataFrame(session.laps)
+    positions = project_positions(session, index=index)
+    timeline = replay_timeline(laps, fps=1, speed=step)
+
+    # Every car counts from the start of its first lap to the end of its last one
+    bounds = laps.groupby('Driver', observed=True).agg(start=('LapStartTime', 'min'), end=('Time', 'max'))
+    names = list(positions)
+    distance = np.full((len(timeline), len(names)), np.nan)
+    curves = list()
+    for j, drv in enumerate(names):
+        frame = positions[drv]
+        seconds = frame['SessionTime'].dt.total_seconds().to_numpy()
+        start, end = (bounds.loc[drv, column].total_seconds() if pd.notna(bounds.loc[drv, column]) else np.nan
+                      for column in ('start', 'end'))
+        distance[:, j] = _on_timeline(seconds, frame['RaceDistance'].to_numpy(), timeline,
+                                      np.nan_to_num(start, nan=-np.inf), np.nan_to_num(end, nan=np.inf))
+        curves.append((frame['RaceDistance'].to_numpy(), seconds))
+
+    with stage('track_index.gaps', rows=distance.size):
+        # Order of the field in every frame, cars not running at the back
+        order = np.argsort(np.where(np.isnan(distance), np.inf, -distance), axis=1, kind='stable')
+        rank = np.empty_like(order)
+        np.put_along_axis(rank, order, np.arange(len(names))[None, :], axis=1)
+        ahead = np.take_along_axis(order, np.maximum(rank - 1, 0), axis=1)
+        leader = np.broadcast_to(order[:, :1], order.shape)
+
+        now = np.broadcast_to(timeline[:, None], distance.shape)
+        gap_ahead = np.full(distance.shape, np.nan)
+        gap_leader = np.full(distance.shape, np.nan)
+        for j, (curve, seconds) in enumerate(curves):
+            for gap, other in ((gap_ahead, ahead), (gap_leader, leader)):
+                mask = (other == j) & ~np.isnan(distance)
+                gap[mask] = now[mask] - _time_at(curve, seconds, distance[mask])
+        gap_ahead[rank == 0] = np.nan
+        gap_leader[rank == 0] = 0.0
+        distance_ahead = np.take_along_axis(distance, ahead, axis=1) - distance
+        distance_ahead[rank == 0] = np.nan
+
+    table = pd.DataFrame({
+        'SessionTime': pd.to_timedelta(np.repeat(timeline, len(names)), unit='s'),
+        'Driver': np.tile(names, len(timeline)),
+        'Position': (rank + 1).ravel(),
+        'RaceDistance': distance.ravel(),
+        'DriverAhead': np.asarray(names, dtype=object)[ahead].ravel(),
+        'DistanceToAhead': distance_ahead.ravel(),
+        'GapToAhead': gap_ahead.ravel(),
+        'GapToLeader': gap_leader.ravel(),
+    })
+    table.loc[table['Position'] == 1, 'DriverAhead'] = None
+    table = table.loc[table['RaceDistance'].notna()]
+    if drivers is not None:
+        table = table.loc[table['Driver'].isin(drivers)]
+    return table.reset_index(drop=True)
+
+
+def main(argv=None):
+    import time
+
+    parser = argparse.ArgumentParser(description='Project the position data onto lap distance and '
+                                                 'compute the gaps of the whole field')
+    parser.add_argument('year', type=int)
+    parser.add_argument('grand_prix')
+    parser.add_argument('session')
+    parser.add_argument('--step', type=float, default=DEFAULT_GAP_STEP, help='seconds between rows')
+    parser.add_argument('--output', help='write the gap table to this .csv file')
+    args = parser.parse_args(argv)
+
+    from driver_comparisons import get_session
+    session = get_session(args.year, args.grand_prix, args.session)
+    session.load_streams('laps', 'car_data', 'pos_data')
+
+    started = time.perf_counter()
+    index = track_index(session)
+    positions = project_positions(session, index=index)
+    projected = time.perf_counter()
+    gaps = field_gaps(session, step=args.step, index=index)
+    finished = time.perf_counter()
+
+    samples = sum(len(frame) for frame in positions.values())
+    print(f'{samples} position samples projected in {projected - started:.2f} s, '
+          f'gaps of {gaps["Driver"].nunique()} drivers in {finished - projected:.2f} s')
+    print(gaps.loc[gaps['SessionTime'] == gaps['SessionTime'].max()].to_string(index=False))
+    if args.output:
+        gaps.to_csv(args.output, index=False)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())